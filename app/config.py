@@ -26,6 +26,14 @@ AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
 AZURE_SEARCH_KEY = os.getenv("AZURE_SEARCH_KEY")
 AZURE_SEARCH_INDEX = os.getenv("AZURE_SEARCH_INDEX")
 
+# ===============================
+# 🧠 Caché de embeddings
+# ===============================
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true")
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", str(Path(__file__).resolve().parent / ".cache" / "embedding_cache.sqlite"))
+EMBEDDING_CACHE_MEMORY_ITEMS = os.getenv("EMBEDDING_CACHE_MEMORY_ITEMS", "1024")
+EMBEDDING_CACHE_MAX_DISK_ITEMS = os.getenv("EMBEDDING_CACHE_MAX_DISK_ITEMS", "50000")
+
 # ===============================
 # 🔒 Validación
 # ===============================
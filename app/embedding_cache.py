@@ -0,0 +1,13 @@
+from typing import Optional
+
+from app import config
+from common.embedding_cache import EmbeddingCache
+
+
+embedding_cache: Optional[EmbeddingCache] = None
+if config.EMBEDDING_CACHE_ENABLED.lower() == "true":
+    embedding_cache = EmbeddingCache(
+        db_path=config.EMBEDDING_CACHE_PATH,
+        memory_items=int(config.EMBEDDING_CACHE_MEMORY_ITEMS),
+        max_disk_items=int(config.EMBEDDING_CACHE_MAX_DISK_ITEMS),
+    )
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from typing import Any, Optional
 
@@ -6,6 +7,7 @@ from azure.search.documents.aio import SearchClient
 from langchain_openai import AzureOpenAIEmbeddings
 
 from app import config
+from app.embedding_cache import embedding_cache
 
 # ── Clases ──────────────────────────────────────────────────────────────────────
 class AzureOpenAI:
@@ -40,7 +42,14 @@ class AzureAISearch:
         k = args.get("k", 3)
 
         try:
-            query_embedding = self.embeddings_model.embed_query(query)
+            # Las preguntas repetidas reutilizan el embedding cacheado.
+            deployment = config.AZURE_OPENAI_EMBEDDING_DEPLOYMENT
+            # SQLite es síncrono: la caché se consulta fuera del event loop.
+            query_embedding = await asyncio.to_thread(embedding_cache.get, deployment, query) if embedding_cache else None
+            if query_embedding is None:
+                query_embedding = await self.embeddings_model.aembed_query(query)
+                if embedding_cache:
+                    await asyncio.to_thread(embedding_cache.put, deployment, query, query_embedding)
             results = await self.search_client.search(
                 search_text=query,
                 vector_queries=[{
@@ -1,15 +1,21 @@
 from langchain_openai import AzureChatOpenAI
-from langchain_core.messages import SystemMessage, BaseMessage, ToolMessage, AIMessage, HumanMessage
+from langchain_core.messages import SystemMessage, BaseMessage, ToolMessage, AIMessage, HumanMessage, message_chunk_to_message
 from langgraph.graph import StateGraph, END
 from langgraph.prebuilt import ToolNode
+from langchain_core.runnables import RunnableConfig
 from typing import TypedDict, Annotated, Sequence
 import operator
-import json
+import asyncio
+import time
+import uuid
 from app import config
 from app.agent.prompts import SYSTEM_PROMPT
 # IMPORTANTE: Importamos TODAS las herramientas.
-from app.agent.tools import agent_tools
+from app.agent.tools import agent_tools, search_similar_queries, get_table_structural_summary
 from app.utils.az_open_ai import AzureOpenAIFunctions
+from app.utils.artifacts import merge_artifacts
+from app.utils.speculative_tools import SpeculativeToolCalls
+from app.utils.observability import observe, timed, record_llm_usage, log_payload, NODE_LATENCY, LLM_LATENCY, LLM_FIRST_TOKEN
 
 # --- 1. Definir el Estado del Agente ---
 class AgentState(TypedDict):
@@ -17,7 +23,11 @@ class AgentState(TypedDict):
     session_id: str
     message_id: str
     sql_query: str
-    sql_results_download_url: str
+    result_format: str
+    use_result_cache: bool
+    # Canal lateral de artefactos (handle -> artefacto): URLs de descarga y datos estructurados que
+    # produce una herramienta para la API y que no viajan en los mensajes.
+    artifacts: Annotated[dict, merge_artifacts]
 
 # --- 2. Definir los Nodos y Herramientas ---
 
@@ -26,25 +36,146 @@ openai_cliente = AzureOpenAIFunctions()
 # Atamos el conjunto completo de herramientas al modelo.
 model = openai_cliente.llm_4o.bind_tools(agent_tools)
 
-def call_model(state: AgentState):
-    print("--- NODO: LLAMANDO AL MODELO ---")
+# Argumentos que no genera el modelo: los aporta el estado del turno.
+RUNTIME_TOOL_ARGS = {
+    "execute_databricks_query": lambda state: {
+        "session_id": state.get("session_id", []),
+        "message_id": state.get("message_id", []),
+        "result_format": state.get("result_format", ""),
+        "use_result_cache": state.get("use_result_cache", True),
+    },
+}
+
+def _with_runtime_args(tool_call: dict, state: AgentState) -> dict:
+    """Añade a los argumentos de la llamada los valores de sesión que la herramienta necesita."""
+    runtime_args = RUNTIME_TOOL_ARGS.get(tool_call["name"])
+    if runtime_args:
+        tool_call["args"].update(runtime_args(state))
+    return tool_call
+
+async def _run_tool_call(tool_call: dict, config: RunnableConfig | None = None) -> ToolMessage:
+    """Ejecuta una sola llamada con el ToolNode (mismo manejo de errores que en el nodo `action`)."""
+    result = await tool_node.ainvoke({"messages": [AIMessage(content="", tool_calls=[tool_call])]}, config)
+    return result["messages"][0]
+
+TOOL_MAX_CONCURRENCY = int(config.TOOL_MAX_CONCURRENCY)
+
+# Herramientas que escriben con la clave del turno (resultado `{session}:{message}` en Cosmos DB):
+# dentro de un paso corren una tras otra, en el orden del modelo.
+SERIAL_TOOLS = {"execute_databricks_query"}
+
+# Herramientas de solo lectura que pueden arrancar mientras el modelo termina de generar.
+# execute_databricks_query queda fuera: escribe el blob, la muestra en Cosmos DB y la caché de
+# resultados, y cancelar la tarea no deshace esas escrituras.
+speculative_calls = SpeculativeToolCalls(
+    ["get_column_value_map", "find_column_values"],
+    dispatch=_run_tool_call,
+    enabled=config.SPECULATIVE_TOOLS_ENABLED.lower() == "true",
+)
+
+@timed(NODE_LATENCY, node="prefetch")
+async def prefetch_context(state: AgentState):
+    """
+    Ejecuta de forma determinista y en paralelo los dos pasos que el prompt exige antes de
+    redactar el SQL (ejemplos similares y resumen estructural) y los inyecta como una llamada a
+    herramientas ya resuelta. Así la primera llamada al modelo puede ir directo al SQL.
+    """
+    print("--- NODO: PRECARGANDO CONTEXTO (ejemplos + esquema en paralelo) ---")
+    last_message = state['messages'][-1]
+    if not isinstance(last_message, HumanMessage):
+        return {"messages": []}
+
+    user_query = last_message.content
+    prefetch_calls = [
+        (search_similar_queries, {"user_query": user_query}),
+        (get_table_structural_summary, {}),
+    ]
+    results = await asyncio.gather(
+        *(tool.ainvoke(args) for tool, args in prefetch_calls),
+        return_exceptions=True,
+    )
 
-    # Estrategia para almacenar la URL de descarga del resultado completo obtenido por la consulta SQL
-    sql_results_download_url = state["sql_results_download_url"]
-    last_message = state["messages"][-1]
-    if isinstance(last_message,ToolMessage) and last_message.name == "execute_databricks_query":
-        try:
-            # print(f"####> LAST MESSAGE {last_message}")
-            content_dict = json.loads(last_message.content)
-            sql_results_download_url = content_dict.get("download_url", sql_results_download_url) # Extraemos la url de descarga para llevarla al state
-            # Limpiamos el mensaje para que el LLM no vea la URL.
-            content_dict.pop("download_url", None)
-            state['messages'][-1].content = json.dumps(content_dict, indent=2, ensure_ascii=False) # Actualizamos la ToolMessage eliminando el campo de "download_url"
-
-        except (json.JSONDecodeError, AttributeError):
-            # Si falla (porque es un string de error), simplemente lo ignoramos y continuamos.
-            # El agente verá el error en el ToolMessage y podrá reaccionar.
-            print("--- El contenido del ToolMessage no es un JSON procesable (probablemente un error), omitiendo extracción de URL. ---")
+    tool_calls, tool_messages = [], []
+    for (tool, args), result in zip(prefetch_calls, results):
+        call_id = f"call_{uuid.uuid4().hex[:24]}"
+        if isinstance(result, Exception):
+            result = f"Error al ejecutar {tool.name}: {result}"
+        tool_calls.append({"name": tool.name, "args": args, "id": call_id})
+        tool_messages.append(ToolMessage(content=str(result), tool_call_id=call_id, name=tool.name))
+
+    return {"messages": [AIMessage(content="", tool_calls=tool_calls)] + tool_messages}
+
+@timed(NODE_LATENCY, node="action")
+async def call_tools(state: AgentState, config: RunnableConfig):
+    """
+    Ejecuta las llamadas a herramientas y traslada sus artefactos (`response_format="content_and_artifact"`)
+    al canal de artefactos del estado. Los ToolMessages conservan solo el handle y el resumen.
+    Las llamadas de un mismo paso corren en paralelo (hasta TOOL_MAX_CONCURRENCY a la vez) y los
+    ToolMessages se devuelven en el orden de las llamadas del modelo. Las que `call_model` ya lanzó
+    de forma anticipada no se repiten: se espera su tarea. Las de SERIAL_TOOLS se encadenan en el
+    orden del modelo, así la última consulta es la que queda en el blob, en Cosmos DB y en el
+    artefacto más reciente.
+    """
+    tool_calls = state["messages"][-1].tool_calls
+    semaphore = asyncio.Semaphore(TOOL_MAX_CONCURRENCY)
+    # asyncio.Lock atiende en orden de llegada y gather arranca las corrutinas en orden.
+    serial_lock = asyncio.Lock()
+
+    async def run(tool_call: dict) -> ToolMessage:
+        task = speculative_calls.take(tool_call["id"])
+        if task is not None:
+            return await task
+        if tool_call["name"] in SERIAL_TOOLS:
+            async with serial_lock, semaphore:
+                return await _run_tool_call(tool_call, config)
+        async with semaphore:
+            return await _run_tool_call(tool_call, config)
+
+    if len(tool_calls) > 1:
+        print(f"--- Ejecutando {len(tool_calls)} herramientas en paralelo: {[call['name'] for call in tool_calls]} ---")
+    messages = list(await asyncio.gather(*(run(tool_call) for tool_call in tool_calls)))
+    artifacts = {}
+    for message in messages:
+        if isinstance(message, ToolMessage) and isinstance(message.artifact, dict) and message.artifact.get("handle"):
+            artifacts[message.artifact["handle"]] = message.artifact
+            message.artifact = None
+    return {"messages": messages, "artifacts": artifacts}
+
+async def _stream_model(messages: list, state: AgentState) -> AIMessage:
+    """
+    Llama al modelo en streaming sobre el pool HTTP asíncrono compartido y agrega los fragmentos
+    en un AIMessage completo (contenido, tool_calls y uso de tokens), igual al que daría `invoke`.
+    Los fragmentos llegan también a `astream_events`, que los reenvía en /chat/stream.
+    Las llamadas a herramientas anticipables se lanzan en cuanto sus argumentos están completos,
+    solapando la cola de la generación con el tiempo del warehouse.
+    """
+    start = time.perf_counter()
+    aggregated = None
+    dispatched = []
+    try:
+        async for chunk in model.astream(messages):
+            if aggregated is None:
+                LLM_FIRST_TOKEN.labels(model=config.AZURE_OPENAI_MODEL_NAME).observe(time.perf_counter() - start)
+                aggregated = chunk
+            else:
+                aggregated = aggregated + chunk
+            if chunk.tool_call_chunks:
+                dispatched += speculative_calls.observe(
+                    aggregated.tool_call_chunks, lambda tool_call: _with_runtime_args(tool_call, state),
+                    run_key=state.get("message_id"),
+                )
+    except BaseException:
+        speculative_calls.discard(dispatched)
+        raise
+    if aggregated is None:
+        return AIMessage(content="")
+    message = message_chunk_to_message(aggregated)
+    speculative_calls.confirm(message.tool_calls, dispatched)
+    return message
+
+@timed(NODE_LATENCY, node="agent")
+async def call_model(state: AgentState):
+    print("--- NODO: LLAMANDO AL MODELO ---")
 
     messages = state['messages']
     if not any(isinstance(m, SystemMessage) for m in messages):
@@ -52,25 +183,23 @@ def call_model(state: AgentState):
     else:
         messages_with_system = messages
     
-    response = [model.invoke(messages_with_system)]
-    print(f"---------- > State en el momento call model: {state}")
-
-    print("--- Response Model ---")
-    print(f"*************** Respuesta Modelo dentro de call model: {response}")
-    print("--- Response Model ---")
+    with observe(LLM_LATENCY, model=config.AZURE_OPENAI_MODEL_NAME):
+        response = [await _stream_model(messages_with_system, state)]
+    record_llm_usage(config.AZURE_OPENAI_MODEL_NAME, getattr(response[0], "usage_metadata", None))
+    print(f"--- Modelo llamado con {len(messages)} mensajes, artefactos: {list(state.get('artifacts') or {})} ---")
+    log_payload("Respuesta del modelo", lambda: response[0])
 
-    # Estrategia para almacenar la QUERY SQL usada por el modelo para responder a la solicitud del usuario
+    # Estrategia para almacenar la QUERY SQL usada por el modelo para responder a la solicitud del usuario.
+    # Con varias consultas en el mismo paso se conserva la última, la misma cuyo artefacto (URL de
+    # descarga) queda como el más reciente, ya que los ToolMessages respetan el orden de las llamadas.
     sql_query = state['sql_query']
-    tool_calls = response[0].tool_calls
-    if tool_calls and tool_calls[0]["name"] == "execute_databricks_query":
-        sql_query = tool_calls[0]["args"]["sql_query"]
+    for tool_call in response[0].tool_calls:
+        if tool_call["name"] == "execute_databricks_query":
+            sql_query = tool_call["args"]["sql_query"]
 
-    return {**state,
+    return {
         "messages": response,
-        "session_id": state['session_id'],
-        "message_id": state['message_id'],
         "sql_query": sql_query,
-        "sql_results_download_url": sql_results_download_url
         }
 
 def should_continue(state: AgentState):
@@ -82,11 +211,8 @@ def should_continue(state: AgentState):
     else:
         print("--- RUTA: A HERRAMIENTA ---")
 
-        if last_message.tool_calls[0]["name"] == "execute_databricks_query":
-            # print(f"########TOOOOOL CALL execute_databricks_query ->  {last_message.tool_calls}")
-            last_message.tool_calls[0]["args"]["session_id"] = state.get("session_id", [])
-            last_message.tool_calls[0]["args"]["message_id"] = state.get("message_id", [])
-            # print(f"########TOOOOOL CALL execute_databricks_query AJUSTADA->  {last_message.tool_calls}")
+        for tool_call in last_message.tool_calls:
+            _with_runtime_args(tool_call, state)
 
         return "continue"
 
@@ -95,7 +221,7 @@ def entry_point_router(state: AgentState):
     """
     Este nodo decide a dónde ir al principio del grafo.
     Si el último mensaje es una llamada a herramienta pre-fabricada, va directo a la acción.
-    De lo contrario, va al agente para que piense.
+    De lo contrario, precarga el contexto y luego va al agente para que piense.
     """
     print("--- NODO DE ENTRADA: Decidiendo ruta inicial ---")
     last_message = state['messages'][-1]
@@ -103,16 +229,18 @@ def entry_point_router(state: AgentState):
         print("--- RUTA INICIAL: A HERRAMIENTA (Vía Rápida) ---")
         return "action"
     else:
-        print("--- RUTA INICIAL: A AGENTE (Flujo Normal) ---")
-        return "agent"
+        print("--- RUTA INICIAL: A PRECARGA Y AGENTE (Flujo Normal) ---")
+        return "prefetch"
 
 workflow = StateGraph(AgentState)
+workflow.add_node("prefetch", prefetch_context)
 workflow.add_node("agent", call_model)
-workflow.add_node("action", tool_node)
+workflow.add_node("action", call_tools)
 workflow.set_conditional_entry_point(
     entry_point_router,
-    {"agent": "agent", "action": "action"}
+    {"prefetch": "prefetch", "action": "action"}
 )
+workflow.add_edge("prefetch", "agent")
 workflow.add_conditional_edges(
     "agent",
     should_continue,
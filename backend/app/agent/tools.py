@@ -4,14 +4,20 @@
 import json
 import re
 import uuid
-from datetime import date
-import pandas as pd
 from langchain_core.tools import tool
 # from langchain_core.pydantic_v1 import BaseModel, Field
 from app.services.databricks_service import DatabricksService
 from app.services.azure_search_service import AzureSearchService
 from app.services.azure_storage_service import AzureStorageService
 from app.services.cosmos_db_service import CosmosDBService # Importamos el servicio de Cosmos
+from app.services.value_dictionary_service import ValueDictionaryService
+from app.utils.query_result import QueryResultHead
+from app.utils.schema_cache import SchemaCache
+from app.utils.result_cache import ResultSetCache, CachedResultSet
+from app.utils.tool_output import encode_table, encode_records, encode_json, ToolTokenReport
+from app.utils.artifacts import new_handle, QUERY_RESULT
+from app.utils.context_builder import TokenCounter
+from app.utils.observability import timed, TOOL_LATENCY
 from tenacity import retry, stop_after_attempt, wait_fixed
 import asyncio
 from app import config
@@ -24,6 +30,31 @@ storage_service = AzureStorageService()
 
 # Cuántos registros mostraremos al agente si el resultado se trunca.
 RESULTS_LIMIT_FOR_THE_AGENT = int(config.RESULTS_LIMIT_FOR_THE_AGENT)
+RESULTS_LIMIT_FOR_THE_FRONTEND = int(config.RESULTS_LIMIT_FOR_THE_FRONTEND)
+
+DEFAULT_TABLE = "`ia-foundation`.pilotos.ods_cliente"
+DEFAULT_SCHEMA = "`ia-foundation`.`pilotos`"
+
+# Caché de metadatos de esquema compartida por las herramientas de esquema.
+# Se invalida por TTL y por cambio de versión Delta de la tabla.
+schema_cache = SchemaCache(
+    ttl_seconds=float(config.SCHEMA_CACHE_TTL_SECONDS),
+    version_check_seconds=float(config.SCHEMA_CACHE_VERSION_CHECK_SECONDS),
+    version_loader=lambda table: asyncio.to_thread(databricks_service.get_table_version, table),
+)
+
+
+# Reporte de tokens por salida de herramienta: formato compacto frente al formato anterior.
+tool_token_report = ToolTokenReport(TokenCounter(config.AZURE_OPENAI_MODEL_NAME)) \
+    if config.TOOL_TOKEN_REPORT_ENABLED.lower() == "true" else None
+
+# Caché de resultados por SQL canónico; se invalida por TTL y por versión Delta de las tablas consultadas.
+result_cache = ResultSetCache(
+    ttl_seconds=float(config.RESULT_CACHE_TTL_SECONDS),
+    max_entries=int(config.RESULT_CACHE_MAX_ENTRIES),
+    version_loader=schema_cache.table_version,
+    version_check_seconds=float(config.RESULT_CACHE_VERSION_CHECK_SECONDS),
+)
 
 
 def _sanitize_table_identifier(sql_query: str) -> str:
@@ -51,84 +82,202 @@ def _sanitize_table_identifier(sql_query: str) -> str:
     # Busca todas las ocurrencias del patrón en la consulta y las reemplaza.
     return pattern.sub(replacer, sql_query)
 
-@tool
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
-async def execute_databricks_query(sql_query: str, session_id: str, message_id: str) -> str:
-    """
-    Ejecuta una consulta SQL en Databricks. El 'session_id' y 'message_id' son inyectados
-    automáticamente por el sistema. La herramienta SIEMPRE guarda el resultado completo y 
-    devuelve solo una muestra al agente.
-    """
+async def _describe_table(table_name: str) -> list[dict]:
+    """Filas de DESCRIBE TABLE (col_name, data_type, comment), servidas desde la caché de esquema."""
+    table_name = table_name.strip()
 
-    if not session_id or not message_id:
-        return "Error: session_id y message_id no fueron encontrados en el contexto de la herramienta. La ejecución no puede continuar."
+    async def loader():
+        result = await asyncio.to_thread(databricks_service.execute_query, f"DESCRIBE TABLE {table_name}")
+        return result.head_records()
 
-    print(f"--- Herramienta 'execute_databricks_query' llamada para session_id: {session_id}, message_id: {message_id} ---")
+    return await schema_cache.get(f"describe:{table_name.lower()}", loader, table=table_name)
 
-    
-    query_sanitized = _sanitize_table_identifier(sql_query.strip().strip('`').rstrip(';'))
+async def _list_tables(schema_name: str = DEFAULT_SCHEMA) -> list[dict]:
+    """Filas de SHOW TABLES para el esquema, servidas desde la caché de esquema (solo TTL)."""
+    async def loader():
+        result = await asyncio.to_thread(databricks_service.execute_query, f"SHOW TABLES IN {schema_name}")
+        return result.head_records()
 
-    try:
-        def sync_executor(query):
-            return databricks_service.execute_query(query)
+    return await schema_cache.get(f"tables:{schema_name.lower()}", loader)
 
-        # 1. Ejecutar la consulta para obtener el resultado completo
-        full_result_data = await asyncio.to_thread(sync_executor, query_sanitized)
+# Diccionario precalculado de pares código/descripción, persistido en SQLite y refrescado en segundo plano.
+value_dictionary = ValueDictionaryService(
+    databricks_service,
+    table_name=DEFAULT_TABLE,
+    db_path=config.VALUE_DICTIONARY_PATH,
+    refresh_interval_seconds=float(config.VALUE_DICTIONARY_REFRESH_SECONDS),
+    max_values_per_column=int(config.VALUE_DICTIONARY_MAX_VALUES),
+)
 
-        # 2. Convertir a DataFrame de Pandas
-        df = pd.DataFrame(full_result_data["rows"], columns=full_result_data["columns"])
-        
-        # 3. Subir el CSV COMPLETO a Azure Blob Storage
-        blob_name = f"{session_id}-{message_id}.csv"
-        download_url = await storage_service.upload_query_results(df, blob_name)
-        
-        # print("##### Hola pasé upload_query_results")
-        # 4. Guardar SIEMPRE una muestra del resultado completo en Cosmos DB
-        await cosmos_db_service.save_query_result(session_id, message_id, full_result_data)
-
-        # print("##### Hola pasé save_query_result")
-
-        # 5. Preparar el resumen y la muestra para el LLM
-        total_count = len(full_result_data["rows"])
-        data_sample = [
-            {
-                k: (v.isoformat() if isinstance(v, date) else v)
-                for k, v in dict(zip(full_result_data["columns"], row)).items()
-            }
-            for row in full_result_data["rows"][:RESULTS_LIMIT_FOR_THE_AGENT]
-        ]
+def start_value_dictionary_refresh() -> asyncio.Task:
+    """Lanza la tarea de fondo que mantiene actualizado el diccionario de valores."""
+    return asyncio.create_task(value_dictionary.run_refresh_loop(lambda: _describe_table(DEFAULT_TABLE)))
 
-        if total_count <= RESULTS_LIMIT_FOR_THE_AGENT:
+async def prewarm_schema_cache():
+    """Precarga la caché de esquema al arrancar para que el primer turno no espere al warehouse."""
+    try:
+        await asyncio.gather(_describe_table(DEFAULT_TABLE), _list_tables())
+        print(f"--- Caché de esquema precargada: {schema_cache.stats()} ---")
+    except Exception as e:
+        print(f"Error precargando la caché de esquema: {e}")
 
-            summary_for_agent = {
-                "estado": "Resultados de la consulta devueltos completamente, háblale de ellos",
-                "resultado_consulta_sql": data_sample,
-                "download_url": download_url
-            }
+def _summarize_for_agent(handle: str, total_count: int, data_sample: list, columns: list) -> dict:
+    """
+    Resumen compacto del resultado para el LLM: handle del artefacto, conteos y la muestra como
+    tabla `|`. Las instrucciones sobre cómo presentarlo viven en el prompt.
+    """
+    return {
+        "artefacto": handle,
+        "filas_totales": total_count,
+        "filas_mostradas": len(data_sample),
+        "resultado_consulta_sql": encode_records(data_sample, columns),
+    }
+
+def _query_result_artifact(handle: str, sql_query: str, total_count: int, columns: list, download_url: str,
+                           result_format: str, session_id: str, message_id: str) -> dict:
+    """
+    Artefacto del resultado: lo que necesita la API y no el modelo. Viaja en el canal de
+    artefactos del estado, nunca en los mensajes (ni en el historial guardado en Cosmos DB).
+    La muestra para el frontend se lee de Cosmos DB con `session_id` y `message_id`.
+    """
+    return {
+        "handle": handle,
+        "kind": QUERY_RESULT,
+        "sql_query": sql_query,
+        "total_rows": total_count,
+        "columns": columns,
+        "download_url": download_url,
+        "download_format": result_format,
+        "session_id": session_id,
+        "message_id": message_id,
+    }
+
+def _legacy_summary_for_agent(total_count: int, data_sample: list) -> dict:
+    """Formato anterior del resumen (registros con instrucciones en 'estado'); solo para el reporte de tokens."""
+    if total_count <= RESULTS_LIMIT_FOR_THE_AGENT:
+        estado = "Resultados de la consulta devueltos completamente, háblale de ellos"
+    elif total_count <= 100:
+        estado = f"La consulta devolvió un total de {total_count} registros, háblale de estos primeros 10. En la tabla inferior del front el usuario puede observarlos completamente. Recuerdale que el también puede descargarlos."
+    else:
+        estado = f"La consulta devolvió un total de {total_count} registros, háblale de estos primeros 10. En la tabla inferior del front el usuario puede observar una muestra mayor. Para visualizarlos todos, puede descargar el CSV con los resultados"
+    return {"estado": estado, "resultado_consulta_sql": data_sample}
+
+def _encode_summary(summary_for_agent: dict, total_count: int, data_sample: list) -> str:
+    encoded = encode_json(summary_for_agent)
+    if tool_token_report is not None:
+        tool_token_report.record(
+            "execute_databricks_query",
+            json.dumps(_legacy_summary_for_agent(total_count, data_sample), indent=2, default=str),
+            encoded,
+        )
+    return encoded
+
+@tool(response_format="content_and_artifact")
+@timed(TOOL_LATENCY, tool="execute_databricks_query")
+@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
+async def execute_databricks_query(sql_query: str, session_id: str, message_id: str, result_format: str = "", use_result_cache: bool = True) -> tuple:
+    """
+    Ejecuta una consulta SQL en Databricks. El 'session_id', 'message_id', 'result_format' y
+    'use_result_cache' son inyectados automáticamente por el sistema. La herramienta SIEMPRE guarda
+    el resultado completo y devuelve solo una muestra al agente.
+    """
 
-        elif total_count > RESULTS_LIMIT_FOR_THE_AGENT and total_count <= 100:
+    if not session_id or not message_id:
+        return "Error: session_id y message_id no fueron encontrados en el contexto de la herramienta. La ejecución no puede continuar.", None
 
-            summary_for_agent = {
-                "estado": f"La consulta devolvió un total de {total_count} registros, háblale de estos primeros 10. En la tabla inferior del front el usuario puede observarlos completamente. Recuerdale que el también puede descargarlos.",
-                "resultado_consulta_sql": data_sample,
-                "download_url": download_url
-            }
+    print(f"--- Herramienta 'execute_databricks_query' llamada para session_id: {session_id}, message_id: {message_id} ---")
 
-        elif total_count > 100:
+    
+    query_sanitized = _sanitize_table_identifier(sql_query.strip().strip('`').rstrip(';'))
 
-            summary_for_agent = {
-                "estado": f"La consulta devolvió un total de {total_count} registros, háblale de estos primeros 10. En la tabla inferior del front el usuario puede observar una muestra mayor. Para visualizarlos todos, puede descargar el CSV con los resultados",
-                "resultado_consulta_sql": data_sample,
-                "download_url": download_url
-            }
+    try:
+        # 0. Reutilizar el resultado si la misma consulta ya se ejecutó y las tablas no cambiaron:
+        #    no se toca el warehouse, ni el Storage, ni se reescribe la muestra en Cosmos DB.
+        cache_key = ResultSetCache.make_key(query_sanitized, result_format)
+        if not use_result_cache:
+            result_cache.record_bypass()
+        else:
+            cached = await result_cache.get(cache_key)
+            if cached is not None:
+                print(f"--- Resultado reutilizado de la caché (mensaje original {cached.message_id}) ---")
+                # Si la entrada es de este mismo turno, su resultado sigue guardado: no hay nada que enlazar.
+                if (cached.session_id, cached.message_id) != (session_id, message_id):
+                    result_cache.evict_message(session_id, message_id)
+                    await cosmos_db_service.save_query_result_alias(
+                        session_id, message_id, cached.session_id, cached.message_id, cached.artifact.get("blob_name")
+                    )
+                handle = new_handle(QUERY_RESULT)
+                summary_for_agent = _summarize_for_agent(handle, cached.total_rows, cached.agent_sample, cached.columns)
+                return _encode_summary(summary_for_agent, cached.total_rows, cached.agent_sample), _query_result_artifact(
+                    handle, sql_query, cached.total_rows, cached.columns, cached.download_url, cached.result_format, session_id, message_id
+                )
+
+        # Versiones de las tablas ANTES de ejecutar: si cambian durante la consulta, la entrada
+        # que se guarde después ya nace invalidada.
+        table_versions = await result_cache.snapshot_versions(query_sanitized)
+
+        # El resultado del turno en Cosmos DB se va a reescribir: las entradas que lo referencian
+        # (otra consulta del mismo turno) dejarían de corresponder a su SQL.
+        result_cache.evict_message(session_id, message_id)
+
+        # 1. Ejecutar la consulta y subir el CSV COMPLETO a Azure Blob Storage por streaming:
+        #    los lotes se suben mientras se descargan y solo se retienen las primeras filas.
+        #    El formato (csv, csv.gz o parquet) se elige por petición o por tamaño del resultado.
+        #    El blob lleva la clave de la consulta: otra consulta del mismo turno no lo sobrescribe,
+        #    así la URL de descarga guardada en la caché sigue correspondiendo a este SQL.
+        result_head = QueryResultHead(max(RESULTS_LIMIT_FOR_THE_AGENT, RESULTS_LIMIT_FOR_THE_FRONTEND))
+        batch_size = int(config.RESULTS_EXPORT_BATCH_ROWS)
+        batches = databricks_service.stream_arrow_batches(
+            query_sanitized,
+            batch_size=batch_size,
+            max_pending=int(config.RESULTS_EXPORT_MAX_PENDING_BATCHES),
+        )
+        download_url, export_stats = await storage_service.upload_query_results_stream(
+            batches,
+            f"{session_id}-{message_id}-{cache_key[:12]}",
+            result_format=result_format,
+            batch_size=batch_size,
+            on_batch=result_head.add,
+        )
+        query_result = result_head.to_result(total_rows=export_stats.rows)
+
+        # 2. Guardar SIEMPRE una muestra del resultado completo en Cosmos DB,
+        #    junto con el formato del archivo exportado para poder releerlo.
+        artifact = {
+            "blob_name": export_stats.blob_name,
+            "format": export_stats.result_format,
+            "rows": export_stats.rows,
+            "bytes": export_stats.bytes,
+        }
+        await cosmos_db_service.save_query_result(session_id, message_id, query_result, artifact=artifact)
+
+        # 3. Preparar el resumen y la muestra para el LLM
+        total_count = query_result.num_rows
+        data_sample = query_result.head_records(RESULTS_LIMIT_FOR_THE_AGENT)
+        handle = new_handle(QUERY_RESULT)
+        summary_for_agent = _summarize_for_agent(handle, total_count, data_sample, query_result.columns)
+
+        result_cache.put(cache_key, CachedResultSet(
+            total_rows=total_count,
+            agent_sample=data_sample,
+            columns=query_result.columns,
+            download_url=download_url,
+            result_format=export_stats.result_format,
+            artifact=artifact,
+            session_id=session_id,
+            message_id=message_id,
+        ), table_versions)
 
         # print(f"0000000 ---/ SUMARY RESULTS EXECUTE DATABRICKS --> {summary_for_agent}")
-        return json.dumps(summary_for_agent, indent=2, default=str)
+        return _encode_summary(summary_for_agent, total_count, data_sample), _query_result_artifact(
+            handle, sql_query, total_count, query_result.columns, download_url, export_stats.result_format, session_id, message_id
+        )
 
     except (ValueError, Exception) as e:
-        return str(e)
+        return str(e), None
 
 @tool
+@timed(TOOL_LATENCY, tool="get_database_schema_info")
 @retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
 async def get_database_schema_info(table_name: str = None) -> str:
     """
@@ -138,54 +287,34 @@ async def get_database_schema_info(table_name: str = None) -> str:
     Usa esta herramienta si no estás seguro sobre los nombres de las columnas.
     """
     # Limpiamos el nombre de la tabla por si el LLM lo pasa con comillas
-    clean_table_name = table_name.strip('`') if table_name else "`ia-foundation`.pilotos.ods_cliente"
+    clean_table_name = table_name.strip('`') if table_name else DEFAULT_TABLE
 
     if table_name:
         # Pide la descripción detallada de una tabla específica
-        # query = f"DESCRIBE TABLE {table_name};"
-        query = "DESCRIBE TABLE `ia-foundation`.pilotos.ods_cliente"
         prompt = f"Obteniendo el esquema para la tabla '{table_name}'..."
     else:
         # Pide la lista de todas las tablas en el esquema especificado
-        # IMPORTANTE: Ajusta `ia-foundation`.`pilotos` al catálogo y esquema que estés usando.
-        query = "SHOW TABLES IN `ia-foundation`.`pilotos`;"
+        # IMPORTANTE: Ajusta DEFAULT_SCHEMA al catálogo y esquema que estés usando.
         prompt = "Obteniendo la lista de todas las tablas disponibles..."
 
     print(f"--- Herramienta 'get_database_schema_info' llamada: {prompt} ---")
     
-    # Reutilizamos nuestro servicio de Databricks para ejecutar esta consulta
-    print(f"query para Databricks: {query}")
     # Formateamos la salida para que sea más útil para el LLM
     try:
-        def sync_schema_executor(q):
-            return databricks_service.execute_query(query=q)
-            
-        result_data = await asyncio.to_thread(sync_schema_executor, query)
-        data = [dict(zip(result_data["columns"], row)) for row in result_data["rows"]]
+        # La descripción se sirve desde la caché de esquema compartida
+        data = await _describe_table(DEFAULT_TABLE) if table_name else await _list_tables()
 
         # Extraemos solo la información relevante para no saturar el prompt
         if table_name:
 
-            # --- Formateo a Tabla Markdown ---
-        
-            # Encabezado de la tabla
-            header = "| Columna | Tipo de Dato | Descripción |\n|---|---|---|"
-
-            # Construir cada fila de la tabla
-            rows = []
-            for col in data:
-                # Limpiamos los comentarios para que no rompan el formato de la tabla
-                col_name = col.get('col_name', 'N/A')
-                data_type = col.get('data_type', 'N/A')
-                comment = col.get('comment', 'N/A') or 'N/A' # Asegurarse de que no sea None
-                cleaned_comment = comment.replace('\n', ' ').replace('|', '') # Quitar saltos de línea y pipes
-                
-                rows.append(f"| {col_name} | {data_type} | {cleaned_comment} |")
-            
-            # Unir todo en un solo string
-            formatted_info = f"Esquema para la tabla `{clean_table_name}`:\n\n{header}\n" + "\n".join(rows)
-
-            print("--- Esquema de tabla formateado exitosamente como Markdown para el agente. ---")
+            # --- Formateo a tabla compacta (encabezado + filas separadas por '|') ---
+            rows = [
+                (col.get('col_name', 'N/A'), col.get('data_type', 'N/A'), col.get('comment', 'N/A') or 'N/A')
+                for col in data
+            ]
+            formatted_info = f"Esquema de {clean_table_name}:\n" + encode_table(["Columna", "Tipo", "Descripción"], rows)
+
+            print("--- Esquema de tabla formateado exitosamente como tabla compacta para el agente. ---")
 
         else:
             # Para SHOW TABLES, extraemos solo los nombres de las tablas
@@ -200,34 +329,37 @@ async def get_database_schema_info(table_name: str = None) -> str:
 
 # --- HERRAMIENTA: EL "MAPA" ESTRUCTURAL ---
 @tool
+@timed(TOOL_LATENCY, tool="get_table_structural_summary")
 @retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
-async def get_table_structural_summary(table_name: str = "`ia-foundation`.pilotos.ods_cliente") -> str:
+async def get_table_structural_summary(table_name: str = DEFAULT_TABLE) -> str:
     """
     Proporciona un resumen ESTRUCTURAL y CONCISO del esquema de la tabla. Devuelve
     el nombre de la columna, su tipo de dato y una BREVE descripción.
     Usa esta herramienta primero para entender la estructura general de la tabla.
     NO devuelve la lista de valores posibles de cada columna.
     """
-    query = f"DESCRIBE TABLE {table_name}"
     print(f"--- Herramienta 'get_table_structural_summary' llamada para: {table_name} ---")
     
     try:
-        def sync_executor(q):
-            return databricks_service.execute_query(query=q)
-            
-        result_data = await asyncio.to_thread(sync_executor, query)
-        data = [dict(zip(result_data["columns"], row)) for row in result_data["rows"]]
-        
-        header = "| Columna | Tipo de Dato | Descripción Breve |\n|---|---|---|"
-        rows = []
-        for col in data:
-            comment = col.get('comment', '') or ''
-            # --- LÓGICA CLAVE: Extraemos solo la primera línea del comentario ---
-            # Esto nos da la descripción sin la lista masiva de valores.
-            brief_description = comment.split('\n')[0].strip()
-            rows.append(f"| {col.get('col_name', 'N/A')} | {col.get('data_type', 'N/A')} | {brief_description} |")
+        # DESCRIBE TABLE se sirve desde la caché de esquema compartida
+        data = await _describe_table(table_name)
         
-        formatted_info = f"Resumen estructural para la tabla `{table_name}`:\n\n{header}\n" + "\n".join(rows)
+        # --- LÓGICA CLAVE: Extraemos solo la primera línea del comentario ---
+        # Esto nos da la descripción sin la lista masiva de valores.
+        rows = [
+            (col.get('col_name', 'N/A'), col.get('data_type', 'N/A'), (col.get('comment', '') or '').split('\n')[0].strip())
+            for col in data
+        ]
+        formatted_info = f"Resumen estructural de {table_name}:\n" + encode_table(["Columna", "Tipo", "Descripción"], rows)
+
+        if tool_token_report is not None:
+            header = "| Columna | Tipo de Dato | Descripción Breve |\n|---|---|---|"
+            markdown_rows = [f"| {name} | {data_type} | {brief} |" for name, data_type, brief in rows]
+            tool_token_report.record(
+                "get_table_structural_summary",
+                f"Resumen estructural para la tabla `{table_name}`:\n\n{header}\n" + "\n".join(markdown_rows),
+                formatted_info,
+            )
         return formatted_info
 
     except Exception as e:
@@ -235,8 +367,9 @@ async def get_table_structural_summary(table_name: str = "`ia-foundation`.piloto
 
 # --- HERRAMIENTA: EL "ZOOM" SEMÁNTICO ---
 @tool
+@timed(TOOL_LATENCY, tool="get_column_value_map")
 @retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
-async def get_column_value_map(column_name: str, descriptive_column_name: str, table_name: str = "`ia-foundation`.pilotos.ods_cliente") -> str:
+async def get_column_value_map(column_name: str, descriptive_column_name: str, table_name: str = DEFAULT_TABLE) -> str:
     """
     Devuelve los valores únicos y sus descripciones para una columna categórica específica.
     Usa esta herramienta DESPUÉS de ver el resumen estructural, si necesitas mapear un
@@ -249,22 +382,52 @@ async def get_column_value_map(column_name: str, descriptive_column_name: str, t
     print(f"--- Herramienta 'get_column_value_map' llamada para la columna: {column_name} ---")
     
     try:
-        def sync_executor(q):
-            return databricks_service.execute_query(query=q)
-            
-        result_data = await asyncio.to_thread(sync_executor, query)
-        
-        # Formateamos como una tabla Markdown para máxima claridad
-        header = f"| Columna ({column_name}) | Descripción ({descriptive_column_name}) |\n|---|---|"
-        rows = [f"| {row[0]} | {row[1]} |" for row in result_data["rows"]]
+        # Primero el diccionario precalculado; la consulta en vivo solo si el par aún no está materializado.
+        value_rows = value_dictionary.get(column_name, descriptive_column_name) if table_name == DEFAULT_TABLE else None
+        if value_rows is None:
+            def sync_executor(q):
+                return databricks_service.execute_query(query=q)
+
+            result_data = await asyncio.to_thread(sync_executor, query)
+            value_rows = result_data.head_rows()
         
-        formatted_info = f"Mapeo de valores para la columna `{column_name}`:\n\n{header}\n" + "\n".join(rows)
+        # Tabla compacta: encabezado con los nombres de columna y una fila por valor
+        formatted_info = f"Mapeo de valores de {column_name}:\n" + encode_table([column_name, descriptive_column_name], value_rows)
         return formatted_info
         
     except Exception as e:
         return f"No se pudo obtener el mapeo de valores para la columna {column_name}: {str(e)}"
 
+# --- HERRAMIENTA: BÚSQUEDA APROXIMADA DE VALORES ---
 @tool
+@timed(TOOL_LATENCY, tool="find_column_values")
+async def find_column_values(search_term: str, candidate_columns: list[str] | None = None, top_k: int = 5) -> str:
+    """
+    Busca los códigos cuyo valor descriptivo se parece más al término del usuario
+    (ej. 'Oficina Chipichape' -> AGEHOMO = 108). Tolera tildes, mayúsculas y errores leves.
+    Úsala ANTES que `get_column_value_map` para columnas con muchos valores (oficinas,
+    ciudades, regionales): devuelve solo las mejores coincidencias en lugar del mapa completo.
+    Args:
+        search_term (str): El valor mencionado por el usuario (ej. 'Chipichape').
+        candidate_columns (list[str], opcional): Columnas de código o descriptivas donde buscar (ej. ['AGEHOMO']).
+        top_k (int): Número máximo de coincidencias a devolver.
+    """
+    print(f"--- Herramienta 'find_column_values' llamada con: '{search_term}' en {candidate_columns or 'todas las columnas'} ---")
+
+    matches = value_dictionary.search(search_term, columns=candidate_columns, top_k=max(1, min(top_k, 20)))
+    if not matches:
+        return (
+            f"No se encontraron valores parecidos a '{search_term}' en el diccionario de valores. "
+            "Usa `get_column_value_map` sobre la columna adecuada."
+        )
+
+    rows = [(m['code_column'], m['code'], m['desc_column'], m['description'], m['score']) for m in matches]
+    return f"Mejores coincidencias para '{search_term}':\n" + encode_table(
+        ["columna_codigo", "codigo", "columna_descripcion", "descripcion", "similitud"], rows
+    )
+
+@tool
+@timed(TOOL_LATENCY, tool="search_similar_queries")
 @retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
 async def search_similar_queries(user_query: str) -> str:
     """
@@ -288,17 +451,11 @@ async def search_similar_queries(user_query: str) -> str:
         if not similar_queries:
             return "No se encontraron consultas similares en la base de ejemplos. Procederé a construir la consulta basándome únicamente en el esquema de la tabla."
         
-        # Formatear el contexto para el agente
-        context = "**CONSULTAS SIMILARES ENCONTRADAS:**\n\n"
-        
-        for i, query in enumerate(similar_queries, 1):
-            context += f"**Ejemplo {i}**:\n"
-            context += f"- Pregunta: \"{query.get('user_query')}\"\n"
-            context += f"- SQL: {query.get('sql_query')}\n\n"
-        
-        context += "**INSTRUCCIONES:**\n"
-        context += "- Usa estos ejemplos similares como referencia para construir tu consulta SQL\n"
-        context += "- Mantén la misma estructura y patrones de los ejemplos cuando sea posible\n"
+        # Formatear el contexto para el agente (las instrucciones de uso están en el prompt)
+        context = "\n\n".join(
+            f"Ejemplo {i}\nPregunta: {query.get('user_query')}\nSQL: {query.get('sql_query')}"
+            for i, query in enumerate(similar_queries, 1)
+        )
         
         print(f"--- Contexto generado con {len(similar_queries)} ejemplos similares ---")
         return context
@@ -308,4 +465,4 @@ async def search_similar_queries(user_query: str) -> str:
         return f"Error al buscar consultas similares: {e}"
 
 # Lista de herramientas para ser usadas por el agente
-agent_tools = [execute_databricks_query, get_table_structural_summary, get_column_value_map, search_similar_queries]
\ No newline at end of file
+agent_tools = [execute_databricks_query, get_table_structural_summary, find_column_values, get_column_value_map, search_similar_queries]
\ No newline at end of file
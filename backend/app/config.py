@@ -19,6 +19,12 @@ COSMOS_DB_KEY = os.getenv("COSMOS_DB_KEY")
 COSMOS_DB_DATABASE_NAME = os.getenv("COSMOS_DB_DATABASE_NAME", "db_agentesql")
 COSMOS_DB_CONTAINER_NAME = os.getenv("COSMOS_DB_CONTAINER_NAME", "historialconversaciones")
 COSMOS_DB_RESULTS_CONTAINER_NAME = os.getenv("COSMOS_DB_RESULTS_CONTAINER_NAME", "resultadosquerysql")
+# "session": un agregado por sesión y lecturas puntuales; "message": un documento por mensaje (modo original)
+COSMOS_STORAGE_MODE = os.getenv("COSMOS_STORAGE_MODE", "session")
+# Mensajes recientes que conserva el agregado de la sesión (debe cubrir CONVERSATION_HISTORY_WINDOW)
+COSMOS_SESSION_WINDOW_MESSAGES = os.getenv("COSMOS_SESSION_WINDOW_MESSAGES", "50")
+# Sesiones recientes en la caché write-through del proceso
+COSMOS_SESSION_CACHE_SIZE = os.getenv("COSMOS_SESSION_CACHE_SIZE", "256")
 
 # --- Configuración de Azure Storage ---
 AZURE_STORAGE_SAS_TOKEN = os.getenv("AZURE_STORAGE_SAS_TOKEN")
@@ -40,11 +46,115 @@ DATABRICKS_TABLE = os.getenv("DATABRICKS_TABLE")
 AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
 AZURE_SEARCH_KEY = os.getenv("AZURE_SEARCH_KEY")
 AZURE_SEARCH_INDEX_NAME = os.getenv("AZURE_SEARCH_INDEX_NAME", "index_sqlagent")
+# Conexiones HTTP keep-alive máximas de los clientes asíncronos de Azure (Search / OpenAI)
+AZURE_HTTP_MAX_CONNECTIONS = os.getenv("AZURE_HTTP_MAX_CONNECTIONS", "20")
 
 # --- Agent Configuration ---
 CONVERSATION_HISTORY_WINDOW = os.getenv("CONVERSATION_HISTORY_WINDOW")
+# Presupuesto de tokens del historial enviado al modelo y turnos recientes con salidas de herramientas completas
+HISTORY_TOKEN_BUDGET = os.getenv("HISTORY_TOKEN_BUDGET", "6000")
+HISTORY_FULL_TOOL_OUTPUT_TURNS = os.getenv("HISTORY_FULL_TOOL_OUTPUT_TURNS", "1")
+HISTORY_TOOL_DIGEST_CHARS = os.getenv("HISTORY_TOOL_DIGEST_CHARS", "200")
 RESULTS_LIMIT_FOR_THE_AGENT = os.getenv("RESULTS_LIMIT_FOR_THE_AGENT")
+# Reporta los tokens de cada salida de herramienta (formato compacto frente al anterior). Es para
+# diagnóstico: construye el formato anterior y tokeniza ambos en cada consulta
+TOOL_TOKEN_REPORT_ENABLED = os.getenv("TOOL_TOKEN_REPORT_ENABLED", "false")
 RESULTS_LIMIT_FOR_THE_FRONTEND = os.getenv("RESULTS_LIMIT_FOR_THE_FRONTEND")
+# Máximo de filas que /get_sample_result lee del archivo exportado en una sola respuesta
+RESULTS_SAMPLE_MAX_ROWS = os.getenv("RESULTS_SAMPLE_MAX_ROWS", "10000")
+
+# --- Pool de conexiones a Databricks ---
+DATABRICKS_POOL_SIZE = os.getenv("DATABRICKS_POOL_SIZE", "4")
+DATABRICKS_POOL_ACQUIRE_TIMEOUT = os.getenv("DATABRICKS_POOL_ACQUIRE_TIMEOUT", "30")
+DATABRICKS_POOL_IDLE_TIMEOUT = os.getenv("DATABRICKS_POOL_IDLE_TIMEOUT", "600")
+DATABRICKS_POOL_HEALTH_CHECK_INTERVAL = os.getenv("DATABRICKS_POOL_HEALTH_CHECK_INTERVAL", "60")
+
+# --- Exportación de resultados por streaming a Blob Storage ---
+RESULTS_EXPORT_BATCH_ROWS = os.getenv("RESULTS_EXPORT_BATCH_ROWS", "50000")
+RESULTS_EXPORT_MAX_PENDING_BATCHES = os.getenv("RESULTS_EXPORT_MAX_PENDING_BATCHES", "2")
+RESULTS_EXPORT_BLOCK_SIZE_MB = os.getenv("RESULTS_EXPORT_BLOCK_SIZE_MB", "4")
+# Formato del archivo descargable: auto | csv | csv.gz | parquet
+RESULTS_EXPORT_FORMAT = os.getenv("RESULTS_EXPORT_FORMAT", "auto")
+# En modo 'auto', formato usado para resultados grandes y umbral (MB del primer lote) para considerarlos así.
+RESULTS_LARGE_FORMAT = os.getenv("RESULTS_LARGE_FORMAT", "csv.gz")
+RESULTS_COMPRESSION_THRESHOLD_MB = os.getenv("RESULTS_COMPRESSION_THRESHOLD_MB", "1")
+
+# --- Caché de esquema (DESCRIBE TABLE / SHOW TABLES) ---
+SCHEMA_CACHE_TTL_SECONDS = os.getenv("SCHEMA_CACHE_TTL_SECONDS", "86400")
+SCHEMA_CACHE_VERSION_CHECK_SECONDS = os.getenv("SCHEMA_CACHE_VERSION_CHECK_SECONDS", "300")
+
+# --- Diccionario precalculado de valores categóricos (get_column_value_map) ---
+VALUE_DICTIONARY_PATH = os.getenv(
+    "VALUE_DICTIONARY_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "value_dictionary.sqlite"),
+)
+VALUE_DICTIONARY_REFRESH_SECONDS = os.getenv("VALUE_DICTIONARY_REFRESH_SECONDS", "86400")
+VALUE_DICTIONARY_MAX_VALUES = os.getenv("VALUE_DICTIONARY_MAX_VALUES", "5000")
+
+# --- Caché de embeddings ---
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true")
+EMBEDDING_CACHE_PATH = os.getenv(
+    "EMBEDDING_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "embedding_cache.sqlite"),
+)
+EMBEDDING_CACHE_MEMORY_ITEMS = os.getenv("EMBEDDING_CACHE_MEMORY_ITEMS", "1024")
+EMBEDDING_CACHE_MAX_DISK_ITEMS = os.getenv("EMBEDDING_CACHE_MAX_DISK_ITEMS", "50000")
+
+# --- Réplica local del índice de ejemplos (few-shot) ---
+LOCAL_EXAMPLE_INDEX_ENABLED = os.getenv("LOCAL_EXAMPLE_INDEX_ENABLED", "true")
+LOCAL_EXAMPLE_INDEX_SYNC_SECONDS = os.getenv("LOCAL_EXAMPLE_INDEX_SYNC_SECONDS", "300")
+
+# --- Caché semántica de respuestas (pregunta -> SQL) ---
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true")
+ANSWER_CACHE_SIMILARITY_THRESHOLD = os.getenv("ANSWER_CACHE_SIMILARITY_THRESHOLD", "0.95")
+ANSWER_CACHE_MAX_ENTRIES = os.getenv("ANSWER_CACHE_MAX_ENTRIES", "500")
+ANSWER_CACHE_TTL_SECONDS = os.getenv("ANSWER_CACHE_TTL_SECONDS", "86400")
+# Solo se consulta la caché en el primer turno de la sesión (preguntas sin dependencia del historial)
+ANSWER_CACHE_FIRST_TURN_ONLY = os.getenv("ANSWER_CACHE_FIRST_TURN_ONLY", "true")
+
+# --- Caché de resultados por SQL ---
+RESULT_CACHE_TTL_SECONDS = os.getenv("RESULT_CACHE_TTL_SECONDS", "3600")
+RESULT_CACHE_MAX_ENTRIES = os.getenv("RESULT_CACHE_MAX_ENTRIES", "256")
+# Antigüedad máxima (segundos) de la versión Delta con la que se valida un acierto de la caché
+RESULT_CACHE_VERSION_CHECK_SECONDS = os.getenv("RESULT_CACHE_VERSION_CHECK_SECONDS", "5")
+
+# --- Persistencia diferida (write-behind) en Cosmos DB ---
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "true")
+WRITE_BEHIND_CONCURRENCY = os.getenv("WRITE_BEHIND_CONCURRENCY", "4")
+WRITE_BEHIND_MAX_RETRIES = os.getenv("WRITE_BEHIND_MAX_RETRIES", "3")
+WRITE_BEHIND_MAX_QUEUE = os.getenv("WRITE_BEHIND_MAX_QUEUE", "1000")
+WRITE_BEHIND_REPLAY_SECONDS = os.getenv("WRITE_BEHIND_REPLAY_SECONDS", "30")
+WRITE_BEHIND_DRAIN_TIMEOUT = os.getenv("WRITE_BEHIND_DRAIN_TIMEOUT", "10")
+WRITE_BEHIND_JOURNAL_PATH = os.getenv(
+    "WRITE_BEHIND_JOURNAL_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "write_behind_journal.jsonl"),
+)
+
+# --- Observabilidad ---
+# Nivel de registro; con DEBUG se imprimen cargas voluminosas (estado, respuestas del modelo, SQL)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# Fracción de las cargas voluminosas que se imprimen con LOG_LEVEL=DEBUG
+LOG_PAYLOAD_SAMPLE_RATE = os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.1")
+
+# --- Grabación y reproducción de llamadas externas (cassettes) ---
+# "off", "record" (graba las llamadas reales) o "replay" (las reproduce sin red)
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "off")
+# Un archivo por escenario (JSONL comprimido con gzip)
+CASSETTE_PATH = os.getenv(
+    "CASSETTE_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "cassettes", "default.jsonl.gz"),
+)
+# Reaplicar en la reproducción la latencia grabada de cada llamada
+CASSETTE_REPLAY_LATENCY = os.getenv("CASSETTE_REPLAY_LATENCY", "true")
+# Si una llamada no está grabada, reproducir la siguiente del mismo tipo en vez de fallar
+CASSETTE_REPLAY_FALLBACK = os.getenv("CASSETTE_REPLAY_FALLBACK", "false")
+
+# --- Ejecución anticipada de herramientas ---
+# Lanzar get_column_value_map / find_column_values (solo lectura) en cuanto sus argumentos llegan completos
+# en el streaming del modelo, sin esperar al final de la respuesta
+SPECULATIVE_TOOLS_ENABLED = os.getenv("SPECULATIVE_TOOLS_ENABLED", "true")
+# Máximo de herramientas que el nodo `action` ejecuta a la vez cuando el modelo pide varias en un paso
+TOOL_MAX_CONCURRENCY = os.getenv("TOOL_MAX_CONCURRENCY", "4")
 
 # Validar que las variables críticas están presentes
 if not all([AZURE_OPENAI_API_KEY, COSMOS_DB_ENDPOINT, COSMOS_DB_KEY, DATABRICKS_SERVER_HOSTNAME, DATABRICKS_HTTP_PATH, DATABRICKS_TOKEN]):
@@ -1,6 +1,10 @@
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse, Response
 from contextlib import asynccontextmanager
 import uuid
+import json
+import asyncio
+import time
 import os
 import sys
 
@@ -9,20 +13,67 @@ import sys
 # sys.path.append(parent_dir)
 
 # Importar los servicios, esquemas y el agente real
-from app.services.cosmos_db_service import CosmosDBService
+from app.services.write_behind import WriteBehindQueue
 from app.services.azure_storage_service import AzureStorageService
 from app.schemas import ChatRequest, ChatResponse, QueryResultSample
 from app.agent.graph import agent_executor
+from app.agent.tools import databricks_service, azure_search_service, schema_cache, prewarm_schema_cache
+from app.agent.tools import value_dictionary, start_value_dictionary_refresh, DEFAULT_TABLE, result_cache
+from app.agent.tools import cosmos_db_service, tool_token_report, storage_service as tools_storage_service
 # from app.agent import agent_executor, execute_databracks_query
 from langchain_core.messages import HumanMessage, AIMessage, ToolMessage
-from fastapi import HTTPException, Path
+from fastapi import HTTPException, Path, Query
+from app.utils.embedding_cache import get_embedding_cache
+from app.utils.answer_cache import SemanticAnswerCache
+from app.utils.context_builder import HistoryContextBuilder
+from app.utils.artifacts import latest_artifact, QUERY_RESULT
+from app.utils.observability import render_metrics
+from app.utils.cassette import Cassette, install_cassette
+from app.utils.http_client import close_async_http_client
+from app.agent import graph as agent_graph
+from app.utils.az_ai_search import AzureIASearch
+from typing import Optional
 from app import config
 
 # --- Inicialización de servicios y constantes ---
-cosmos_service = CosmosDBService()
+# Se comparte la instancia de las herramientas para que ambas vean la misma cola de persistencia diferida.
+cosmos_service = cosmos_db_service
 storage_service = AzureStorageService()
 CONVERSATION_HISTORY_WINDOW = int(config.CONVERSATION_HISTORY_WINDOW)
 
+# El historial enviado al modelo se limita por tokens; CONVERSATION_HISTORY_WINDOW solo acota cuántos mensajes se cargan.
+history_builder = HistoryContextBuilder(
+    token_budget=int(config.HISTORY_TOKEN_BUDGET),
+    full_tool_output_turns=int(config.HISTORY_FULL_TOOL_OUTPUT_TURNS),
+    digest_chars=int(config.HISTORY_TOOL_DIGEST_CHARS),
+    model_name=config.AZURE_OPENAI_MODEL_NAME,
+)
+
+# Persistencia diferida de historial y muestras de resultados.
+write_behind = WriteBehindQueue(
+    writer=cosmos_service.write_item,
+    journal_path=config.WRITE_BEHIND_JOURNAL_PATH,
+    concurrency=int(config.WRITE_BEHIND_CONCURRENCY),
+    max_retries=int(config.WRITE_BEHIND_MAX_RETRIES),
+    max_queue=int(config.WRITE_BEHIND_MAX_QUEUE),
+    replay_interval_seconds=float(config.WRITE_BEHIND_REPLAY_SECONDS),
+) if config.WRITE_BEHIND_ENABLED.lower() == "true" else None
+
+# Caché pregunta -> SQL para reutilizar el SQL final ante preguntas casi idénticas.
+answer_cache = SemanticAnswerCache(
+    max_entries=int(config.ANSWER_CACHE_MAX_ENTRIES),
+    similarity_threshold=float(config.ANSWER_CACHE_SIMILARITY_THRESHOLD),
+    ttl_seconds=float(config.ANSWER_CACHE_TTL_SECONDS),
+) if config.ANSWER_CACHE_ENABLED.lower() == "true" else None
+
+# Cassette de llamadas externas (CASSETTE_MODE=record|replay) para perfilar el agente sin red.
+cassette = Cassette(
+    path=config.CASSETTE_PATH,
+    mode=config.CASSETTE_MODE.lower(),
+    replay_latency=config.CASSETTE_REPLAY_LATENCY.lower() == "true",
+    allow_fallback=config.CASSETTE_REPLAY_FALLBACK.lower() == "true",
+) if config.CASSETTE_MODE.lower() in ("record", "replay") else None
+
 def _sanitize_history_for_api(history: list) -> list:
     """
     Elimina cualquier 'ToolMessage' huérfano del principio del historial
@@ -35,10 +86,38 @@ def _sanitize_history_for_api(history: list) -> list:
         sanitized_history.pop(0)
     return sanitized_history
 
+async def _answer_cache_fingerprint() -> str:
+    """Huella del contexto del que depende el SQL cacheado: versión de la tabla e índice de ejemplos."""
+    table_version = await schema_cache.table_version(DEFAULT_TABLE)
+    local_index = azure_search_service.local_index
+    examples = local_index.manifest_hash() if local_index is not None and local_index.ready else "remote"
+    return f"{table_version}:{examples}"
+
+def _successful_sql(new_messages: list, sql_query: str) -> Optional[str]:
+    """SQL del turno si la última ejecución de `execute_databricks_query` devolvió resultados (JSON válido)."""
+    for message in reversed(new_messages):
+        if isinstance(message, ToolMessage) and message.name == "execute_databricks_query":
+            try:
+                return sql_query if "resultado_consulta_sql" in json.loads(message.content) else None
+            except (json.JSONDecodeError, TypeError):
+                return None
+    return None
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Gestiona las tareas de inicio y apagado."""
     print("--- La aplicación está iniciando ---")
+    # Grabación / reproducción de las llamadas externas; en replay no se abre ninguna conexión real.
+    if cassette is not None:
+        await install_cassette(
+            cassette,
+            graph_module=agent_graph,
+            databricks_service=databricks_service,
+            cosmos_service=cosmos_service,
+            storage_services=[storage_service, tools_storage_service],
+            search_service=azure_search_service,
+            index_names=[config.AZURE_SEARCH_INDEX_NAME],
+        )
     await cosmos_service.initialize_resources()
     # Asegurar contenedor de Azure Storage
     try:
@@ -47,8 +126,32 @@ async def lifespan(app: FastAPI):
         # No detenemos el arranque, pero registramos el error para diagnosticar
         print(f"Error inicializando contenedor de Storage: {e}")
     print("--- Inicialización de recursos de Cosmos DB completada ---")
+    if write_behind is not None:
+        await write_behind.start()
+        cosmos_service.write_behind = write_behind
+    # Clientes asíncronos de larga vida para la recuperación de ejemplos
+    await azure_search_service.initialize_clients()
+    # Réplica local del índice de ejemplos: carga inicial y sincronización periódica en segundo plano
+    example_index_task = asyncio.create_task(azure_search_service.run_local_index_sync_loop())
+    # Precargar el esquema para que los turnos no paguen DESCRIBE TABLE contra el warehouse
+    await prewarm_schema_cache()
+    # Mantener el diccionario de valores categóricos actualizado en segundo plano
+    value_dictionary_task = start_value_dictionary_refresh()
     yield
     print("--- La aplicación se está apagando ---")
+    # Esperar a que terminen las persistencias pendientes de /chat/stream
+    if _background_tasks:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+    # Vaciar la cola de persistencia diferida (lo pendiente queda en el journal local)
+    if write_behind is not None:
+        await write_behind.drain(timeout=float(config.WRITE_BEHIND_DRAIN_TIMEOUT))
+    value_dictionary_task.cancel()
+    example_index_task.cancel()
+    await azure_search_service.close()
+    await close_async_http_client()
+    databricks_service.close()
+    if cassette is not None:
+        cassette.save()
 
 
 app = FastAPI(
@@ -63,103 +166,341 @@ def read_root():
     """Endpoint raíz para verificar que la API está funcionando."""
     return {"status": "ok", "message": "Welcome to the SQL Agent API"}
 
+@app.get("/metrics", tags=["Health Check"])
+def get_metrics():
+    """Histogramas de latencia (nodos, modelo, herramientas, servicios externos) y tokens en formato Prometheus."""
+    payload, content_type = render_metrics()
+    return Response(content=payload, media_type=content_type)
 
-@app.post("/chat", response_model=ChatResponse, tags=["Agent"])
-async def chat_with_agent(request: ChatRequest):
+@app.get("/stats/databricks_pool", tags=["Health Check"])
+def get_databricks_pool_stats():
+    """Métricas del pool de conexiones a Databricks para dimensionarlo frente al warehouse."""
+    return databricks_service.get_pool_stats()
+
+@app.get("/stats/schema_cache", tags=["Health Check"])
+def get_schema_cache_stats():
+    """Aciertos, fallos e invalidaciones de la caché de esquema."""
+    return schema_cache.stats()
+
+@app.get("/stats/value_dictionary", tags=["Health Check"])
+def get_value_dictionary_stats():
+    """Pares materializados y aciertos del diccionario de valores categóricos."""
+    return value_dictionary.stats()
+
+@app.get("/stats/example_index", tags=["Health Check"])
+def get_example_index_stats():
+    """Estado de la réplica local del índice de ejemplos y búsquedas que fueron al índice remoto."""
+    return azure_search_service.stats()
+
+@app.get("/stats/result_cache", tags=["Health Check"])
+def get_result_cache_stats():
+    """Aciertos, omisiones por petición e invalidaciones de la caché de resultados por SQL."""
+    return result_cache.stats()
+
+@app.get("/stats/answer_cache", tags=["Health Check"])
+def get_answer_cache_stats():
+    """Aciertos exactos y semánticos de la caché pregunta -> SQL."""
+    return answer_cache.stats() if answer_cache else {"enabled": False}
+
+@app.get("/stats/cosmos", tags=["Health Check"])
+def get_cosmos_stats():
+    """Modo de almacenamiento y aciertos de la caché de sesiones de Cosmos DB."""
+    return cosmos_service.stats()
+
+@app.get("/stats/write_behind", tags=["Health Check"])
+def get_write_behind_stats():
+    """Profundidad de la cola, latencia de volcado y escrituras en el journal de la persistencia diferida."""
+    return write_behind.stats() if write_behind else {"enabled": False}
+
+@app.get("/stats/tool_tokens", tags=["Health Check"])
+def get_tool_token_stats():
+    """Tokens acumulados por herramienta con el formato compacto frente al formato anterior."""
+    return tool_token_report.stats() if tool_token_report else {"enabled": False}
+
+@app.get("/stats/cassette", tags=["Health Check"])
+def get_cassette_stats():
+    """Modo del cassette de llamadas externas e interacciones grabadas o reproducidas."""
+    return cassette.stats() if cassette else {"enabled": False}
+
+@app.get("/stats/speculative_tools", tags=["Health Check"])
+def get_speculative_tool_stats():
+    """Llamadas a herramientas lanzadas durante el streaming del modelo, aprovechadas y descartadas."""
+    return agent_graph.speculative_calls.stats()
+
+@app.get("/stats/embedding_cache", tags=["Health Check"])
+def get_embedding_cache_stats():
+    """Tasa de aciertos y tamaño de la caché de embeddings."""
+    cache = get_embedding_cache()
+    return cache.stats() if cache else {"enabled": False}
 
+
+async def _prepare_turn(request: ChatRequest, session_id: str, message_id: str) -> dict:
+    """
+    Prepara el estado inicial del grafo para un turno: historial saneado, vía rápida de SQL
+    corregido, vía rápida por caché de respuestas o flujo normal. Lo comparten /chat y /chat/stream.
+    """
     user_query = request.user_query
     corrected_sql_query = request.corrected_sql_query
+
+    # Recuperamos el historial de la base de datos para tener contexto.
+    conversation_history = await cosmos_service.get_conversation_history(
+        session_id,
+        limit=CONVERSATION_HISTORY_WINDOW
+    )
+    # --- Sanitización del Historial ---
+    # Nos aseguramos de que el historial no comience con un ToolMessage huérfano y lo ajustamos al
+    # presupuesto de tokens (pares llamada/resultado intactos, salidas antiguas resumidas).
+    sanitized_history = history_builder.build(_sanitize_history_for_api(conversation_history))
+
+    messages_for_agent = list(sanitized_history)
+    cached_answer = None
+    normalized_question = None
+    question_vector = None
+
+    if corrected_sql_query:
+
+        # --- RUTA 1: VÍA RÁPIDA DE CORRECCIÓN DE SQL ---
+        print(f"--- Vía Rápida: Ejecutando SQL corregido por el usuario ---")
+
+        # Creamos un HumanMessage que instruye al agente a llamar a la herramienta.
+        correction_message = HumanMessage(
+            content=f"He corregido la consulta anterior. Por favor, ejecuta esta nueva versión:\n\n```sql\n{corrected_sql_query}\n```"
+        )
+
+        # Creamos un AIMessage "falso" que instruye al agente a llamar a la herramienta.
+        pre_fabricated_tool_call = {
+            "name": "execute_databricks_query",
+            "args": {
+                "sql_query": corrected_sql_query,
+                "message_id": message_id,
+                "session_id": session_id,
+                "result_format": request.result_format or "",
+                "use_result_cache": not request.bypass_result_cache
+                },
+            "id": f"{str(uuid.uuid4())}"
+        }
+        ai_message_with_tool_call = AIMessage(
+            content="",
+            tool_calls=[pre_fabricated_tool_call]
+        )
+        # Añadimos estos mensajes fabricados al historial que pasaremos al agente.
+        messages_for_agent.extend([correction_message, ai_message_with_tool_call])
+
+    else:
+
+        # Añadimos el mensaje del usuario.
+        current_user_message = HumanMessage(content=user_query)
+        messages_for_agent.append(current_user_message)
+
+        # Solo las preguntas autocontenidas (primer turno de la sesión) se consultan y guardan en la
+        # caché de respuestas: en turnos posteriores el SQL puede depender del historial.
+        if answer_cache is not None and (not sanitized_history or config.ANSWER_CACHE_FIRST_TURN_ONLY.lower() != "true"):
+            normalized_question = AzureIASearch.normalize_text(user_query)
+            try:
+                answer_cache.validate(await _answer_cache_fingerprint())
+                cached_answer = answer_cache.lookup(normalized_question)
+                if cached_answer is None:
+                    # Mismo texto normalizado que usa la búsqueda de ejemplos: el embedding queda cacheado para ella.
+                    question_vector = await azure_search_service.get_embedding(normalized_question)
+                    cached_answer = answer_cache.lookup(normalized_question, question_vector)
+            except Exception as e:
+                print(f"Error consultando la caché de respuestas: {e}")
+                normalized_question = None
+
+    if cached_answer is not None:
+
+        # --- RUTA 2: VÍA RÁPIDA POR CACHÉ DE RESPUESTAS ---
+        print(f"--- Vía Rápida: SQL reutilizado de la caché de respuestas ({cached_answer['match']}, {cached_answer['similarity']}) ---")
+
+        pre_fabricated_tool_call = {
+            "name": "execute_databricks_query",
+            "args": {
+                "sql_query": cached_answer["sql_query"],
+                "message_id": message_id,
+                "session_id": session_id,
+                "result_format": request.result_format or "",
+                "use_result_cache": not request.bypass_result_cache
+                },
+            "id": f"{str(uuid.uuid4())}"
+        }
+        messages_for_agent.append(AIMessage(content="", tool_calls=[pre_fabricated_tool_call]))
+
+    elif not corrected_sql_query:
+
+        # --- RUTA 3: FLUJO NORMAL DEL AGENTE ---
+        print(f"--- Flujo Normal: Invocando al agente ---")
+
+    # Estado inicial con el mensaje fabricado o el mensaje del usuario
+    initial_state = {
+        "messages": messages_for_agent,
+        "session_id": session_id,
+        "message_id": message_id,
+        "sql_query": corrected_sql_query or (cached_answer["sql_query"] if cached_answer else ""),
+        "artifacts": {},
+        "result_format": request.result_format or "",
+        "use_result_cache": not request.bypass_result_cache
+    }
+    return {
+        "session_id": session_id,
+        "message_id": message_id,
+        "sanitized_history": sanitized_history,
+        "initial_state": initial_state,
+        "cached_answer": cached_answer,
+        "normalized_question": normalized_question,
+        "question_vector": question_vector,
+    }
+
+async def _persist_turn(turn: dict, agent_response: dict):
+    """Guarda los mensajes nuevos del turno en Cosmos DB y, si procede, el SQL final en la caché de respuestas."""
+    new_messages_from_turn = agent_response.get("messages", [])[len(turn["sanitized_history"]):]
+
+    # Guardar el "proceso de pensamiento" completo en la DB.
+    await cosmos_service.add_messages(turn["session_id"], new_messages_from_turn)
+
+    # Guardar el SQL final del flujo normal en la caché de respuestas si se ejecutó con éxito.
+    if turn["normalized_question"] and turn["question_vector"] is not None and turn["cached_answer"] is None:
+        successful_sql = _successful_sql(new_messages_from_turn, agent_response.get("sql_query"))
+        if successful_sql:
+            answer_cache.store(turn["normalized_question"], turn["question_vector"], successful_sql)
+
+def _turn_response(turn: dict, agent_response: dict) -> ChatResponse:
+    """Construye la respuesta final del turno a partir del estado final del grafo."""
+    new_messages_from_turn = agent_response.get("messages", [])[len(turn["sanitized_history"]):]
+    final_response_content = new_messages_from_turn[-1].content if new_messages_from_turn else "No se generó una respuesta."
+
+    # Extraemos el SQL del estado final y la URL del artefacto del último resultado de la consulta.
+    query_artifact = latest_artifact(agent_response.get("artifacts"), QUERY_RESULT) or {}
+    return ChatResponse(
+        response=final_response_content,
+        sql_query=agent_response.get("sql_query"),
+        session_id=turn["session_id"],
+        message_id=turn["message_id"],
+        sql_results_download_url=query_artifact.get("download_url") or "",
+        sql_results_format=query_artifact.get("download_format") or None
+    )
+
+@app.post("/chat", response_model=ChatResponse, tags=["Agent"])
+async def chat_with_agent(request: ChatRequest):
+
     session_id = request.session_id or str(uuid.uuid4())
     message_id = request.message_id or str(uuid.uuid4())
     
     try:
-        # Recuperamos el historial de la base de datos para tener contexto.
-        conversation_history = await cosmos_service.get_conversation_history(
-            session_id,
-            limit=CONVERSATION_HISTORY_WINDOW
-        )
-        # --- Sanitización del Historial ---
-        # Nos aseguramos de que el historial no comience con un ToolMessage huérfano.
-        sanitized_history = _sanitize_history_for_api(conversation_history)
-
-        messages_for_agent = list(sanitized_history)
-
-        if corrected_sql_query:
-
-            # --- RUTA 1: VÍA RÁPIDA DE CORRECCIÓN DE SQL ---
-            print(f"--- Vía Rápida: Ejecutando SQL corregido por el usuario ---")
-
-            # Creamos un HumanMessage que instruye al agente a llamar a la herramienta.
-            correction_message = HumanMessage(
-                content=f"He corregido la consulta anterior. Por favor, ejecuta esta nueva versión:\n\n```sql\n{corrected_sql_query}\n```"
-            )
-
-            # Creamos un AIMessage "falso" que instruye al agente a llamar a la herramienta.
-            pre_fabricated_tool_call = {
-                "name": "execute_databricks_query",
-                "args": {
-                    "sql_query": corrected_sql_query,
-                    "message_id": message_id,
-                    "session_id": session_id
-                    },
-                "id": f"{str(uuid.uuid4())}"
-            }
-            ai_message_with_tool_call = AIMessage(
-                content="",
-                tool_calls=[pre_fabricated_tool_call]
-            )
-            # Añadimos estos mensajes fabricados al historial que pasaremos al agente.
-            messages_for_agent.extend([correction_message, ai_message_with_tool_call])
-
-        else:
-
-            # --- RUTA 2: FLUJO NORMAL DEL AGENTE ---
-            print(f"--- Flujo Normal: Invocando al agente ---")
-
-            # Añadimos el mensaje del usuario.
-            current_user_message = HumanMessage(content=user_query)
-            messages_for_agent.append(current_user_message)
+        turn = await _prepare_turn(request, session_id, message_id)
 
         # Invocar al agente con el fabricado o el estado preparado con la serialización de mensajes
-        initial_state = {
-            "messages": messages_for_agent,
-            "session_id": session_id,
-            "message_id": message_id,
-            "sql_query": corrected_sql_query or "",
-            "sql_results_download_url": ""
-        }
-        agent_response = await agent_executor.ainvoke(initial_state)
-
-        # Guardar el historial completo del turno en la DB.
-        new_messages_from_turn = agent_response.get("messages", [])[len(sanitized_history):]
+        with agent_graph.speculative_calls.run_scope(message_id):
+            agent_response = await agent_executor.ainvoke(turn["initial_state"])
 
-        # Guardar el "proceso de pensamiento" completo en la DB.
-        await cosmos_service.add_messages(session_id, new_messages_from_turn)
+        # Guardar el historial completo del turno en la DB, fuera del camino crítico: reservar el
+        # turno en el agregado de la sesión puede requerir varias idas y vueltas a Cosmos DB.
+        _run_in_background(_persist_turn_safely(turn, agent_response))
 
         # Preparar y devolver la respuesta final al usuario.
-        final_response_content = new_messages_from_turn[-1].content if new_messages_from_turn else "No se generó una respuesta."
-
-        # Extraemos el SQL y la URL del estado final del grafo.
-        sql_query = agent_response.get("sql_query")
-        sql_results_download_url = agent_response.get("sql_results_download_url")
-
-        return ChatResponse(
-            response=final_response_content,
-            sql_query=sql_query,
-            session_id=session_id,
-            message_id=message_id,
-            sql_results_download_url=sql_results_download_url
-        )
+        return _turn_response(turn, agent_response)
 
     except Exception as e:
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Ocurrió un error inesperado: {e}")
 
+# Nodos del grafo cuyas transiciones se notifican al cliente en /chat/stream
+STREAM_GRAPH_NODES = {"prefetch", "agent", "action"}
+# Argumentos inyectados por el sistema que no se exponen en los eventos de herramientas
+STREAM_HIDDEN_TOOL_ARGS = {"session_id", "message_id", "result_format", "use_result_cache"}
+# Tareas de persistencia lanzadas fuera del camino crítico (se retiene la referencia hasta que terminan)
+_background_tasks: set = set()
+
+def _sse(event: str, data: dict) -> str:
+    """Serializa un evento Server-Sent Events."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+def _run_in_background(coroutine):
+    task = asyncio.create_task(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def _persist_turn_safely(turn: dict, agent_response: dict):
+    try:
+        await _persist_turn(turn, agent_response)
+    except Exception as e:
+        print(f"Error persistiendo el turno {turn['message_id']} de la sesión {turn['session_id']}: {e}")
+
+async def _stream_turn(request: ChatRequest, session_id: str, message_id: str):
+    """
+    Genera los eventos SSE de un turno: inicio inmediato, transiciones de nodos, inicio y fin de
+    herramientas con su duración, tokens de la respuesta final y un evento final con el SQL y la URL.
+    """
+    # Primer byte inmediato, antes de cualquier E/S
+    yield _sse("start", {"session_id": session_id, "message_id": message_id})
+    try:
+        turn = await _prepare_turn(request, session_id, message_id)
+        tool_started_at = {}
+        final_state = None
+
+        # Al desconectarse el cliente el generador se cierra y `run_scope` cancela lo anticipado.
+        with agent_graph.speculative_calls.run_scope(message_id):
+            async for event in agent_executor.astream_events(turn["initial_state"], version="v2"):
+                kind = event["event"]
+                name = event.get("name")
+                node = event.get("metadata", {}).get("langgraph_node")
+
+                if kind == "on_chain_start" and name in STREAM_GRAPH_NODES and node == name:
+                    yield _sse("node", {"node": name})
+
+                elif kind == "on_tool_start":
+                    tool_started_at[event["run_id"]] = time.perf_counter()
+                    tool_input = event.get("data", {}).get("input") or {}
+                    if isinstance(tool_input, dict):
+                        tool_input = {k: v for k, v in tool_input.items() if k not in STREAM_HIDDEN_TOOL_ARGS}
+                    yield _sse("tool_start", {"tool": name, "run_id": event["run_id"], "input": tool_input})
+
+                elif kind == "on_tool_end":
+                    started = tool_started_at.pop(event["run_id"], None)
+                    duration_ms = round((time.perf_counter() - started) * 1000, 1) if started else None
+                    yield _sse("tool_end", {"tool": name, "run_id": event["run_id"], "duration_ms": duration_ms})
+
+                elif kind == "on_chat_model_stream" and node == "agent":
+                    # Las llamadas a herramientas llegan sin contenido de texto: solo se emite la respuesta final.
+                    chunk = event["data"]["chunk"]
+                    if isinstance(chunk.content, str) and chunk.content:
+                        yield _sse("token", {"text": chunk.content})
+
+                elif kind == "on_chain_end" and not event.get("parent_ids"):
+                    final_state = event["data"].get("output")
+
+        if not isinstance(final_state, dict):
+            raise RuntimeError("El grafo terminó sin devolver un estado final.")
+
+        # La persistencia en Cosmos DB no retrasa el evento final.
+        _run_in_background(_persist_turn_safely(turn, final_state))
+        yield _sse("final", _turn_response(turn, final_state).model_dump())
+
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        yield _sse("error", {"detail": f"Ocurrió un error inesperado: {e}"})
+
+@app.post("/chat/stream", tags=["Agent"])
+async def chat_with_agent_stream(request: ChatRequest):
+    """
+    Variante de /chat que responde con Server-Sent Events (`text/event-stream`): `start`, `node`,
+    `tool_start`, `tool_end`, `token` y finalmente `final` (mismo contenido que ChatResponse) o `error`.
+    """
+    session_id = request.session_id or str(uuid.uuid4())
+    message_id = request.message_id or str(uuid.uuid4())
+    return StreamingResponse(
+        _stream_turn(request, session_id, message_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 @app.get("/get_sample_result/{session_id}/{message_id}")
 async def get_large_result(
     session_id: str = Path(..., description="ID de la sesión donde se guardó el resultado"),
-    message_id: str = Path(..., description="ID del mensaje asociado al resultado")):
+    message_id: str = Path(..., description="ID del mensaje asociado al resultado"),
+    limit: Optional[int] = Query(default=None, ge=1, le=int(config.RESULTS_SAMPLE_MAX_ROWS), description="Filas deseadas. Si supera la muestra guardada, se leen del archivo exportado.")):
     """
     Endpoint para que el frontend descargue una muestra de los resultados completos de una consulta
     que fueron guardados en Cosmos DB.
@@ -170,6 +511,12 @@ async def get_large_result(
             return {"error": "Resultado no encontrado. Verifique los identificadores."}
 
         result_data = result_doc['data']
+        artifact = result_doc.get('artifact')
+
+        # Si se piden más filas de las que guarda Cosmos, se leen del blob según su formato registrado.
+        if limit and artifact and limit > len(result_data['rows']) and artifact.get('rows', 0) > len(result_data['rows']):
+            sample = await storage_service.read_query_results_sample(artifact['blob_name'], artifact['format'], limit)
+            return QueryResultSample(columns=sample.columns, rows=sample.head_records())
         
         return QueryResultSample(columns=result_data["columns"], rows=result_data['rows'])
 
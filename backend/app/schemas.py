@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Literal
 
 # Este archivo centraliza los modelos de datos para validar
 # las peticiones y respuestas de la API, asegurando consistencia.
@@ -10,6 +10,8 @@ class ChatRequest(BaseModel):
     session_id: str | None = Field(default=None, description="ID de sesión para mantener el contexto. Si es nulo, se creará uno nuevo.")
     message_id: str = Field(..., description="ID del mensaje, para tener control de cada pregunta hecha por el usuario")
     corrected_sql_query: Optional[str] = Field(default=None, description="Consulta SQL opcionalmente corregida por el usuario.")
+    result_format: Optional[Literal["auto", "csv", "csv.gz", "parquet"]] = Field(default=None, description="Formato del archivo de resultados descargable. Si es nulo se usa el configurado (por defecto 'auto', que comprime los resultados grandes).")
+    bypass_result_cache: bool = Field(default=False, description="Si es verdadero, la consulta SQL se ejecuta en el warehouse aunque exista un resultado cacheado.")
 
 class ChatResponse(BaseModel):
     """Modelo para la respuesta del endpoint /chat."""
@@ -18,6 +20,7 @@ class ChatResponse(BaseModel):
     session_id: str = Field(..., description="El ID de sesión de la conversación actual.")
     message_id: str = Field(..., description="ID del mensaje, identificador unico del mensaje y usado para guardar respuesta sql en cosmos db")
     sql_results_download_url: Optional[str] = None
+    sql_results_format: Optional[str] = Field(default=None, description="Formato del archivo descargable: csv, csv.gz o parquet.")
 
 class QueryResultSample(BaseModel):
     columns: List[str] = Field(..., description="Lista de nombres de columnas")
@@ -1,7 +1,10 @@
-from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient
 from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import AioHttpTransport
 from azure.search.documents.models import VectorizedQuery, QueryType
+from openai import AsyncAzureOpenAI
 import re
+import time
 import unicodedata
 from app import config
 import json
@@ -9,22 +12,168 @@ import sys, os
 from typing import List, Dict, Optional
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from utils.az_open_ai import AzureOpenAIFunctions
 from utils.az_ai_search import AzureIASearch
+from app.utils.embedding_cache import get_embedding_cache
+from app.utils.example_index import LocalExampleIndex
+from app.utils.observability import observe, DEPENDENCY_LATENCY
+from app.utils.http_client import get_async_http_client
+import asyncio
+import aiohttp
 
 class AzureSearchService:
     """Servicio para buscar consultas similares en Azure AI Search."""
     
     def __init__(self):
-        """Inicializa el cliente de Azure AI Search."""
+        """Inicializa la configuración de Azure AI Search. Los clientes se crean en `initialize_clients`."""
         if not all([config.AZURE_SEARCH_ENDPOINT, config.AZURE_SEARCH_KEY, config.AZURE_SEARCH_INDEX_NAME]):
             raise ValueError("Las variables de entorno de Azure AI Search deben estar configuradas.")
         
         self.endpoint = config.AZURE_SEARCH_ENDPOINT
         self.key = config.AZURE_SEARCH_KEY
+        self.embedding_deployment = config.AZURE_OPENAI_EMBEDDING_NAME
+
+        # Clientes asíncronos de larga vida, compartidos por todas las peticiones del proceso.
+        self._search_clients: Dict[str, SearchClient] = {}
+        # Sesión aiohttp propia de los SearchClient (el SDK de Azure no usa httpx): un pool keep-alive
+        # compartido por todos los índices.
+        self._search_session: Optional[aiohttp.ClientSession] = None
+        self._openai_client: Optional[AsyncAzureOpenAI] = None
+
+        # Réplica local opcional del índice de ejemplos; el índice remoto queda como respaldo.
+        self.local_index_name = config.AZURE_SEARCH_INDEX_NAME
+        self.local_index = LocalExampleIndex() if config.LOCAL_EXAMPLE_INDEX_ENABLED.lower() == "true" else None
+        self.local_index_sync_seconds = float(config.LOCAL_EXAMPLE_INDEX_SYNC_SECONDS)
+        self.remote_searches = 0
         
         print("Servicio de Azure AI Search inicializado.")
 
+    async def initialize_clients(self):
+        """
+        Crea una sola vez los clientes asíncronos (Azure AI Search y Azure OpenAI) con pools
+        HTTP keep-alive (aiohttp para Search, el pool httpx compartido para OpenAI), para que la
+        recuperación no construya objetos ni abra conexiones en cada petición. Se invoca en el
+        `lifespan` de la aplicación.
+        """
+        if self._openai_client is None:
+            # Mismo pool HTTP que el modelo de chat: las conexiones con Azure OpenAI se reutilizan.
+            self._openai_client = AsyncAzureOpenAI(
+                azure_endpoint=config.AZURE_OPENAI_ENDPOINT,
+                api_key=config.AZURE_OPENAI_API_KEY,
+                api_version=config.AZURE_OPENAI_API_VERSION,
+                http_client=get_async_http_client(),
+            )
+        self._get_search_client(config.AZURE_SEARCH_INDEX_NAME)
+        print("Clientes asíncronos de Azure AI Search y Azure OpenAI listos.")
+
+    def _get_search_client(self, index_name: str) -> SearchClient:
+        """Cliente de búsqueda del índice, creado una única vez por índice."""
+        client = self._search_clients.get(index_name)
+        if client is None:
+            if self._search_session is None or self._search_session.closed:
+                self._search_session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(limit=int(config.AZURE_HTTP_MAX_CONNECTIONS), keepalive_timeout=120)
+                )
+            client = SearchClient(
+                endpoint=self.endpoint,
+                index_name=index_name,
+                credential=AzureKeyCredential(self.key),
+                transport=AioHttpTransport(session=self._search_session, session_owner=False),
+            )
+            self._search_clients[index_name] = client
+        return client
+
+    async def close(self):
+        """Cierra los clientes y sus conexiones. Se invoca al apagar la aplicación."""
+        for client in self._search_clients.values():
+            await client.close()
+        self._search_clients.clear()
+        if self._search_session is not None:
+            await self._search_session.close()
+            self._search_session = None
+        # El cliente de Azure OpenAI usa el pool HTTP compartido, que se cierra al apagar la aplicación.
+        self._openai_client = None
+        print("Clientes de Azure AI Search y Azure OpenAI cerrados.")
+
+    async def get_embedding(self, text: str) -> List[float]:
+        """Embedding del texto, servido desde la caché compartida o calculado con el cliente asíncrono."""
+        cache = get_embedding_cache()
+        if cache is not None:
+            # SQLite bloquea: la consulta y la escritura de la caché salen del event loop.
+            cached = await asyncio.to_thread(cache.get, self.embedding_deployment, text)
+            if cached is not None:
+                return cached
+
+        if self._openai_client is None:
+            await self.initialize_clients()
+        with observe(DEPENDENCY_LATENCY, dependency="openai", operation="embedding"):
+            response = await self._openai_client.embeddings.create(input=[text], model=self.embedding_deployment)
+        embedding = response.data[0].embedding
+        if cache is not None:
+            await asyncio.to_thread(cache.put, self.embedding_deployment, text, embedding)
+        return embedding
+
+    # --- Réplica local del índice de ejemplos ---
+
+    async def _remote_document_ids(self, index_name: str) -> set:
+        search_client = self._get_search_client(index_name)
+        results = await search_client.search(search_text="*", select=["id"])
+        return {result["id"] async for result in results}
+
+    async def _fetch_documents(self, index_name: str, document_ids: List[str], chunk_size: int = 100) -> List[Dict]:
+        """Descarga los documentos indicados (con su vector) filtrando por id en lotes."""
+        search_client = self._get_search_client(index_name)
+        documents = []
+        for start in range(0, len(document_ids), chunk_size):
+            chunk = document_ids[start:start + chunk_size]
+            # Los ids son hashes SHA-256 en hexadecimal, seguros dentro de search.in.
+            results = await search_client.search(
+                search_text="*",
+                filter=f"search.in(id, '{','.join(chunk)}', ',')",
+                select=["id", "user_query", "sql_query", "embedded_user_query"],
+                top=len(chunk),
+            )
+            documents.extend([dict(result) async for result in results])
+        return documents
+
+    async def sync_local_index(self) -> bool:
+        """
+        Sincroniza la réplica local con el índice remoto comparando el manifiesto de hash ids:
+        solo se descargan los documentos nuevos y se descartan los eliminados.
+        Devuelve True si hubo cambios.
+        """
+        if self.local_index is None:
+            return False
+        if self._openai_client is None:
+            await self.initialize_clients()
+        remote_ids = await self._remote_document_ids(self.local_index_name)
+        local_ids = self.local_index.document_ids
+        new_ids = sorted(remote_ids - local_ids)
+        deleted_ids = sorted(local_ids - remote_ids)
+        if not new_ids and not deleted_ids and self.local_index.ready:
+            self.local_index.synced_at = time.time()
+            return False
+        new_documents = await self._fetch_documents(self.local_index_name, new_ids)
+        self.local_index.apply_changes(new_documents, deleted_ids)
+        print(f"--- Réplica local de '{self.local_index_name}' sincronizada: "
+              f"+{len(new_documents)} / -{len(deleted_ids)} documentos ({len(remote_ids)} en total) ---")
+        return True
+
+    async def run_local_index_sync_loop(self):
+        """Tarea de fondo: mantiene la réplica local alineada con el índice remoto."""
+        while True:
+            try:
+                await self.sync_local_index()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error sincronizando la réplica local del índice de ejemplos: {e}")
+            await asyncio.sleep(self.local_index_sync_seconds)
+
+    def stats(self) -> dict:
+        return {
+            "local_index": self.local_index.stats() if self.local_index is not None else None,
+            "remote_searches": self.remote_searches,
+        }
 
     async def search_similar_queries(self, user_query: str, top_k: int = 20, index_name: str = "index_sqlagent") -> List[Dict]:
         """
@@ -39,23 +188,29 @@ class AzureSearchService:
         """
         try:
             #Normalizamos la consulta
-            ai_search = AzureIASearch()
-            user_query = ai_search.normalize_text(user_query)
+            user_query = AzureIASearch.normalize_text(user_query)
 
 
             print(f"--- Buscando consultas similares para: '{user_query}' ---")
 
-            # Este cliente se usa para buscar documentos en el indice definido por "index_name"
-            search_client = SearchClient(
-                endpoint=self.endpoint,
-                index_name=index_name,
-                credential=AzureKeyCredential(self.key)
-            )
             # 1. Generar el vector para la consulta del usuario
-            openai_client = AzureOpenAIFunctions()
-            query_vector = openai_client.get_embedding(user_query)
+            query_vector = await self.get_embedding(user_query)
+
+            # 2a. Responder desde la réplica en memoria cuando está disponible
+            if self.local_index is not None and self.local_index.ready and index_name == self.local_index_name:
+                try:
+                    with observe(DEPENDENCY_LATENCY, dependency="search", operation="local_hybrid"):
+                        similar_queries = self.local_index.search(user_query, query_vector, top_k=top_k)[:3]
+                    print(f"--- Encontradas {len(similar_queries)} consultas similares (réplica local) ---")
+                    return similar_queries
+                except Exception as e:
+                    print(f"Error en la réplica local, se usa el índice remoto: {e}")
+
+            # Cliente de larga vida para el indice definido por "index_name"
+            search_client = self._get_search_client(index_name)
+            self.remote_searches += 1
 
-            # 2. Construir la consulta vectorial
+            # 2b. Construir la consulta vectorial para el índice remoto
             vector_query = VectorizedQuery(
                 vector=query_vector, 
                 k_nearest_neighbors=top_k, 
@@ -65,24 +220,25 @@ class AzureSearchService:
             print(f"🔍 Realizando búsqueda híbrida para: '{user_query}'")
 
             # 3. Ejecutar la búsqueda
-            search_results = search_client.search(
-                search_text=user_query,
-                search_fields=["user_query"],  # Campo de texto completo para búsqueda
-                vector_queries=[vector_query], # Campo de vectores completo para búsqueda
-                # query_type=QueryType.SEMANTIC,  # Activa la reclasificación semántica1
-                top=top_k, # Número de resultados a devolver después de la reclasificación
-                select=["user_query", "sql_query"], # Seleccionamos los campos a recuperar
-            )
-            
-            similar_queries = []
-            for result in search_results:
-                # if result['@search.reranker_score'] > 0:
-                similar_queries.append({
-                    "user_query": result.get("user_query"),
-                    "sql_query": result.get("sql_query"),
-                    "score": result.get("@search.score", 0),
-                    # "reranker_score": result.get("@search.reranker_score", 0)
-                })
+            with observe(DEPENDENCY_LATENCY, dependency="search", operation="remote_hybrid"):
+                search_results = await search_client.search(
+                    search_text=user_query,
+                    search_fields=["user_query"],  # Campo de texto completo para búsqueda
+                    vector_queries=[vector_query], # Campo de vectores completo para búsqueda
+                    # query_type=QueryType.SEMANTIC,  # Activa la reclasificación semántica1
+                    top=top_k, # Número de resultados a devolver después de la reclasificación
+                    select=["user_query", "sql_query"], # Seleccionamos los campos a recuperar
+                )
+
+                similar_queries = []
+                async for result in search_results:
+                    # if result['@search.reranker_score'] > 0:
+                    similar_queries.append({
+                        "user_query": result.get("user_query"),
+                        "sql_query": result.get("sql_query"),
+                        "score": result.get("@search.score", 0),
+                        # "reranker_score": result.get("@search.reranker_score", 0)
+                    })
             similar_queries = similar_queries[:3]
             print(f"--- Encontradas {len(similar_queries)} consultas similares ---")
             return similar_queries
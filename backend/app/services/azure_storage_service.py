@@ -1,11 +1,210 @@
 import os
 import io
-import pandas as pd
+import time
+import zlib
+import base64
+import asyncio
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Optional
+from azure.storage.blob import BlobBlock, ContentSettings
 from azure.storage.blob.aio import BlobServiceClient
 from app import config
+from app.utils.query_result import QueryResult, csv_compatible
+from app.utils.observability import observe, timed, DEPENDENCY_LATENCY
 from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError
 from urllib.parse import urlparse
 
+
+@dataclass
+class ExportStats:
+    """Métricas y metadatos de una exportación por streaming a Blob Storage."""
+    rows: int = 0
+    bytes: int = 0
+    blocks: int = 0
+    seconds: float = 0.0
+    result_format: str = "csv"
+    blob_name: str = ""
+
+
+class _CsvBatchEncoder:
+    """Codifica lotes Arrow a CSV de forma incremental; el encabezado sale solo con el primer lote."""
+
+    def __init__(self):
+        self._sink = io.BytesIO()
+        self._writer = None
+
+    def encode(self, batch: pa.Table) -> bytes:
+        batch = csv_compatible(batch)
+        if self._writer is None:
+            self._writer = pacsv.CSVWriter(self._sink, batch.schema, write_options=pacsv.WriteOptions(quoting_style="needed"))
+        self._writer.write_table(batch)
+        return self._drain()
+
+    def close(self) -> bytes:
+        if self._writer is not None:
+            self._writer.close()
+        return self._drain()
+
+    def _drain(self) -> bytes:
+        data = self._sink.getvalue()
+        self._sink.seek(0)
+        self._sink.truncate()
+        return data
+
+
+class _GzipCsvBatchEncoder(_CsvBatchEncoder):
+    """CSV incremental comprimido con gzip en un único stream."""
+
+    def __init__(self):
+        super().__init__()
+        # wbits=31 produce el contenedor gzip (cabecera + CRC), no zlib crudo.
+        self._compressor = zlib.compressobj(level=6, wbits=31)
+
+    def encode(self, batch: pa.Table) -> bytes:
+        return self._compressor.compress(super().encode(batch))
+
+    def close(self) -> bytes:
+        return self._compressor.compress(super().close()) + self._compressor.flush()
+
+
+class _ParquetBatchEncoder(_CsvBatchEncoder):
+    """Parquet incremental: cada lote se escribe como un row group; el footer sale al cerrar."""
+
+    def encode(self, batch: pa.Table) -> bytes:
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self._sink, batch.schema, compression="snappy")
+        self._writer.write_table(batch)
+        return self._drain()
+
+
+# Formatos de exportación soportados: extensión, cabeceras HTTP del blob y codificador.
+RESULT_FORMATS = {
+    "csv": {
+        "extension": "csv",
+        "content_type": "text/csv; charset=utf-8",
+        "content_encoding": None,
+        "encoder": _CsvBatchEncoder,
+    },
+    # Con Content-Encoding: gzip el navegador descarga comprimido y guarda el CSV ya descomprimido.
+    "csv.gz": {
+        "extension": "csv.gz",
+        "content_type": "text/csv; charset=utf-8",
+        "content_encoding": "gzip",
+        "encoder": _GzipCsvBatchEncoder,
+    },
+    "parquet": {
+        "extension": "parquet",
+        "content_type": "application/vnd.apache.parquet",
+        "content_encoding": None,
+        "encoder": _ParquetBatchEncoder,
+    },
+}
+
+
+def resolve_result_format(requested: Optional[str], first_batch: pa.Table, batch_size: int) -> str:
+    """
+    Decide el formato de exportación. Si se pidió uno explícito se respeta; con 'auto'
+    (o vacío) se comprime cuando el resultado es grande: el primer lote llega lleno (hay más
+    lotes detrás) o su tamaño en memoria supera el umbral configurado.
+    """
+    requested = (requested or config.RESULTS_EXPORT_FORMAT or "auto").lower()
+    if requested in RESULT_FORMATS:
+        return requested
+    if requested != "auto":
+        raise ValueError(f"Formato de resultados no soportado: '{requested}'. Usa 'auto', 'csv', 'csv.gz' o 'parquet'.")
+
+    threshold_bytes = float(config.RESULTS_COMPRESSION_THRESHOLD_MB) * 1024 * 1024
+    is_large = first_batch.num_rows >= batch_size or first_batch.nbytes >= threshold_bytes
+    return config.RESULTS_LARGE_FORMAT if is_large else "csv"
+
+
+def _content_settings(result_format: str, download_name: str) -> ContentSettings:
+    spec = RESULT_FORMATS[result_format]
+    # El nombre sugerido para csv.gz es .csv porque el navegador lo guarda ya descomprimido.
+    filename = download_name.removesuffix(".gz") if spec["content_encoding"] == "gzip" else download_name
+    return ContentSettings(
+        content_type=spec["content_type"],
+        content_encoding=spec["content_encoding"],
+        content_disposition=f'attachment; filename="{filename}"',
+    )
+
+
+async def _stage_block(blob_client, block_id: str, data: bytes):
+    with observe(DEPENDENCY_LATENCY, dependency="blob", operation="stage_block"):
+        await blob_client.stage_block(block_id=block_id, data=data, length=len(data))
+
+
+async def stream_to_block_blob(
+    blob_client,
+    batches: AsyncIterator[pa.Table],
+    block_size: int,
+    content_settings: Optional[ContentSettings] = None,
+    on_batch: Optional[Callable[[pa.Table], None]] = None,
+    result_format: str = "csv",
+) -> ExportStats:
+    """
+    Sube un stream de lotes Arrow como un block blob, bloque a bloque (`stage_block` +
+    `commit_block_list`), sin materializar el resultado completo en memoria.
+
+    Como máximo hay un bloque en construcción y otro en vuelo hacia Azure, así que el techo de
+    memoria es ~2 * `block_size` más los lotes pendientes del productor. `blob_client` solo necesita
+    los métodos asíncronos `stage_block` y `commit_block_list`, por lo que puede sustituirse por un
+    cliente falso local en pruebas.
+    """
+    stats = ExportStats(result_format=result_format)
+    start = time.perf_counter()
+    encoder = RESULT_FORMATS[result_format]["encoder"]()
+    buffer = bytearray()
+    block_ids = []
+    in_flight = None
+
+    async def flush(data: bytes):
+        nonlocal in_flight
+        if in_flight is not None:
+            await in_flight
+        # Azure exige que todos los IDs de bloque de un blob tengan la misma longitud.
+        block_id = base64.b64encode(f"{len(block_ids):08d}".encode()).decode()
+        block_ids.append(block_id)
+        stats.blocks += 1
+        in_flight = asyncio.ensure_future(_stage_block(blob_client, block_id, data))
+
+    try:
+        async for batch in batches:
+            if on_batch is not None:
+                on_batch(batch)
+            stats.rows += batch.num_rows
+            buffer += encoder.encode(batch)
+            if len(buffer) >= block_size:
+                stats.bytes += len(buffer)
+                await flush(bytes(buffer))
+                buffer.clear()
+
+        buffer += encoder.close()
+        if buffer or not block_ids:
+            stats.bytes += len(buffer)
+            await flush(bytes(buffer))
+            buffer.clear()
+        await in_flight
+        with observe(DEPENDENCY_LATENCY, dependency="blob", operation="commit_block_list"):
+            await blob_client.commit_block_list([BlobBlock(block_id=block_id) for block_id in block_ids], content_settings=content_settings)
+    except BaseException:
+        if in_flight is not None and not in_flight.done():
+            in_flight.cancel()
+        raise
+
+    stats.seconds = time.perf_counter() - start
+    return stats
+
+
+async def _prepend(first: pa.Table, rest: AsyncIterator[pa.Table]) -> AsyncIterator[pa.Table]:
+    """Reinyecta el primer lote (ya consumido para elegir el formato) delante del resto."""
+    yield first
+    async for batch in rest:
+        yield batch
+
 class AzureStorageService:
     def __init__(self):
 
@@ -54,30 +253,223 @@ class AzureStorageService:
         else:
             print("⚠️ Saltando validación de contenedor porque se usa SAS token sin permisos elevados.")
 
-    async def upload_query_results(self, df: pd.DataFrame, blob_name: str) -> str:
+    def _effective_blob_name(self, blob_name: str) -> str:
+        """Incorpora el prefijo de ruta configurado, si existe."""
+        return f"{self.blob_prefix}/{blob_name}".strip('/') if self.blob_prefix else blob_name
+
+    def _blob_url(self, effective_blob_name: str) -> str:
+        """Construye la URL pública del blob evitando duplicar '?'."""
+        sas = self.sas_token.lstrip('?') if self.sas_token else ''
+        return f"{self.account_url}/{self.container_name}/{effective_blob_name}{('?' + sas) if sas else ''}"
+
+    @timed(DEPENDENCY_LATENCY, dependency="blob", operation="upload_stream")
+    async def upload_query_results_stream(
+        self,
+        batches: AsyncIterator[pa.Table],
+        base_name: str,
+        result_format: Optional[str] = None,
+        batch_size: int = 0,
+        on_batch: Optional[Callable[[pa.Table], None]] = None,
+    ) -> tuple[str, ExportStats]:
         """
-        Convierte un DataFrame de Pandas a CSV, lo sube a Azure Blob Storage
-        y devuelve la URL del blob.
+        Exporta un stream de lotes Arrow subiéndolo por bloques a medida que llegan,
+        de modo que la subida se solapa con la descarga desde Databricks.
+
+        El formato (csv, csv.gz o parquet) se toma de `result_format` o, en modo 'auto',
+        se decide con el primer lote. El blob se nombra `{base_name}.{extensión}`.
+        Devuelve la URL del blob y las métricas de filas/bytes transmitidos y el formato elegido.
         """
         try:
-            # Convertir DataFrame a CSV en un buffer en memoria
-            output = io.StringIO()
-            df.to_csv(output, index=False, encoding='utf-8')
-            csv_data = output.getvalue().encode('utf-8')
-            output.close()
-
-            # Incorporar prefijo si existe
-            effective_blob_name = f"{self.blob_prefix}/{blob_name}".strip('/') if self.blob_prefix else blob_name
+            first_batch = await batches.__anext__()
+            chosen_format = resolve_result_format(result_format, first_batch, batch_size)
+            blob_name = f"{base_name}.{RESULT_FORMATS[chosen_format]['extension']}"
+
+            effective_blob_name = self._effective_blob_name(blob_name)
             blob_client = self.blob_service_client.get_blob_client(container=self.container_name, blob=effective_blob_name)
-            await blob_client.upload_blob(csv_data, overwrite=True)
-            print(f"Archivo CSV '{blob_name}' subido exitosamente a Azure Storage.")
+            stats = await stream_to_block_blob(
+                blob_client,
+                _prepend(first_batch, batches),
+                block_size=int(config.RESULTS_EXPORT_BLOCK_SIZE_MB) * 1024 * 1024,
+                content_settings=_content_settings(chosen_format, blob_name),
+                on_batch=on_batch,
+                result_format=chosen_format,
+            )
+            stats.blob_name = effective_blob_name
+            print(
+                f"Archivo '{blob_name}' subido por streaming: {stats.rows} filas, "
+                f"{stats.bytes} bytes en {stats.blocks} bloques ({stats.seconds:.2f}s)."
+            )
+            return self._blob_url(effective_blob_name), stats
+        except Exception as e:
+            print(f"Error al subir los resultados a Azure Storage: {e}")
+            raise
+        finally:
+            # Si la subida falla, el productor deja de leer del warehouse y libera la sesión del pool
+            # de inmediato, sin esperar al recolector de basura.
+            await batches.aclose()
 
-            # Construir URL pública del blob evitando duplicar '?'
-            sas = self.sas_token.lstrip('?') if self.sas_token else ''
-            blob_url = f"{self.account_url}/{self.container_name}/{effective_blob_name}{('?' + sas) if sas else ''}"
+    @timed(DEPENDENCY_LATENCY, dependency="blob", operation="read_sample")
+    async def read_query_results_sample(self, blob_name: str, result_format: str, limit: int) -> QueryResult:
+        """
+        Lee las primeras `limit` filas de un resultado exportado según su formato registrado.
+        Parquet descarga por rangos solo el footer y los primeros row groups necesarios;
+        CSV y CSV gzip se leen con el lector CSV en streaming y se detienen en cuanto hay filas
+        suficientes (respeta celdas entre comillas con saltos de línea).
+        """
+        blob_client = self.blob_service_client.get_blob_client(container=self.container_name, blob=blob_name)
+        if result_format == "parquet":
+            return await _read_parquet_head(blob_client, limit)
 
-            # Devolver la URL del archivo subido
-            return blob_url
-        except Exception as e:
-            print(f"Error al subir el archivo CSV a Azure Storage: {e}")
-            raise
\ No newline at end of file
+        downloader = await blob_client.download_blob()
+        reader = _BlobChunkReader(downloader.chunks(), asyncio.get_running_loop(), gzip=result_format == "csv.gz")
+        table = await asyncio.to_thread(_read_csv_head, reader, limit)
+        return QueryResult(table)
+
+
+# Bytes finales que se piden de entrada para leer el footer de un Parquet (suele bastar con uno).
+_PARQUET_TAIL_BYTES = 64 * 1024
+
+
+class _RangeReader(io.RawIOBase):
+    """Archivo de solo lectura que sirve a pyarrow los rangos de un blob ya descargados."""
+
+    def __init__(self, size: int):
+        self._size = size
+        self._position = 0
+        self._segments: dict[int, bytes] = {}
+
+    def add(self, offset: int, data: bytes):
+        self._segments[offset] = data
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: self._size}[whence]
+        self._position = base + offset
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        length = min(len(buffer), self._size - self._position)
+        if length <= 0:
+            return 0
+        for offset, data in self._segments.items():
+            if offset <= self._position and self._position + length <= offset + len(data):
+                start = self._position - offset
+                buffer[:length] = data[start:start + length]
+                self._position += length
+                return length
+        raise IOError(f"Rango no descargado: {self._position}-{self._position + length}.")
+
+
+def _row_group_range(metadata: pq.FileMetaData, index: int) -> tuple[int, int]:
+    """Desplazamiento y longitud en bytes de un row group (todas sus columnas)."""
+    row_group = metadata.row_group(index)
+    start, end = None, 0
+    for i in range(row_group.num_columns):
+        column = row_group.column(i)
+        offset = column.dictionary_page_offset if column.has_dictionary_page else column.data_page_offset
+        start = offset if start is None else min(start, offset)
+        end = max(end, offset + column.total_compressed_size)
+    return start, end - start
+
+
+async def _download_range(blob_client, offset: int, length: int) -> bytes:
+    downloader = await blob_client.download_blob(offset=offset, length=length)
+    return await downloader.readall()
+
+
+async def _read_parquet_head(blob_client, limit: int) -> QueryResult:
+    """Primeras `limit` filas de un Parquet con descargas por rango: footer y luego row groups."""
+    size = (await blob_client.get_blob_properties()).size
+    reader = _RangeReader(size)
+    tail_offset = max(0, size - _PARQUET_TAIL_BYTES)
+    tail = await _download_range(blob_client, tail_offset, size - tail_offset)
+    # Los últimos 8 bytes son la longitud del footer (little endian) y la marca "PAR1".
+    footer_length = int.from_bytes(tail[-8:-4], "little") + 8
+    if footer_length > len(tail):
+        tail_offset = size - footer_length
+        tail = await _download_range(blob_client, tail_offset, footer_length)
+    reader.add(tail_offset, tail)
+
+    parquet_file = pq.ParquetFile(reader)
+    metadata = parquet_file.metadata
+    tables, rows = [], 0
+    for index in range(metadata.num_row_groups):
+        if rows >= limit:
+            break
+        offset, length = _row_group_range(metadata, index)
+        reader.add(offset, await _download_range(blob_client, offset, length))
+        table = parquet_file.read_row_group(index)
+        tables.append(table.slice(0, limit - rows))
+        rows += tables[-1].num_rows
+
+    table = pa.concat_tables(tables) if tables else parquet_file.schema_arrow.empty_table()
+    return QueryResult(table, total_rows=metadata.num_rows)
+
+
+class _BlobChunkReader(io.RawIOBase):
+    """
+    Expone los trozos asíncronos de una descarga como un archivo síncrono para el lector CSV de
+    pyarrow, que corre en un hilo. Descomprime gzip al vuelo si el blob llega comprimido.
+    """
+
+    def __init__(self, chunks: AsyncIterator[bytes], loop: asyncio.AbstractEventLoop, gzip: bool = False):
+        self._chunks = chunks
+        self._loop = loop
+        self._gzip = gzip
+        self._decompressor = None
+        self._started = False
+        self._pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def _next_chunk(self) -> Optional[bytes]:
+        try:
+            return asyncio.run_coroutine_threadsafe(self._chunks.__anext__(), self._loop).result()
+        except StopAsyncIteration:
+            return None
+
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            chunk = self._next_chunk()
+            if chunk is None:
+                if self._decompressor is not None:
+                    self._pending, self._decompressor = self._decompressor.flush(), None
+                    continue
+                return 0
+            # Según la versión del SDK, un blob con Content-Encoding gzip puede llegar ya descomprimido.
+            if not self._started and self._gzip and chunk[:2] == b"\x1f\x8b":
+                self._decompressor = zlib.decompressobj(wbits=31)
+            self._started = True
+            self._pending = self._decompressor.decompress(chunk) if self._decompressor else chunk
+        length = min(len(buffer), len(self._pending))
+        buffer[:length] = self._pending[:length]
+        self._pending = self._pending[length:]
+        return length
+
+
+def _read_csv_head(source: io.RawIOBase, limit: int) -> pa.Table:
+    """Lee bloques del CSV en streaming hasta reunir `limit` filas."""
+    try:
+        reader = pacsv.open_csv(io.BufferedReader(source))
+    except pa.ArrowInvalid:
+        # CSV vacío (sin encabezado).
+        return pa.table({})
+    batches, rows = [], 0
+    while rows < limit:
+        try:
+            batch = reader.read_next_batch()
+        except StopIteration:
+            break
+        batches.append(batch)
+        rows += batch.num_rows
+    table = pa.Table.from_batches(batches, schema=reader.schema)
+    return table.slice(0, limit)
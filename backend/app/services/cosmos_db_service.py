@@ -1,10 +1,14 @@
 from azure.cosmos.aio import CosmosClient
 from azure.cosmos import exceptions, PartitionKey
+from azure.core import MatchConditions
+from azure.core.exceptions import AzureError
 from langchain_core.messages import message_to_dict, messages_from_dict
 from langchain_core.messages import HumanMessage, AIMessage, ToolMessage
-from decimal import Decimal
-from datetime import date
 from app import config
+from app.utils.query_result import QueryResult
+from app.utils.observability import observe, DEPENDENCY_LATENCY
+from collections import OrderedDict
+import asyncio
 import datetime
 import uuid
 import json
@@ -22,6 +26,20 @@ class CosmosDBService:
         self.database = None
         self.conversations_container = None
         self.results_container = None
+        # Cola de persistencia diferida; si es None las escrituras se hacen en línea.
+        self.write_behind = None
+
+        # Modo de almacenamiento: "session" (agregado por sesión con lecturas puntuales) o
+        # "message" (un documento por mensaje, consultado con ORDER BY).
+        self.storage_mode = config.COSMOS_STORAGE_MODE.lower()
+        self.session_window = int(config.COSMOS_SESSION_WINDOW_MESSAGES)
+        self.session_cache_size = int(config.COSMOS_SESSION_CACHE_SIZE)
+        # Caché write-through de los agregados de sesión más recientes: session_id -> documento meta.
+        # Solo acelera las lecturas; las escrituras del agregado se validan con su etag.
+        self._session_cache: "OrderedDict[str, dict]" = OrderedDict()
+        self._session_locks: dict = {}
+        self.session_cache_hits = 0
+        self.session_cache_misses = 0
         print("Servicio de Cosmos DB inicializado.")
 
     async def initialize_resources(self):
@@ -73,6 +91,22 @@ class CosmosDBService:
                 print(f"Error al inicializar el contenedor de resultados: {e}")
         return self.results_container
 
+    async def write_item(self, container_name: str, body: dict):
+        """Escribe (upsert, idempotente ante reintentos) un documento en el contenedor indicado."""
+        if container_name == "conversations":
+            container = await self._get_conversations_container()
+        else:
+            container = await self._get_results_container()
+        with observe(DEPENDENCY_LATENCY, dependency="cosmos", operation="upsert"):
+            await container.upsert_item(body)
+
+    async def _write(self, container_name: str, body: dict):
+        """Encola la escritura en la persistencia diferida o, si no está activa, la aplica en línea."""
+        if self.write_behind is not None:
+            await self.write_behind.enqueue(container_name, body)
+        else:
+            await self.write_item(container_name, body)
+
     #--- NUEVO MÉTODO AUXILIAR: De Objeto a Diccionario Optimizado
     def _message_to_slim_dict(self, message) -> dict:
         """Convierte un objeto de mensaje de LangChain a un diccionario optimizado para el almacenamiento."""
@@ -99,23 +133,189 @@ class CosmosDBService:
         else:
             raise ValueError(f"Tipo de mensaje desconocido: {msg_type}")
 
-    async def get_conversation_history(self, session_id: str, limit: int = 10) -> list:
+    # --- Modelo de sesión: documentos con id determinista y lecturas puntuales ---
+
+    @staticmethod
+    def _session_meta_id(session_id: str) -> str:
+        return f"{session_id}:meta"
+
+    @staticmethod
+    def _turn_id(session_id: str, turn: int) -> str:
+        return f"{session_id}:{turn:06d}"
+
+    def _result_id(self, session_id: str, message_id: str) -> str:
+        return f"{session_id}:{message_id}" if self.storage_mode == "session" else str(uuid.uuid4())
+
+    def _cache_session(self, session_id: str, meta: dict):
+        self._session_cache[session_id] = meta
+        self._session_cache.move_to_end(session_id)
+        while len(self._session_cache) > self.session_cache_size:
+            evicted, _ = self._session_cache.popitem(last=False)
+            lock = self._session_locks.get(evicted)
+            if lock is not None and not lock.locked():
+                del self._session_locks[evicted]
+
+    async def _read_item(self, container, item_id: str, session_id: str) -> dict | None:
+        """Lectura puntual (id + partición); None si no existe."""
+        pending = self.write_behind.pending_item(item_id) if self.write_behind is not None else None
+        if pending is not None:
+            return pending
+        # Un documento inexistente es un resultado válido, no un error: se registra como "ok".
+        with observe(DEPENDENCY_LATENCY, dependency="cosmos", operation="point_read"):
+            try:
+                return await container.read_item(item=item_id, partition_key=session_id)
+            except exceptions.CosmosResourceNotFoundError:
+                return None
+
+    async def _load_session_meta(self, session_id: str) -> dict | None:
+        """Agregado de la sesión (últimos mensajes y número de turnos), desde la caché o con una lectura puntual."""
+        # El turno anterior se guarda en segundo plano: si aún está reservando su número, se espera
+        # a que termine para que el historial lo incluya.
+        lock = self._session_locks.get(session_id)
+        if lock is not None and lock.locked():
+            async with lock:
+                pass
+        meta = self._session_cache.get(session_id)
+        if meta is not None:
+            self._session_cache.move_to_end(session_id)
+            self.session_cache_hits += 1
+            return meta
+        self.session_cache_misses += 1
+        container = await self._get_conversations_container()
+        meta = await self._read_item(container, self._session_meta_id(session_id), session_id)
+        if meta is not None:
+            self._cache_session(session_id, meta)
+        return meta
+
+    async def _read_session_meta_from_cosmos(self, session_id: str) -> dict | None:
+        """Lectura puntual del agregado directamente en Cosmos DB (sin caché), con su `_etag`."""
+        container = await self._get_conversations_container()
+        with observe(DEPENDENCY_LATENCY, dependency="cosmos", operation="point_read"):
+            try:
+                return await container.read_item(item=self._session_meta_id(session_id), partition_key=session_id)
+            except exceptions.CosmosResourceNotFoundError:
+                return None
+
+    def _next_session_meta(self, meta: dict, slim_messages: list, now: str) -> dict:
+        """Agregado con el turno siguiente (sin los campos de sistema `_etag`, `_rid`, ...)."""
+        return {
+            **{key: value for key, value in meta.items() if not key.startswith("_")},
+            "turns": meta["turns"] + 1,
+            "recent_messages": (meta["recent_messages"] + slim_messages)[-self.session_window:],
+            "updated_at": now,
+        }
+
+    async def _claim_session_turn(self, session_id: str, meta: dict | None, slim_messages: list, now: str,
+                                  max_attempts: int = 5) -> dict:
         """
-        Recupera los últimos 'limit' mensajes de una conversación, reconstruyendo
-        los objetos de mensaje desde el formato optimizado.
+        Escribe el agregado con el turno siguiente usando concurrencia optimista: `create_item` si
+        la sesión es nueva y `replace_item` condicionado al `_etag` leído si ya existe. Si otra réplica
+        o worker escribió antes, el conflicto (409/412) obliga a releer de Cosmos DB y reintentar en
+        lugar de sobrescribir su turno.
         """
         container = await self._get_conversations_container()
+        if meta is None or "_etag" not in meta:
+            meta = await self._read_session_meta_from_cosmos(session_id)
+        for attempt in range(max_attempts):
+            if meta is None:
+                # Sesiones creadas en el modo por mensaje: se migran sus últimos mensajes al agregado.
+                legacy_items = await self._query_message_items(session_id, self.session_window)
+                meta = {
+                    "id": self._session_meta_id(session_id),
+                    "sessionId": session_id,
+                    "type": "session_meta",
+                    "turns": 0,
+                    "recent_messages": [item["message_data"] for item in legacy_items],
+                    "created_at": now,
+                }
+            new_meta = self._next_session_meta(meta, slim_messages, now)
+            try:
+                with observe(DEPENDENCY_LATENCY, dependency="cosmos", operation="upsert"):
+                    if "_etag" not in meta:
+                        return await container.create_item(new_meta)
+                    return await container.replace_item(
+                        item=new_meta["id"], body=new_meta,
+                        etag=meta["_etag"], match_condition=MatchConditions.IfNotModified,
+                    )
+            except (exceptions.CosmosAccessConditionFailedError, exceptions.CosmosResourceExistsError):
+                print(f"--- Conflicto al actualizar la sesión {session_id} (intento {attempt + 1}); se relee ---")
+                meta = await self._read_session_meta_from_cosmos(session_id)
+        raise RuntimeError(f"No se pudo reservar un turno para la sesión {session_id} tras {max_attempts} intentos.")
+
+    async def _add_session_turn(self, session_id: str, messages: list):
+        """
+        Guarda el turno como un documento `{session}:{turn}` y actualiza el agregado `{session}:meta`,
+        que conserva los últimos mensajes para que cargar el historial sea una sola lectura puntual.
+
+        El número de turno se reserva primero en el agregado, validado con su etag: el agregado
+        cacheado es solo el primer intento, de modo que varias réplicas o workers nunca reutilizan el
+        mismo `{session}:{turn}` ni pierden mensajes de `recent_messages`.
+        """
+        lock = self._session_locks.setdefault(session_id, asyncio.Lock())
+        async with lock:
+            now = datetime.datetime.utcnow().isoformat() + "Z"
+            slim_messages = [self._message_to_slim_dict(message) for message in messages]
+            cached = self._session_cache.pop(session_id, None)
+            try:
+                meta = await self._claim_session_turn(session_id, cached, slim_messages, now)
+            except AzureError as e:
+                if self.write_behind is None or cached is None:
+                    raise
+                # Cosmos DB no disponible: el agregado pasa por la persistencia diferida sin control de
+                # concurrencia, para no perder el turno. El siguiente turno vuelve a leerlo de Cosmos DB.
+                print(f"--- Cosmos DB no disponible para la sesión {session_id} ({e}); el agregado se encola ---")
+                meta = self._next_session_meta(cached, slim_messages, now)
+                await self._write("conversations", meta)
+
+            self._cache_session(session_id, meta)
+            await self._write("conversations", {
+                "id": self._turn_id(session_id, meta["turns"]),
+                "sessionId": session_id,
+                "type": "turn",
+                "turn": meta["turns"],
+                "messages": slim_messages,
+                "timestamp": now,
+            })
+
+    # --- Historial ---
+
+    async def _query_message_items(self, session_id: str, limit: int) -> list:
+        """Documentos del modo por mensaje, en orden cronológico."""
+        container = await self._get_conversations_container()
         # Hacemos la consulta más eficiente ordenando y limitando en la propia base de datos.
-        query = f"SELECT * FROM c WHERE c.sessionId = @session_id ORDER BY c.timestamp DESC OFFSET 0 LIMIT {limit}"
+        query = f"SELECT * FROM c WHERE c.sessionId = @session_id AND IS_DEFINED(c.message_data) ORDER BY c.timestamp DESC OFFSET 0 LIMIT {limit}"
         parameters = [{"name": "@session_id", "value": session_id}]
-        
+
+        items_iterable = container.query_items(query=query, parameters=parameters, partition_key=session_id)
+        # El resultado de la BD viene en orden descendente, lo revertimos para la lógica del agente.
+        with observe(DEPENDENCY_LATENCY, dependency="cosmos", operation="query_messages"):
+            items = [item async for item in items_iterable]
+        # Mensajes del turno anterior que la persistencia diferida aún no ha escrito.
+        if self.write_behind is not None:
+            persisted_ids = {item["id"] for item in items}
+            pending = [
+                i for i in self.write_behind.pending_items("conversations", session_id)
+                if i["id"] not in persisted_ids and "message_data" in i
+            ]
+            if pending:
+                items = sorted(items + pending, key=lambda item: item["timestamp"], reverse=True)[:limit]
+        return items[::-1]
+
+    async def get_conversation_history(self, session_id: str, limit: int = 10) -> list:
+        """
+        Recupera los últimos 'limit' mensajes de una conversación, reconstruyendo
+        los objetos de mensaje desde el formato optimizado.
+        """
         try:
-            items_iterable = container.query_items(query=query, parameters=parameters, partition_key=session_id)
-            # El resultado de la BD viene en orden descendente, lo revertimos para la lógica del agente.
-            items = [item async for item in items_iterable][::-1] 
-            
+            meta = await self._load_session_meta(session_id) if self.storage_mode == "session" else None
+            if meta is not None:
+                slim_messages = meta["recent_messages"][-limit:] if limit else []
+            else:
+                slim_messages = [item["message_data"] for item in await self._query_message_items(session_id, limit)]
+
             # Reconstruimos los objetos de mensaje de LangChain desde los diccionarios guardados.
-            history = [self._slim_dict_to_message(msg['message_data']) for msg in items]
+            # Se copian porque los agregados cacheados no deben modificarse.
+            history = [self._slim_dict_to_message(dict(msg)) for msg in slim_messages]
             
             print(f"Historial recuperado para la sesión {session_id}: {len(history)} mensajes.")
             return history
@@ -128,8 +328,16 @@ class CosmosDBService:
         Añade una lista de mensajes de LangChain (Human, AI, Tool) al historial,
         guardando la estructura completa de cada mensaje.
         """
-        container = await self._get_conversations_container()
-        
+        if self.storage_mode == "session":
+            try:
+                await self._add_session_turn(session_id, messages)
+            except (AzureError, RuntimeError) as e:
+                # Cosmos DB no disponible sin agregado en caché, o turno sin reservar tras los reintentos:
+                # la respuesta ya se dio, así que el fallo solo se registra.
+                print(f"Error al añadir el turno a la sesión {session_id}: {e}")
+            print(f"Se añadieron {len(messages)} mensajes a la sesión {session_id}.")
+            return
+
         for message in messages:
             # Serializamos el objeto de mensaje completo a un diccionario.
             # message_dict = message_to_dict(message)
@@ -143,54 +351,83 @@ class CosmosDBService:
                 "timestamp": datetime.datetime.utcnow().isoformat() + "Z",
             }
             try:
-                await container.create_item(body=new_item)
-            except exceptions.CosmosHttpResponseError as e:
+                await self._write("conversations", new_item)
+            except AzureError as e:
                 print(f"Error al añadir mensaje a la sesión {session_id}: {e}")
         
         print(f"Se añadieron {len(messages)} mensajes a la sesión {session_id}.")
 
-    async def save_query_result(self, session_id: str, message_id: str, result_data: dict):
+    async def save_query_result(self, session_id: str, message_id: str, result: QueryResult, artifact: dict | None = None):
         """
         Guarda el resultado completo de una consulta en el Storage.
         Guarda una muestra del resultado completo de una consulta en CosmosDB.
+        'artifact' registra el blob exportado (nombre, formato, filas y bytes) para poder releerlo.
         """
-        container = await self._get_results_container()
         RESULTS_LIMIT_FOR_THE_FRONTEND = int(config.RESULTS_LIMIT_FOR_THE_FRONTEND)
 
-        sample_rows = result_data["rows"][:RESULTS_LIMIT_FOR_THE_FRONTEND]
-        # --- Lógica de Conversión de Tipos de Datos ---
-        processed_rows = []
-        for row in sample_rows:
-            processed_row = {}
-            for k, v in dict(zip(result_data["columns"], row)).items():
-                if isinstance(v, date):
-                    processed_row[k] = v.isoformat()
-                elif isinstance(v, Decimal):
-                    # Convertimos el objeto Decimal a un float, que es serializable.
-                    processed_row[k] = float(v)
-                else:
-                    processed_row[k] = v
-            processed_rows.append(processed_row)
-
-        # Estructura final
+        # La conversión de tipos (fechas, Decimals) ya viene resuelta por el QueryResult.
         data_sample = {
-            "columns": result_data["columns"],
-            "rows": processed_rows
+            "columns": result.columns,
+            "rows": result.head_records(RESULTS_LIMIT_FOR_THE_FRONTEND)
         }
 
         item = {
-            "id": str(uuid.uuid4()),
+            "id": self._result_id(session_id, message_id),
             "sessionId": session_id,
             "messageId": message_id,
             "data": data_sample,
+            "artifact": artifact,
             "type": "query_result"
         }
 
-        await container.upsert_item(item)
+        await self._write("results", item)
         print(f"Resultado para message_id '{message_id}' guardado en Cosmos DB.")
 
+    async def save_query_result_alias(self, session_id: str, message_id: str, source_session_id: str, source_message_id: str,
+                                      source_blob_name: str | None = None):
+        """
+        Registra que el resultado de 'message_id' es el mismo ya guardado para 'source_message_id'
+        (caché de resultados), sin volver a escribir la muestra. 'source_blob_name' identifica la
+        exportación enlazada: si el resultado de origen se reescribe con otra consulta, el enlace
+        deja de resolverse en lugar de devolver datos de otro SQL.
+        """
+        item = {
+            "id": self._result_id(session_id, message_id),
+            "sessionId": session_id,
+            "messageId": message_id,
+            "aliasOf": {"sessionId": source_session_id, "messageId": source_message_id, "blobName": source_blob_name},
+            "type": "query_result_alias"
+        }
+        await self._write("results", item)
+        print(f"Resultado para message_id '{message_id}' enlazado al de '{source_message_id}'.")
+
     async def get_query_result(self, session_id: str, message_id: str) -> dict | None:
-        """Recupera un resultado de consulta guardado desde Cosmos DB."""
+        """Recupera un resultado de consulta guardado desde Cosmos DB, siguiendo los enlaces de la caché de resultados."""
+        item = None
+        if self.storage_mode == "session":
+            # Lectura puntual por id determinista (incluye lo pendiente en la persistencia diferida).
+            container = await self._get_results_container()
+            item = await self._read_item(container, f"{session_id}:{message_id}", session_id)
+
+        if item is None:
+            item = await self._query_result_item(session_id, message_id)
+        if item is not None and item.get("aliasOf"):
+            alias_of = item["aliasOf"]
+            source = await self.get_query_result(alias_of["sessionId"], alias_of["messageId"])
+            if source is not None and alias_of.get("blobName") and (source.get("artifact") or {}).get("blob_name") != alias_of["blobName"]:
+                print(f"El resultado enlazado de '{message_id}' fue reemplazado por otra consulta del mensaje '{alias_of['messageId']}'.")
+                return None
+            return source
+        return item
+
+    async def _query_result_item(self, session_id: str, message_id: str) -> dict | None:
+        """Búsqueda por messageId para resultados guardados con id aleatorio (modo por mensaje)."""
+        # Un resultado recién guardado puede seguir en la cola de persistencia diferida.
+        if self.write_behind is not None:
+            for item in self.write_behind.pending_items("results", session_id):
+                if item.get("messageId") == message_id:
+                    return item
+
         container = await self._get_results_container()
         try:
 
@@ -201,9 +438,9 @@ class CosmosDBService:
                 partition_key=session_id
             )
 
-            async for item in items:
-                
-                return item
+            with observe(DEPENDENCY_LATENCY, dependency="cosmos", operation="query_result"):
+                async for item in items:
+                    return item
                 
         except exceptions.CosmosResourceNotFoundError:
             print(f"No se encontró el resultado para message_id '{message_id}' en la sesión '{session_id}'.")
@@ -211,3 +448,11 @@ class CosmosDBService:
         except Exception as e:
             print(f"Error inesperado al recuperar el resultado: {e}")
             return None
+
+    def stats(self) -> dict:
+        return {
+            "storage_mode": self.storage_mode,
+            "cached_sessions": len(self._session_cache),
+            "session_cache_hits": self.session_cache_hits,
+            "session_cache_misses": self.session_cache_misses,
+        }
@@ -1,43 +1,367 @@
 from databricks import sql
 from databricks.sql.exc import ServerOperationError
 from sqlalchemy.util import column_set
+from contextlib import contextmanager
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import AsyncIterator, Iterator
 from app import config
+from app.utils.query_result import QueryResult
+from app.utils.observability import observe, DEPENDENCY_LATENCY
+import pyarrow as pa
+import asyncio
+import threading
+import time
 import json
 
+# Marca de fin del stream de lotes entre el hilo productor y el consumidor asíncrono.
+_END_OF_STREAM = object()
+
+
+class _PooledConnection:
+    """Envoltura de una conexión abierta con los metadatos que necesita el pool."""
+
+    def __init__(self, connection, open_latency: float):
+        self.connection = connection
+        self.open_latency = open_latency
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+        self.broken = False
+
+
+class DatabricksConnectionPool:
+    """
+    Pool acotado de conexiones (sesiones) al SQL Warehouse de Databricks.
+
+    Es seguro entre hilos porque las consultas se ejecutan desde `asyncio.to_thread`.
+    Reutiliza las sesiones abiertas, descarta las que llevan demasiado tiempo inactivas,
+    valida con `SELECT 1` las que no se han usado recientemente y recicla las que
+    fallaron por un error de conexión.
+    """
+
+    def __init__(self, connect_factory, max_size: int, acquire_timeout: float,
+                 idle_timeout: float, health_check_interval: float):
+        self._connect_factory = connect_factory
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+
+        self._idle = []  # Pila LIFO: la conexión más reciente es la más probable de seguir viva.
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+        # Contadores para dimensionar el pool frente a la concurrencia del warehouse.
+        self._opened = 0
+        self._recycled = 0
+        self._evicted_idle = 0
+        self._acquired = 0
+        self._open_latency_total = 0.0
+        self._open_latency_max = 0.0
+        self._wait_time_total = 0.0
+
+    def _open(self) -> _PooledConnection:
+        start = time.perf_counter()
+        connection = self._connect_factory()
+        latency = time.perf_counter() - start
+        with self._condition:
+            self._opened += 1
+            self._open_latency_total += latency
+            self._open_latency_max = max(self._open_latency_max, latency)
+        return _PooledConnection(connection, latency)
+
+    @staticmethod
+    def _close_quietly(pooled: _PooledConnection):
+        try:
+            pooled.connection.close()
+        except Exception as e:
+            print(f"Error al cerrar una conexión de Databricks: {e}")
+
+    def _is_healthy(self, pooled: _PooledConnection) -> bool:
+        """Valida con una consulta trivial las conexiones que llevan un rato sin usarse."""
+        if time.monotonic() - pooled.last_used_at < self.health_check_interval:
+            return True
+        try:
+            with pooled.connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchall()
+            return True
+        except Exception as e:
+            print(f"--- Conexión de Databricks no saludable, se recicla: {e} ---")
+            return False
+
+    def _discard(self, pooled: _PooledConnection):
+        self._close_quietly(pooled)
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def _evict_idle_locked(self):
+        """Cierra las conexiones inactivas más allá del tiempo permitido. Requiere el lock."""
+        now = time.monotonic()
+        expired = [p for p in self._idle if now - p.last_used_at > self.idle_timeout]
+        if not expired:
+            return []
+        self._idle = [p for p in self._idle if p not in expired]
+        self._size -= len(expired)
+        self._evicted_idle += len(expired)
+        return expired
+
+    def acquire(self) -> _PooledConnection:
+        """Obtiene una conexión del pool, abriendo una nueva si hay capacidad disponible."""
+        wait_start = time.perf_counter()
+        deadline = time.monotonic() + self.acquire_timeout
+        while True:
+            with self._condition:
+                if self._closed:
+                    raise ValueError("El pool de conexiones de Databricks está cerrado.")
+                expired = self._evict_idle_locked()
+                pooled = None
+                must_open = False
+                while pooled is None and not must_open:
+                    if self._idle:
+                        pooled = self._idle.pop()
+                    elif self._size < self.max_size:
+                        self._size += 1
+                        must_open = True
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise ValueError(
+                                f"Tiempo de espera agotado ({self.acquire_timeout}s) esperando una conexión libre de Databricks."
+                            )
+                        self._waiting += 1
+                        try:
+                            self._condition.wait(remaining)
+                        finally:
+                            self._waiting -= 1
+                self._in_use += 1
+                self._acquired += 1
+                self._wait_time_total += time.perf_counter() - wait_start
+
+            for old in expired:
+                self._close_quietly(old)
+
+            if must_open:
+                try:
+                    return self._open()
+                except Exception:
+                    with self._condition:
+                        self._in_use -= 1
+                        self._size -= 1
+                        self._condition.notify()
+                    raise
+
+            if self._is_healthy(pooled):
+                return pooled
+
+            # La sesión estaba rota: la cerramos y volvemos a intentar.
+            with self._condition:
+                self._in_use -= 1
+                self._recycled += 1
+            self._discard(pooled)
+
+    def release(self, pooled: _PooledConnection):
+        """Devuelve una conexión al pool, o la cierra si quedó marcada como rota."""
+        with self._condition:
+            self._in_use -= 1
+            if pooled.broken or self._closed:
+                if pooled.broken:
+                    self._recycled += 1
+                self._size -= 1
+                self._condition.notify()
+                discard = True
+            else:
+                pooled.last_used_at = time.monotonic()
+                self._idle.append(pooled)
+                self._condition.notify()
+                discard = False
+        if discard:
+            self._close_quietly(pooled)
+
+    @contextmanager
+    def connection(self):
+        """Context manager que presta una conexión y la devuelve al terminar."""
+        pooled = self.acquire()
+        try:
+            yield pooled.connection
+        except ServerOperationError:
+            # Error de SQL del usuario: la sesión sigue siendo válida.
+            raise
+        except Exception:
+            # Cualquier otro error (red, sesión expirada, etc.) invalida la conexión.
+            pooled.broken = True
+            raise
+        finally:
+            self.release(pooled)
+
+    def close(self):
+        """Cierra todas las conexiones inactivas e impide nuevos préstamos."""
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._condition.notify_all()
+        for pooled in idle:
+            self._close_quietly(pooled)
+
+    def stats(self) -> dict:
+        """Devuelve las métricas del pool para dimensionarlo frente al warehouse."""
+        with self._condition:
+            return {
+                "max_size": self.max_size,
+                "size": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "opened": self._opened,
+                "recycled": self._recycled,
+                "evicted_idle": self._evicted_idle,
+                "acquired": self._acquired,
+                "avg_open_latency_ms": round(1000 * self._open_latency_total / self._opened, 2) if self._opened else 0.0,
+                "max_open_latency_ms": round(1000 * self._open_latency_max, 2),
+                "avg_wait_ms": round(1000 * self._wait_time_total / self._acquired, 2) if self._acquired else 0.0,
+            }
+
+
 class DatabricksService:
     """Servicio para ejecutar consultas en un SQL Warehouse de Databricks."""
 
     def __init__(self):
-        """Inicializa los parámetros de conexión."""
+        """Inicializa los parámetros de conexión y el pool de sesiones."""
         self.hostname = config.DATABRICKS_SERVER_HOSTNAME
         self.http_path = config.DATABRICKS_HTTP_PATH
         self.token = config.DATABRICKS_TOKEN
+        self.pool = DatabricksConnectionPool(
+            connect_factory=self._connect,
+            max_size=int(config.DATABRICKS_POOL_SIZE),
+            acquire_timeout=float(config.DATABRICKS_POOL_ACQUIRE_TIMEOUT),
+            idle_timeout=float(config.DATABRICKS_POOL_IDLE_TIMEOUT),
+            health_check_interval=float(config.DATABRICKS_POOL_HEALTH_CHECK_INTERVAL),
+        )
         print("Servicio de Databricks inicializado.")
 
-    def execute_query(self, query: str):
+    def _connect(self):
+        """Abre una nueva sesión contra el SQL Warehouse."""
+        return sql.connect(
+            server_hostname=self.hostname,
+            http_path=self.http_path,
+            access_token=self.token,
+        )
+
+    @staticmethod
+    def _to_service_error(e: Exception) -> ValueError:
+        """Traduce los errores del conector a ValueError con un mensaje apto para el agente."""
+        if isinstance(e, ServerOperationError):
+            error_message = f"Error de SQL: {e}. Revisa la sintaxis."
+        else:
+            error_message = f"Error inesperado: {e}"
+        print(error_message)
+        return ValueError(error_message)
+
+    def execute_query(self, query: str) -> QueryResult:
         """
-        Ejecuta una única consulta SQL en Databricks y devuelve las filas y columnas.
+        Ejecuta una única consulta SQL en Databricks y devuelve el resultado en formato Arrow.
         Este método es síncrono y debe ser llamado desde un hilo asíncrono si es necesario.
+        La sesión se toma prestada del pool y se devuelve al terminar.
         """
         print(f"--- Ejecutando consulta en Databricks: {query}... ---")
         try:
-            with sql.connect(
-                server_hostname=self.hostname,
-                http_path=self.http_path,
-                access_token=self.token,
-            ) as connection:
-                with connection.cursor() as cursor:
+            with self.pool.connection() as connection:
+                with connection.cursor() as cursor, observe(DEPENDENCY_LATENCY, dependency="databricks", operation="execute_query"):
                     cursor.execute(query)
-                    columns = [desc[0] for desc in cursor.description]
-                    rows = cursor.fetchall()
-                    # Devuelve una estructura de datos, no un string JSON
-                    return {"columns": columns, "rows": rows}
-        except ServerOperationError as e:
-            error_message = f"Error de SQL: {e}. Revisa la sintaxis."
-            print(error_message)
+                    # Devuelve una tabla columnar, sin materializar objetos Row por fila
+                    return QueryResult(cursor.fetchall_arrow())
+        except Exception as e:
             # Lanza una excepción para que la herramienta la maneje
-            raise ValueError(error_message)
+            raise self._to_service_error(e)
+
+    def iter_arrow_batches(self, query: str, batch_size: int) -> Iterator[pa.Table]:
+        """
+        Ejecuta una consulta y devuelve el resultado por lotes Arrow de hasta `batch_size` filas.
+        El primer lote se entrega siempre (aunque esté vacío) para conocer el esquema.
+        Síncrono: la sesión del pool permanece prestada mientras se consume el iterador.
+        """
+        print(f"--- Ejecutando consulta por lotes en Databricks: {query}... ---")
+        try:
+            with self.pool.connection() as connection:
+                with connection.cursor() as cursor:
+                    # Tiempo hasta que el warehouse tiene el resultado listo; la descarga se solapa con la subida.
+                    with observe(DEPENDENCY_LATENCY, dependency="databricks", operation="execute_stream"):
+                        cursor.execute(query)
+                    first = True
+                    while True:
+                        batch = cursor.fetchmany_arrow(batch_size)
+                        if batch.num_rows == 0 and not first:
+                            break
+                        first = False
+                        yield batch
+                        if batch.num_rows == 0:
+                            break
+        except GeneratorExit:
+            raise
         except Exception as e:
-            error_message = f"Error inesperado: {e}"
-            print(error_message)
-            raise ValueError(error_message)
\ No newline at end of file
+            raise self._to_service_error(e)
+
+    async def stream_arrow_batches(self, query: str, batch_size: int, max_pending: int = 2) -> AsyncIterator[pa.Table]:
+        """
+        Versión asíncrona de `iter_arrow_batches`. Un hilo descarga los lotes del warehouse
+        mientras el consumidor procesa los anteriores; la cola acotada a `max_pending` lotes
+        fija el techo de memoria y aplica contrapresión sobre la descarga.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=max_pending)
+        stop = threading.Event()
+
+        def put(item) -> bool:
+            # Espera a que haya sitio en la cola, abandonando si el consumidor se detuvo.
+            future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+            while True:
+                try:
+                    future.result(timeout=0.5)
+                    return True
+                except FutureTimeoutError:
+                    if stop.is_set():
+                        future.cancel()
+                        return False
+
+        def produce():
+            batches = self.iter_arrow_batches(query, batch_size)
+            try:
+                for batch in batches:
+                    if stop.is_set() or not put(batch):
+                        return
+                put(_END_OF_STREAM)
+            except Exception as e:
+                put(e)
+            finally:
+                batches.close()
+
+        producer = asyncio.ensure_future(asyncio.to_thread(produce))
+        try:
+            while True:
+                item = await queue.get()
+                if item is _END_OF_STREAM:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            await producer
+
+    def get_table_version(self, table_name: str) -> int | None:
+        """Devuelve la última versión Delta de la tabla (DESCRIBE HISTORY), o None si no tiene historial."""
+        history = self.execute_query(f"DESCRIBE HISTORY {table_name} LIMIT 1").head_records(1)
+        return history[0].get("version") if history else None
+
+    def get_pool_stats(self) -> dict:
+        """Métricas del pool de conexiones (en uso, en espera, latencia de apertura)."""
+        return self.pool.stats()
+
+    def close(self):
+        """Cierra las sesiones abiertas del pool. Se invoca al apagar la aplicación."""
+        self.pool.close()
+        print("Pool de conexiones de Databricks cerrado.")
@@ -0,0 +1,208 @@
+import asyncio
+import re
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from app.utils.value_index import TrigramValueIndex
+
+
+class ValueDictionaryService:
+    """
+    Diccionario precalculado de pares código/descripción de las columnas categóricas de la tabla.
+
+    Los pares de columnas se descubren a partir de DESCRIBE TABLE (nombres y comentarios), sus
+    valores se materializan en segundo plano con un `SELECT DISTINCT` por par y se persisten en
+    un archivo SQLite local. En memoria se mantiene un índice que permite responder en
+    microsegundos; las columnas aún no materializadas se resuelven con la consulta en vivo.
+    """
+
+    def __init__(self, databricks_service, table_name: str, db_path: str,
+                 refresh_interval_seconds: float, max_values_per_column: int):
+        self.databricks_service = databricks_service
+        self.table_name = table_name
+        self.db_path = Path(db_path)
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.max_values_per_column = max_values_per_column
+
+        self._values: Dict[Tuple[str, str], List[Tuple[str, str]]] = {}
+        self._refreshed_at: Optional[float] = None
+        self._refresh_lock = asyncio.Lock()
+        self.index = TrigramValueIndex()
+        self.hits = 0
+        self.misses = 0
+
+        self._init_db()
+        self._load_from_db()
+        self.index.build(self._values)
+        print(f"Diccionario de valores inicializado con {len(self._values)} pares de columnas.")
+
+    # --- Persistencia local ---
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path)
+
+    def _init_db(self):
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS column_pairs (
+                    table_name TEXT NOT NULL,
+                    code_column TEXT NOT NULL,
+                    desc_column TEXT NOT NULL,
+                    refreshed_at REAL NOT NULL,
+                    PRIMARY KEY (table_name, code_column, desc_column)
+                );
+                CREATE TABLE IF NOT EXISTS column_values (
+                    table_name TEXT NOT NULL,
+                    code_column TEXT NOT NULL,
+                    desc_column TEXT NOT NULL,
+                    code TEXT,
+                    description TEXT
+                );
+                CREATE INDEX IF NOT EXISTS idx_column_values_pair
+                    ON column_values (table_name, code_column, desc_column);
+                """
+            )
+
+    def _load_from_db(self):
+        """Carga en memoria los pares materializados previamente."""
+        values: Dict[Tuple[str, str], List[Tuple[str, str]]] = {}
+        with self._connect() as conn:
+            pairs = conn.execute(
+                "SELECT code_column, desc_column, refreshed_at FROM column_pairs WHERE table_name = ?",
+                (self.table_name,),
+            ).fetchall()
+            for code_column, desc_column, _ in pairs:
+                values[(code_column.upper(), desc_column.upper())] = []
+            for code_column, desc_column, code, description in conn.execute(
+                "SELECT code_column, desc_column, code, description FROM column_values WHERE table_name = ? ORDER BY rowid",
+                (self.table_name,),
+            ):
+                values.setdefault((code_column.upper(), desc_column.upper()), []).append((code, description))
+        self._values = values
+        self._refreshed_at = min((p[2] for p in pairs), default=None)
+
+    def _save_pair(self, code_column: str, desc_column: str, rows: List[Tuple[str, str]]):
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM column_values WHERE table_name = ? AND code_column = ? AND desc_column = ?",
+                (self.table_name, code_column, desc_column),
+            )
+            conn.executemany(
+                "INSERT INTO column_values (table_name, code_column, desc_column, code, description) VALUES (?, ?, ?, ?, ?)",
+                [(self.table_name, code_column, desc_column, code, description) for code, description in rows],
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO column_pairs (table_name, code_column, desc_column, refreshed_at) VALUES (?, ?, ?, ?)",
+                (self.table_name, code_column, desc_column, time.time()),
+            )
+
+    # --- Descubrimiento de pares ---
+
+    @staticmethod
+    def discover_pairs(describe_rows: List[dict]) -> List[Tuple[str, str]]:
+        """
+        Identifica pares (columna de código, columna descriptiva) a partir de DESCRIBE TABLE:
+        - Por convención de nombres: `X` y `STRX` (ej. AGEHOMO / STRAGEHOMO).
+        - Por comentarios: una columna de texto cuyo comentario menciona otra columna
+          (ej. "Descripción de la oficina AGEHOMO").
+        """
+        columns = {}
+        for row in describe_rows:
+            name = (row.get("col_name") or "").strip()
+            # DESCRIBE TABLE añade secciones (# Partition Information, etc.) después de las columnas.
+            if not name or name.startswith("#"):
+                break
+            columns[name.upper()] = row
+
+        pairs = []
+        for name, row in columns.items():
+            if name.startswith("STR") and name[3:] in columns:
+                pairs.append((columns[name[3:]]["col_name"], row["col_name"]))
+
+        known = {p[1].upper() for p in pairs}
+        for name, row in columns.items():
+            if name in known or "string" not in (row.get("data_type") or "").lower():
+                continue
+            comment = (row.get("comment") or "").split("\n")[0]
+            for other in columns:
+                if other != name and re.search(rf"\b{re.escape(other)}\b", comment, re.IGNORECASE):
+                    pairs.append((columns[other]["col_name"], row["col_name"]))
+                    break
+        return pairs
+
+    # --- Construcción y refresco ---
+
+    def _fetch_pair(self, code_column: str, desc_column: str) -> Optional[List[Tuple[str, str]]]:
+        """Materializa los valores de un par; devuelve None si la columna no es categórica."""
+        query = (
+            f"SELECT DISTINCT {code_column}, {desc_column} FROM {self.table_name} "
+            f"ORDER BY {code_column} ASC LIMIT {self.max_values_per_column + 1}"
+        )
+        rows = self.databricks_service.execute_query(query).head_rows()
+        if len(rows) > self.max_values_per_column:
+            return None
+        return [(None if code is None else str(code), None if desc is None else str(desc)) for code, desc in rows]
+
+    async def refresh(self, describe_rows: List[dict]):
+        """Reconstruye el diccionario para todos los pares descubiertos, uno a uno para no saturar el warehouse."""
+        async with self._refresh_lock:
+            pairs = self.discover_pairs(describe_rows)
+            print(f"--- Diccionario de valores: materializando {len(pairs)} pares de columnas ---")
+            start = time.perf_counter()
+            for code_column, desc_column in pairs:
+                try:
+                    rows = await asyncio.to_thread(self._fetch_pair, code_column, desc_column)
+                except Exception as e:
+                    print(f"Error materializando {code_column}/{desc_column}: {e}")
+                    continue
+                if rows is None:
+                    print(f"--- {code_column}/{desc_column} supera {self.max_values_per_column} valores, se omite ---")
+                    continue
+                await asyncio.to_thread(self._save_pair, code_column, desc_column, rows)
+                self._values[(code_column.upper(), desc_column.upper())] = rows
+            self.index.build(self._values)
+            self._refreshed_at = time.time()
+            print(f"--- Diccionario de valores actualizado en {time.perf_counter() - start:.1f}s ---")
+
+    def is_stale(self) -> bool:
+        return self._refreshed_at is None or time.time() - self._refreshed_at > self.refresh_interval_seconds
+
+    async def run_refresh_loop(self, describe_loader):
+        """Tarea de fondo: refresca el diccionario cuando está vacío o caducado."""
+        while True:
+            try:
+                if self.is_stale():
+                    await self.refresh(await describe_loader())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error refrescando el diccionario de valores: {e}")
+            await asyncio.sleep(min(self.refresh_interval_seconds, 3600))
+
+    # --- Consulta ---
+
+    def get(self, code_column: str, desc_column: str) -> Optional[List[Tuple[str, str]]]:
+        """Valores materializados del par, o None si aún no está disponible."""
+        values = self._values.get((code_column.strip('`').upper(), desc_column.strip('`').upper()))
+        if values is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return values
+
+    def search(self, term: str, columns: Optional[List[str]] = None, top_k: int = 5) -> List[dict]:
+        """Mejores coincidencias aproximadas de `term` entre las descripciones materializadas."""
+        return self.index.search(term, columns=columns, top_k=top_k)
+
+    def stats(self) -> dict:
+        return {
+            "pairs": len(self._values),
+            "values": sum(len(v) for v in self._values.values()),
+            "indexed_values": len(self.index),
+            "refreshed_at": self._refreshed_at,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,252 @@
+import asyncio
+import json
+import time
+from collections import deque
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+
+class WriteBehindQueue:
+    """
+    Persistencia diferida (write-behind) de documentos de Cosmos DB.
+
+    Las escrituras se encolan y la petición responde de inmediato; un grupo acotado de workers
+    las aplica con reintentos y backoff exponencial. Si Cosmos DB está lento o no disponible (cola
+    llena o reintentos agotados), los documentos se vuelcan a un journal JSONL local y se
+    reencolan periódicamente, también tras un reinicio. Los documentos aún no persistidos se
+    pueden leer mediante `pending_items`, para que el turno siguiente y la muestra del frontend
+    vean lo recién escrito.
+
+    Un mismo documento puede encolarse varias veces (por ejemplo, el agregado de una sesión): las
+    escrituras de un id se serializan y siempre se persiste la versión más reciente, de modo que
+    una versión antigua nunca sobrescribe a una nueva.
+    """
+
+    def __init__(self, writer: Callable[[str, dict], Awaitable[None]], journal_path: str,
+                 concurrency: int = 4, max_retries: int = 3, max_queue: int = 1000,
+                 replay_interval_seconds: float = 30, retry_backoff_seconds: float = 0.5):
+        """
+        Args:
+            writer: Corrutina que persiste un documento (`container`, `body`); debe ser idempotente (upsert).
+            journal_path: Archivo JSONL donde se vuelcan las escrituras que no se pudieron aplicar.
+        """
+        self._writer = writer
+        self.journal_path = Path(journal_path)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.max_queue = max_queue
+        self.replay_interval_seconds = replay_interval_seconds
+        self.retry_backoff_seconds = retry_backoff_seconds
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._replay_task: Optional[asyncio.Task] = None
+        self._journal_lock = asyncio.Lock()
+        # id del documento -> {"container", "body"} para todo lo que aún no está en Cosmos DB
+        self._pending: Dict[str, dict] = {}
+        # Locks por id para serializar las escrituras de un mismo documento: id -> [lock, referencias]
+        self._id_locks: Dict[str, list] = {}
+        # Ids volcados al journal que después se escribieron con una versión más nueva: id -> enqueued_at
+        self._spilled_ids: set = set()
+        self._superseded: Dict[str, float] = {}
+
+        self.enqueued = 0
+        self.written = 0
+        self.failed_attempts = 0
+        self.spilled = 0
+        self.replayed = 0
+        self._flush_latencies = deque(maxlen=500)
+
+    # --- Ciclo de vida ---
+
+    async def start(self):
+        """Arranca los workers y reencola lo que haya quedado en el journal de una ejecución anterior."""
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        await self._replay_journal()
+        self._replay_task = asyncio.create_task(self._replay_loop())
+        print(f"Persistencia diferida iniciada con {self.concurrency} workers.")
+
+    async def drain(self, timeout: float):
+        """
+        Intenta vaciar la cola antes de apagar. Todo lo que no alcance a escribirse (en cola, en
+        vuelo o esperando un reintento) se vuelca al journal, igual que lo que se encole después.
+        """
+        if self._replay_task:
+            self._replay_task.cancel()
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout=timeout)
+            except asyncio.TimeoutError:
+                print(f"--- Persistencia diferida: tiempo agotado con {self._queue.qsize()} escrituras pendientes ---")
+        # Sin cola, `enqueue` escribe directo en el journal.
+        self._queue = None
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        # `_pending` tiene la última versión de cada documento no persistido, incluidas las escrituras
+        # interrumpidas; las que ya están en el journal no se duplican.
+        leftovers = [entry for entry in list(self._pending.values()) if not entry.get("in_journal")]
+        if leftovers:
+            await self._spill(leftovers)
+        print(f"Persistencia diferida detenida: {self.stats()}")
+
+    # --- Encolado ---
+
+    async def enqueue(self, container: str, body: dict):
+        entry = {"container": container, "body": body, "enqueued_at": time.time()}
+        self._pending[body["id"]] = entry
+        self.enqueued += 1
+        if self._queue is None or self._queue.qsize() >= self.max_queue:
+            # Sin workers o con Cosmos DB acumulando retraso: directo al journal.
+            await self._spill([entry])
+        else:
+            self._queue.put_nowait(entry)
+
+    def pending_item(self, doc_id: str) -> Optional[dict]:
+        """Última versión aún no persistida de un documento, o None."""
+        entry = self._pending.get(doc_id)
+        return entry["body"] if entry is not None else None
+
+    def pending_items(self, container: str, session_id: str) -> List[dict]:
+        """Documentos de una sesión aún no persistidos en Cosmos DB (encolados, en vuelo o en el journal)."""
+        return [
+            entry["body"] for entry in list(self._pending.values())
+            if entry["container"] == container and entry["body"].get("sessionId") == session_id
+        ]
+
+    # --- Escritura ---
+
+    async def _worker(self):
+        while True:
+            entry = await self._queue.get()
+            try:
+                await self._write_with_retries(entry)
+            finally:
+                self._queue.task_done()
+
+    async def _write_with_retries(self, entry: dict):
+        doc_id = entry["body"]["id"]
+        lock_ref = self._id_locks.setdefault(doc_id, [asyncio.Lock(), 0])
+        lock_ref[1] += 1
+        try:
+            async with lock_ref[0]:
+                await self._write_latest(doc_id)
+        finally:
+            lock_ref[1] -= 1
+            if lock_ref[1] == 0:
+                self._id_locks.pop(doc_id, None)
+
+    async def _write_latest(self, doc_id: str):
+        """Escribe la versión más reciente pendiente del documento (si otra tarea ya la escribió, no hace nada)."""
+        latest = self._pending.get(doc_id)
+        if latest is None:
+            return
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self._writer(latest["container"], latest["body"])
+                if self._pending.get(doc_id) is latest:
+                    self._pending.pop(doc_id, None)
+                if doc_id in self._spilled_ids:
+                    self._superseded[doc_id] = latest["enqueued_at"]
+                self.written += 1
+                self._flush_latencies.append(time.time() - latest["enqueued_at"])
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed_attempts += 1
+                print(f"Error persistiendo '{doc_id}' (intento {attempt + 1}): {e}")
+                if attempt < self.max_retries:
+                    await asyncio.sleep(self.retry_backoff_seconds * (2 ** attempt))
+        await self._spill([latest])
+
+    # --- Journal local ---
+
+    # El acceso al archivo corre en un hilo (`asyncio.to_thread`): el journal se usa justo cuando
+    # Cosmos DB va lento y no debe bloquear el event loop de las peticiones.
+
+    def _append_journal(self, lines: List[str]):
+        self.journal_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.journal_path, "a", encoding="utf-8") as journal:
+            journal.writelines(lines)
+
+    def _read_journal(self) -> List[dict]:
+        """Lee el journal sin modificarlo; lista vacía si no existe."""
+        if not self.journal_path.exists():
+            return []
+        with open(self.journal_path, "r", encoding="utf-8") as journal:
+            return [json.loads(line) for line in journal if line.strip()]
+
+    async def _spill(self, entries: List[dict]):
+        # Se serializa en el event loop: el journal guarda la versión del documento de este momento.
+        lines = [
+            json.dumps({key: value for key, value in entry.items() if key != "in_journal"}, ensure_ascii=False, default=str) + "\n"
+            for entry in entries
+        ]
+        async with self._journal_lock:
+            await asyncio.to_thread(self._append_journal, lines)
+            for entry in entries:
+                entry["in_journal"] = True
+                self._spilled_ids.add(entry["body"]["id"])
+        self.spilled += len(entries)
+
+    async def _replay_journal(self):
+        """Reencola el contenido del journal si la cola tiene capacidad."""
+        if self._queue is None or self._queue.qsize() >= self.max_queue:
+            return
+        async with self._journal_lock:
+            # El journal solo se borra cuando su contenido ya está en `_pending`: si la tarea se cancela
+            # antes (apagado), nada se pierde.
+            entries = await asyncio.to_thread(self._read_journal)
+            if not entries or self._queue is None:
+                return
+            self._requeue(entries)
+            await asyncio.to_thread(self.journal_path.unlink, True)
+
+    def _requeue(self, entries: List[dict]):
+        # Solo la última versión de cada documento, y nunca una más antigua que la ya escrita.
+        latest_by_id = {}
+        for entry in entries:
+            latest_by_id[entry["body"]["id"]] = entry
+        entries = [
+            entry for doc_id, entry in latest_by_id.items()
+            if self._superseded.get(doc_id, float("-inf")) < entry["enqueued_at"]
+        ]
+        self._spilled_ids.difference_update(latest_by_id)
+        for doc_id in latest_by_id:
+            self._superseded.pop(doc_id, None)
+        for entry in entries:
+            current = self._pending.get(entry["body"]["id"])
+            if current is None or current["enqueued_at"] <= entry["enqueued_at"]:
+                self._pending[entry["body"]["id"]] = entry
+            self._queue.put_nowait(entry)
+        if entries:
+            self.replayed += len(entries)
+            print(f"--- Persistencia diferida: {len(entries)} escrituras reencoladas desde el journal ---")
+
+    async def _replay_loop(self):
+        while True:
+            await asyncio.sleep(self.replay_interval_seconds)
+            try:
+                await self._replay_journal()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error reencolando el journal de persistencia: {e}")
+
+    def stats(self) -> dict:
+        latencies = sorted(self._flush_latencies)
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "pending_items": len(self._pending),
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "failed_attempts": self.failed_attempts,
+            "spilled": self.spilled,
+            "replayed": self.replayed,
+            "journal_bytes": self.journal_path.stat().st_size if self.journal_path.exists() else 0,
+            "flush_latency_avg_ms": round(1000 * sum(latencies) / len(latencies), 1) if latencies else None,
+            "flush_latency_p95_ms": round(1000 * latencies[int(0.95 * (len(latencies) - 1))], 1) if latencies else None,
+        }
@@ -0,0 +1,110 @@
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+
+
+class _AnswerEntry:
+    def __init__(self, question: str, sql_query: str, vector: np.ndarray):
+        self.question = question
+        self.sql_query = sql_query
+        self.vector = vector
+        self.created_at = time.monotonic()
+        self.hits = 0
+
+
+class SemanticAnswerCache:
+    """
+    Caché pregunta -> SQL final para preguntas casi idénticas.
+
+    Busca primero por el texto normalizado exacto y, si no hay coincidencia, por similitud coseno
+    del embedding de la pregunta contra las preguntas guardadas (umbral configurable). Las entradas
+    se desalojan por LRU y por TTL, y se descartan todas cuando cambia la huella del contexto con
+    que se generaron (versión Delta de la tabla e índice de ejemplos), ya que el SQL puede dejar de
+    ser válido o dejar de ser el que generaría el agente.
+    """
+
+    def __init__(self, max_entries: int, similarity_threshold: float, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, _AnswerEntry]" = OrderedDict()
+        self._fingerprint: Optional[str] = None
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def validate(self, fingerprint: Optional[str]):
+        """Vacía la caché si la huella del contexto (esquema / ejemplos) cambió."""
+        if fingerprint != self._fingerprint:
+            if self._entries:
+                print(f"--- Caché de respuestas invalidada: el contexto cambió ({self._fingerprint} -> {fingerprint}) ---")
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+            self._fingerprint = fingerprint
+
+    def _expire(self):
+        now = time.monotonic()
+        expired = [k for k, e in self._entries.items() if now - e.created_at > self.ttl_seconds]
+        for key in expired:
+            del self._entries[key]
+        self.evictions += len(expired)
+
+    @staticmethod
+    def _unit(vector: List[float]) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def lookup(self, normalized_question: str, vector: Optional[List[float]] = None) -> Optional[dict]:
+        """
+        Devuelve {"sql_query", "question", "similarity", "match"} para la mejor entrada válida, o None.
+        Sin `vector` solo se intenta la coincidencia exacta y el fallo no se cuenta, para poder
+        consultarla antes de pagar el embedding de la pregunta.
+        """
+        self._expire()
+        entry = self._entries.get(normalized_question)
+        if entry is not None:
+            self.exact_hits += 1
+            match, similarity = "exact", 1.0
+        elif vector is not None and self._entries:
+            keys = list(self._entries)
+            similarities = np.stack([self._entries[k].vector for k in keys]) @ self._unit(vector)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.similarity_threshold:
+                self.misses += 1
+                return None
+            entry = self._entries[keys[best]]
+            self.semantic_hits += 1
+            match, similarity = "semantic", float(similarities[best])
+        else:
+            if vector is not None:
+                self.misses += 1
+            return None
+
+        entry.hits += 1
+        self._entries.move_to_end(entry.question)
+        return {"sql_query": entry.sql_query, "question": entry.question, "similarity": round(similarity, 4), "match": match}
+
+    def store(self, normalized_question: str, vector: List[float], sql_query: str):
+        self._entries[normalized_question] = _AnswerEntry(normalized_question, sql_query, self._unit(vector))
+        self._entries.move_to_end(normalized_question)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        hits = self.exact_hits + self.semantic_hits
+        lookups = hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "fingerprint": self._fingerprint,
+        }
@@ -0,0 +1,28 @@
+import uuid
+from typing import Optional
+
+# Tipos de artefacto que producen las herramientas
+QUERY_RESULT = "query_result"
+
+
+def new_handle(kind: str) -> str:
+    """Identificador corto que el modelo ve en lugar del contenido del artefacto."""
+    return f"{kind}:{uuid.uuid4().hex[:12]}"
+
+
+def merge_artifacts(left: Optional[dict], right: Optional[dict]) -> dict:
+    """
+    Reductor del canal de artefactos del estado del agente: handle -> artefacto. Conserva el
+    orden de llegada, de modo que el último artefacto de un tipo es el más reciente.
+    """
+    merged = dict(left or {})
+    merged.update(right or {})
+    return merged
+
+
+def latest_artifact(artifacts: Optional[dict], kind: str) -> Optional[dict]:
+    """Artefacto más reciente de un tipo, o None."""
+    for artifact in reversed(list((artifacts or {}).values())):
+        if artifact.get("kind") == kind:
+            return artifact
+    return None
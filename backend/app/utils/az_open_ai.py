@@ -6,6 +6,8 @@ import os
 from dotenv import load_dotenv, find_dotenv
 import pandas as pd
 from app import config
+from app.utils.embedding_cache import get_embedding_cache
+from app.utils.http_client import get_async_http_client
 
 
 # Cargar variables desde el archivo .env
@@ -51,7 +53,10 @@ class AzureOpenAIFunctions:
             azure_endpoint=self.endpoint,
             api_key=self.api_key,
             api_version=self.api_version_4o,
-            temperature=0.4
+            temperature=0.4,
+            # Llamadas asíncronas sobre el pool HTTP compartido, y uso de tokens también en streaming.
+            http_async_client=get_async_http_client(),
+            stream_usage=True,
         )
         # Cliente de respuesta de Azure OpenAI
         self.client_response = AzureOpenAI(
@@ -126,5 +131,11 @@ class AzureOpenAIFunctions:
             list[float]: La representación vectorial del texto.
         """
         #embedding_deployment = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
-        embedding = self.client_response.embeddings.create(input=[text], model=self.model_name).data[0].embedding
-        return embedding
\ No newline at end of file
+        def compute(t: str) -> list[float]:
+            return self.client_response.embeddings.create(input=[t], model=self.model_name).data[0].embedding
+
+        # Las preguntas repetidas se sirven desde la caché sin llamar a Azure OpenAI.
+        cache = get_embedding_cache()
+        if cache is None:
+            return compute(text)
+        return cache.get_or_compute(self.model_name, text, compute)
\ No newline at end of file
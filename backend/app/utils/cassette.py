@@ -0,0 +1,445 @@
+import asyncio
+import base64
+import gzip
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List
+
+import pyarrow as pa
+from azure.cosmos import exceptions
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from app.utils.query_result import QueryResult
+
+# Argumentos que el sistema inyecta en las llamadas a herramientas y que cambian en cada ejecución.
+_VOLATILE_TOOL_ARGS = {"session_id", "message_id", "result_format", "use_result_cache"}
+# Handles de artefactos (ver app.utils.artifacts.new_handle): aleatorios, no forman parte de la clave.
+_ARTIFACT_HANDLE = re.compile(r"\b([a-z_]+):[0-9a-f]{12}\b")
+
+
+class CassetteMissError(RuntimeError):
+    """La reproducción pidió una llamada que no está grabada en el cassette."""
+
+
+class Cassette:
+    """
+    Grabación y reproducción de las llamadas externas de un escenario (un archivo JSONL gzip).
+
+    - `record`: ejecuta la llamada real y guarda petición (como clave), respuesta y latencia.
+    - `replay`: devuelve la respuesta grabada sin salir del proceso y, opcionalmente, espera la
+      latencia grabada. Las llamadas idénticas se reproducen en el orden en que se grabaron. Una
+      clave que no existe es un error (`CassetteMissError`): una petición distinta puede ser una
+      regresión real. Con `allow_fallback` se usa en su lugar la siguiente grabación pendiente del
+      mismo tipo, para tolerar diferencias menores entre commits.
+    """
+
+    def __init__(self, path: str, mode: str, replay_latency: bool = True, allow_fallback: bool = False):
+        self.path = Path(path)
+        self.mode = mode
+        self.replay_latency = replay_latency
+        self.allow_fallback = allow_fallback
+        self._lock = threading.Lock()
+        self._recorded: List[dict] = []
+        self._by_key: Dict[str, deque] = defaultdict(deque)
+        self._by_kind: Dict[str, deque] = defaultdict(deque)
+        self.hits = 0
+        self.fallbacks = 0
+        if mode == "replay":
+            self._load()
+
+    # --- Archivo ---
+
+    def _load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as cassette:
+            for line in cassette:
+                entry = json.loads(line)
+                entry["used"] = False
+                self._by_key[entry["key"]].append(entry)
+                self._by_kind[entry["kind"]].append(entry)
+        print(f"--- Cassette '{self.path}' cargado: {sum(len(v) for v in self._by_kind.values())} interacciones ---")
+
+    def save(self):
+        if self.mode != "record":
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with gzip.open(self.path, "wt", encoding="utf-8") as cassette:
+            for entry in self._recorded:
+                cassette.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":"), default=str) + "\n")
+        print(f"--- Cassette '{self.path}' guardado: {len(self._recorded)} interacciones ---")
+
+    # --- Grabación y reproducción ---
+
+    @staticmethod
+    def make_key(kind: str, request: Any) -> str:
+        payload = json.dumps(request, ensure_ascii=False, sort_keys=True, default=str)
+        return f"{kind}:{hashlib.sha256(payload.encode('utf-8')).hexdigest()[:20]}"
+
+    def _record(self, kind: str, key: str, response: Any, latency: float):
+        with self._lock:
+            self._recorded.append({"kind": kind, "key": key, "latency": round(latency, 4), "response": response})
+
+    def _take(self, kind: str, key: str) -> dict:
+        with self._lock:
+            entries = self._by_key.get(key)
+            while entries and entries[0]["used"]:
+                entries.popleft()
+            if entries:
+                self.hits += 1
+            else:
+                if not self.allow_fallback:
+                    raise CassetteMissError(
+                        f"La interacción {key} no está grabada en {self.path} "
+                        "(CASSETTE_REPLAY_FALLBACK=true reproduce la siguiente del mismo tipo)"
+                    )
+                pending = self._by_kind.get(kind)
+                while pending and pending[0]["used"]:
+                    pending.popleft()
+                if not pending:
+                    raise CassetteMissError(f"No hay interacciones '{kind}' grabadas para {key} en {self.path}")
+                self.fallbacks += 1
+                print(f"--- Cassette: {key} no está grabada, se usa la siguiente interacción '{kind}' ---")
+                entries = pending
+            entry = entries.popleft()
+            entry["used"] = True
+            return entry
+
+    async def acall(self, kind: str, request: Any, call: Callable, encode: Callable = None, decode: Callable = None):
+        """Versión asíncrona: `call` es una corrutina sin argumentos que hace la llamada real."""
+        key = self.make_key(kind, request)
+        if self.mode == "replay":
+            entry = self._take(kind, key)
+            if self.replay_latency and entry["latency"]:
+                await asyncio.sleep(entry["latency"])
+            return decode(entry["response"]) if decode else entry["response"]
+        start = time.perf_counter()
+        response = await call()
+        self._record(kind, key, encode(response) if encode else response, time.perf_counter() - start)
+        return response
+
+    def call(self, kind: str, request: Any, call: Callable, encode: Callable = None, decode: Callable = None):
+        """Versión síncrona (conector de Databricks, llamadas síncronas al modelo)."""
+        key = self.make_key(kind, request)
+        if self.mode == "replay":
+            entry = self._take(kind, key)
+            if self.replay_latency and entry["latency"]:
+                time.sleep(entry["latency"])
+            return decode(entry["response"]) if decode else entry["response"]
+        start = time.perf_counter()
+        response = call()
+        self._record(kind, key, encode(response) if encode else response, time.perf_counter() - start)
+        return response
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "path": str(self.path),
+            "recorded": len(self._recorded),
+            "replay_hits": self.hits,
+            "replay_fallback_enabled": self.allow_fallback,
+            "replay_fallbacks": self.fallbacks,
+        }
+
+
+# --- Codificación de respuestas ---
+
+def encode_arrow(table: pa.Table) -> str:
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return base64.b64encode(sink.getvalue().to_pybytes()).decode("ascii")
+
+
+def decode_arrow(data: str) -> pa.Table:
+    return pa.ipc.open_stream(base64.b64decode(data)).read_all()
+
+
+def _message_key(message) -> dict:
+    """Representación estable de un mensaje para la clave: sin ids ni argumentos inyectados."""
+    content = message.content if isinstance(message.content, str) else json.dumps(message.content, default=str)
+    key = {"type": message.type, "content": _ARTIFACT_HANDLE.sub(r"\1:*", content)}
+    if isinstance(message, AIMessage) and message.tool_calls:
+        key["tool_calls"] = [
+            {"name": call["name"], "args": {k: v for k, v in call["args"].items() if k not in _VOLATILE_TOOL_ARGS}}
+            for call in message.tool_calls
+        ]
+    return key
+
+
+def messages_key(messages) -> list:
+    return [_message_key(message) for message in messages]
+
+
+# --- Envolturas de los clientes externos ---
+
+class CassetteChatModel(BaseChatModel):
+    """Modelo de chat (ya con herramientas enlazadas) cuyas respuestas pasan por el cassette."""
+
+    inner: Any = None
+    cassette: Any = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "cassette"
+
+    @staticmethod
+    def _encode(message: AIMessage) -> dict:
+        return message_to_dict(message)
+
+    @staticmethod
+    def _decode(data: dict) -> AIMessage:
+        return messages_from_dict([data])[0]
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        message = self.cassette.call("llm", messages_key(messages), lambda: self.inner.invoke(messages),
+                                     self._encode, self._decode)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        message = await self.cassette.acall("llm", messages_key(messages), lambda: self.inner.ainvoke(messages),
+                                            self._encode, self._decode)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        async def collect():
+            final = None
+            async for chunk in self.inner.astream(messages):
+                final = chunk if final is None else final + chunk
+            return AIMessage(**{k: v for k, v in final.model_dump().items()
+                                if k in ("content", "tool_calls", "usage_metadata", "response_metadata", "id")})
+
+        # La respuesta se reproduce como un único fragmento: el cassette guarda el mensaje final.
+        message = await self.cassette.acall("llm", messages_key(messages), collect, self._encode, self._decode)
+        yield ChatGenerationChunk(message=AIMessageChunk(
+            content=message.content,
+            tool_call_chunks=[
+                {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": i}
+                for i, call in enumerate(message.tool_calls)
+            ],
+            usage_metadata=message.usage_metadata,
+        ))
+
+
+class _BytesDownloader:
+    def __init__(self, data: bytes, chunk_size: int = 4 * 1024 * 1024):
+        self._data = data
+        self._chunk_size = chunk_size
+
+    async def readall(self) -> bytes:
+        return self._data
+
+    async def chunks(self):
+        for start in range(0, len(self._data), self._chunk_size):
+            yield self._data[start:start + self._chunk_size]
+
+
+class CassetteBlobClient:
+    def __init__(self, cassette: Cassette, name: str, real=None):
+        self.cassette = cassette
+        self.name = name
+        self.real = real
+
+    async def stage_block(self, block_id: str, data: bytes, length: int = None):
+        await self.cassette.acall("blob", {"op": "stage_block", "blob": self.name, "block": block_id},
+                                  lambda: self.real.stage_block(block_id=block_id, data=data, length=length))
+
+    async def commit_block_list(self, blocks, content_settings=None):
+        await self.cassette.acall("blob", {"op": "commit_block_list", "blob": self.name, "blocks": len(blocks)},
+                                  lambda: self.real.commit_block_list(blocks, content_settings=content_settings))
+
+    async def upload_blob(self, data: bytes, overwrite: bool = False):
+        await self.cassette.acall("blob", {"op": "upload_blob", "blob": self.name},
+                                  lambda: self.real.upload_blob(data, overwrite=overwrite))
+
+    async def download_blob(self, offset: int = None, length: int = None) -> _BytesDownloader:
+        async def download():
+            downloader = await self.real.download_blob(offset=offset, length=length)
+            return await downloader.readall()
+
+        data = await self.cassette.acall(
+            "blob", {"op": "download_blob", "blob": self.name, "offset": offset, "length": length}, download,
+            encode=lambda raw: base64.b64encode(raw).decode("ascii"), decode=base64.b64decode,
+        )
+        return _BytesDownloader(data)
+
+    async def get_blob_properties(self) -> SimpleNamespace:
+        async def properties():
+            return {"size": (await self.real.get_blob_properties()).size}
+
+        recorded = await self.cassette.acall("blob", {"op": "get_blob_properties", "blob": self.name}, properties)
+        return SimpleNamespace(**recorded)
+
+
+class CassetteBlobService:
+    def __init__(self, cassette: Cassette, real=None):
+        self.cassette = cassette
+        self.real = real
+
+    def get_blob_client(self, container: str, blob: str) -> CassetteBlobClient:
+        real = self.real.get_blob_client(container=container, blob=blob) if self.real is not None else None
+        return CassetteBlobClient(self.cassette, f"{container}/{blob}", real)
+
+    def get_container_client(self, container: str):
+        return self.real.get_container_client(container)
+
+
+class CassetteCosmosContainer:
+    def __init__(self, cassette: Cassette, name: str, real=None):
+        self.cassette = cassette
+        self.name = name
+        self.real = real
+
+    async def upsert_item(self, body: dict) -> dict:
+        await self.cassette.acall("cosmos", {"op": "upsert", "container": self.name, "id": body["id"]},
+                                  lambda: self.real.upsert_item(body), encode=lambda _: None)
+        return body
+
+    async def _conditional_write(self, op: str, item_id: str, write: Callable[[], Any]) -> dict:
+        """create/replace con su resultado grabado: el documento (con `_etag`) o el código de conflicto."""
+        async def run():
+            try:
+                return {"item": await write()}
+            except (exceptions.CosmosResourceExistsError, exceptions.CosmosAccessConditionFailedError) as e:
+                return {"status": e.status_code}
+
+        recorded = await self.cassette.acall("cosmos", {"op": op, "container": self.name, "id": item_id}, run)
+        if recorded.get("status") == 409:
+            raise exceptions.CosmosResourceExistsError(status_code=409, message=f"{item_id} ya existe")
+        if recorded.get("status") == 412:
+            raise exceptions.CosmosAccessConditionFailedError(status_code=412, message=f"{item_id} cambió")
+        return recorded["item"]
+
+    async def create_item(self, body: dict) -> dict:
+        return await self._conditional_write("create", body["id"], lambda: self.real.create_item(body))
+
+    async def replace_item(self, item: str, body: dict, etag: str = None, match_condition=None) -> dict:
+        return await self._conditional_write(
+            "replace", item, lambda: self.real.replace_item(item=item, body=body, etag=etag, match_condition=match_condition)
+        )
+
+    async def read_item(self, item: str, partition_key: str) -> dict:
+        async def read():
+            try:
+                return await self.real.read_item(item=item, partition_key=partition_key)
+            except exceptions.CosmosResourceNotFoundError:
+                return None
+
+        found = await self.cassette.acall("cosmos", {"op": "read", "container": self.name, "id": item}, read)
+        if found is None:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message=f"{item} no existe")
+        return found
+
+    def query_items(self, query: str, parameters: List[dict] = None, partition_key: str = None):
+        async def run():
+            items = self.real.query_items(query=query, parameters=parameters, partition_key=partition_key)
+            return [item async for item in items]
+
+        async def iterate():
+            items = await self.cassette.acall(
+                "cosmos", {"op": "query", "container": self.name, "query": query, "parameters": parameters}, run
+            )
+            for item in items:
+                yield item
+
+        return iterate()
+
+
+class _ListResults:
+    def __init__(self, items: List[dict]):
+        self._items = items
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for item in self._items:
+            yield item
+
+
+class CassetteSearchClient:
+    def __init__(self, cassette: Cassette, real=None):
+        self.cassette = cassette
+        self.real = real
+
+    async def search(self, **kwargs) -> _ListResults:
+        async def run():
+            results = await self.real.search(**kwargs)
+            return [dict(result) async for result in results]
+
+        # El vector de la consulta deriva del texto (ya en la clave); se omite para que la clave sea estable.
+        request = {k: v for k, v in kwargs.items() if k != "vector_queries"}
+        return _ListResults(await self.cassette.acall("search", request, run))
+
+    async def close(self):
+        if self.real is not None:
+            await self.real.close()
+
+
+# --- Instalación ---
+
+async def install_cassette(cassette: Cassette, *, graph_module, databricks_service, cosmos_service,
+                           storage_services, search_service, index_names: List[str]):
+    """
+    Envuelve los clientes externos de las instancias compartidas de la aplicación. En modo
+    `replay` no se crea ningún cliente real, de modo que no hay tráfico de red.
+    """
+    recording = cassette.mode == "record"
+
+    graph_module.model = CassetteChatModel(inner=graph_module.model, cassette=cassette)
+
+    real_execute, real_iter = databricks_service.execute_query, databricks_service.iter_arrow_batches
+
+    def execute_query(query: str) -> QueryResult:
+        table = cassette.call("warehouse", {"op": "execute_query", "query": query},
+                              lambda: real_execute(query).table, encode_arrow, decode_arrow)
+        return QueryResult(table)
+
+    def iter_arrow_batches(query: str, batch_size: int):
+        def run():
+            return pa.concat_tables(list(real_iter(query, batch_size)))
+
+        table = cassette.call("warehouse", {"op": "iter_arrow_batches", "query": query}, run, encode_arrow, decode_arrow)
+        yield table.slice(0, batch_size)
+        for offset in range(batch_size, table.num_rows, batch_size):
+            yield table.slice(offset, batch_size)
+
+    databricks_service.execute_query = execute_query
+    databricks_service.iter_arrow_batches = iter_arrow_batches
+
+    conversations = await cosmos_service._get_conversations_container() if recording else None
+    results = await cosmos_service._get_results_container() if recording else None
+    cosmos_service.conversations_container = CassetteCosmosContainer(cassette, "conversations", conversations)
+    cosmos_service.results_container = CassetteCosmosContainer(cassette, "results", results)
+
+    for storage in storage_services:
+        storage.blob_service_client = CassetteBlobService(cassette, storage.blob_service_client if recording else None)
+
+    if recording:
+        await search_service.initialize_clients()
+    real_get_embedding = search_service.get_embedding
+
+    async def get_embedding(text: str):
+        return await cassette.acall("embedding", {"text": text}, lambda: real_get_embedding(text))
+
+    search_service.get_embedding = get_embedding
+    for index_name in index_names:
+        real = search_service._get_search_client(index_name) if recording else None
+        search_service._search_clients[index_name] = CassetteSearchClient(cassette, real)
+    if not recording:
+        # Evita que initialize_clients cree el cliente real de Azure OpenAI.
+        search_service._openai_client = _NoNetworkClient()
+    print(f"--- Cassette en modo '{cassette.mode}': {cassette.path} ---")
+
+
+class _NoNetworkClient:
+    """Marcador para el modo replay: los embeddings salen del cassette, este cliente nunca se usa."""
+
+    async def close(self):
+        pass
@@ -0,0 +1,137 @@
+import json
+from typing import List
+
+import tiktoken
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+
+
+class TokenCounter:
+    """
+    Conteo de tokens con tiktoken para los mensajes que se envían al modelo.
+
+    tiktoken descarga la codificación la primera vez (o la lee de TIKTOKEN_CACHE_DIR, que la imagen
+    Docker deja precargada). Sin red ni caché, el conteo pasa a una estimación por caracteres en
+    lugar de impedir que arranque la aplicación.
+    """
+
+    # Tokens fijos que la API añade por mensaje (rol, separadores).
+    MESSAGE_OVERHEAD = 4
+    # Estimación conservadora sin tokenizer: ~3 caracteres por token en español (sobrestima un poco).
+    CHARS_PER_TOKEN = 3
+
+    def __init__(self, model_name: str = "gpt-4o"):
+        try:
+            try:
+                self.encoding = tiktoken.encoding_for_model(model_name)
+            except KeyError:
+                # Nombres de deployment de Azure (ej. "gpt-4o-sql-agent") no los reconoce tiktoken.
+                self.encoding = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            print(f"--- tiktoken no disponible ({e}); se estiman los tokens por caracteres ---")
+            self.encoding = None
+
+    def count_text(self, text: str) -> int:
+        if self.encoding is None:
+            return -(-len(text or "") // self.CHARS_PER_TOKEN)
+        return len(self.encoding.encode(text or ""))
+
+    def count_message(self, message: BaseMessage) -> int:
+        content = message.content if isinstance(message.content, str) else json.dumps(message.content, ensure_ascii=False)
+        tokens = self.MESSAGE_OVERHEAD + self.count_text(content)
+        if isinstance(message, AIMessage) and message.tool_calls:
+            tokens += self.count_text(json.dumps([
+                {"name": call["name"], "args": call["args"]} for call in message.tool_calls
+            ], ensure_ascii=False))
+        return tokens
+
+    def count_messages(self, messages: List[BaseMessage]) -> int:
+        return sum(self.count_message(message) for message in messages)
+
+
+class HistoryContextBuilder:
+    """
+    Arma el historial que se envía al modelo dentro de un presupuesto de tokens.
+
+    - Agrupa cada AIMessage con llamadas a herramientas junto con sus ToolMessages, de modo que
+      nunca se envía una llamada sin su resultado ni un resultado huérfano.
+    - Recorre el historial del turno más reciente al más antiguo y se detiene cuando el siguiente
+      bloque ya no cabe, conservando siempre una secuencia contigua.
+    - Las salidas de herramientas de los turnos antiguos se sustituyen por un resumen corto;
+      solo los últimos `full_tool_output_turns` turnos conservan la salida completa.
+    """
+
+    def __init__(self, token_budget: int, full_tool_output_turns: int = 1,
+                 digest_chars: int = 200, model_name: str = "gpt-4o"):
+        self.token_budget = token_budget
+        self.full_tool_output_turns = full_tool_output_turns
+        self.digest_chars = digest_chars
+        self.counter = TokenCounter(model_name)
+
+    @staticmethod
+    def _group_units(messages: List[BaseMessage]) -> List[List[BaseMessage]]:
+        """Bloques atómicos: [AIMessage con tool_calls + sus ToolMessages] o un mensaje suelto."""
+        units = []
+        for message in messages:
+            if isinstance(message, ToolMessage) and units and (
+                isinstance(units[-1][0], AIMessage) and units[-1][0].tool_calls
+            ):
+                units[-1].append(message)
+            elif isinstance(message, ToolMessage):
+                # Resultado sin su llamada (cortado por la ventana de carga): se descarta.
+                continue
+            else:
+                units.append([message])
+        return units
+
+    def _digest(self, message: ToolMessage) -> ToolMessage:
+        """Resumen corto de la salida de una herramienta de un turno antiguo."""
+        content = message.content if isinstance(message.content, str) else str(message.content)
+        try:
+            payload = json.loads(content)
+        except (json.JSONDecodeError, TypeError):
+            payload = None
+
+        if isinstance(payload, dict) and "resultado_consulta_sql" in payload:
+            sample = payload.get("resultado_consulta_sql") or ""
+            if isinstance(sample, str):
+                # Tabla compacta: la primera línea es el encabezado.
+                columns = sample.split("\n", 1)[0].split("|") if sample else []
+            else:
+                columns = list(sample[0].keys()) if sample and isinstance(sample[0], dict) else []
+            total = payload.get("filas_totales", "?")
+            digest = f"[Resultado anterior resumido: {total} filas en total; columnas: {', '.join(map(str, columns))}]"
+        elif len(content) > self.digest_chars:
+            digest = f"[Salida anterior de {message.name} resumida] {content[:self.digest_chars].rstrip()}…"
+        else:
+            return message
+        return ToolMessage(content=digest, tool_call_id=message.tool_call_id, name=message.name)
+
+    def build(self, history: List[BaseMessage]) -> List[BaseMessage]:
+        units = self._group_units(history)
+
+        # Número de turno (contado desde el final) de cada bloque; un turno empieza en un HumanMessage.
+        turns_from_end, turn = [], 0
+        for unit in reversed(units):
+            turns_from_end.append(turn)
+            if isinstance(unit[0], HumanMessage):
+                turn += 1
+        turns_from_end.reverse()
+
+        selected, used = [], 0
+        for unit, turn in zip(reversed(units), reversed(turns_from_end)):
+            if turn >= self.full_tool_output_turns:
+                unit = [self._digest(m) if isinstance(m, ToolMessage) else m for m in unit]
+            tokens = self.counter.count_messages(unit)
+            if used + tokens > self.token_budget:
+                break
+            selected.append(unit)
+            used += tokens
+
+        messages = [message for unit in reversed(selected) for message in unit]
+        # Empezar en el inicio de un turno para que el modelo no vea una respuesta sin su pregunta.
+        first_human = next((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), 0)
+        messages = messages[first_human:]
+
+        print(f"--- Historial: {len(history)} mensajes ({self.counter.count_messages(history)} tokens) -> "
+              f"{len(messages)} mensajes ({self.counter.count_messages(messages)} tokens, presupuesto {self.token_budget}) ---")
+        return messages
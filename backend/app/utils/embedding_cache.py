@@ -0,0 +1,25 @@
+import threading
+from typing import Optional
+
+from app import config
+from common.embedding_cache import EmbeddingCache
+
+
+# Instancia única por proceso. Vive en este módulo (importado siempre como `app.utils.embedding_cache`)
+# para que la compartan todos los clientes de embeddings, sin importar cómo se importe az_open_ai.
+_embedding_cache: Optional[EmbeddingCache] = None
+_embedding_cache_lock = threading.Lock()
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """Devuelve la caché de embeddings del proceso, o None si está deshabilitada."""
+    global _embedding_cache
+    if config.EMBEDDING_CACHE_ENABLED.lower() != "true":
+        return None
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache(
+                db_path=config.EMBEDDING_CACHE_PATH,
+                memory_items=int(config.EMBEDDING_CACHE_MEMORY_ITEMS),
+                max_disk_items=int(config.EMBEDDING_CACHE_MAX_DISK_ITEMS),
+            )
+    return _embedding_cache
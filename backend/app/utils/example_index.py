@@ -0,0 +1,143 @@
+import hashlib
+import math
+import sys, os
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from utils.az_ai_search import AzureIASearch
+
+
+class LocalExampleIndex:
+    """
+    Réplica en memoria del índice de ejemplos (`index_sqlagent`) para recuperación few-shot local.
+
+    Guarda los vectores `embedded_user_query` normalizados en una matriz NumPy (la similitud
+    coseno es un único producto matriz-vector) y un índice invertido BM25 sobre `user_query`.
+    Ambos rankings se combinan con Reciprocal Rank Fusion, igual que la búsqueda híbrida de
+    Azure AI Search, de modo que los puntajes quedan en la misma escala que los del índice remoto.
+
+    La réplica se identifica por el conjunto de hash ids de sus documentos (los mismos que
+    asigna `create_knowledge_base`), lo que permite sincronizarla con el índice remoto
+    descargando solo los documentos nuevos.
+    """
+
+    RRF_K = 60
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+
+    def __init__(self):
+        self._documents: Dict[str, dict] = {}
+        self._ids: List[str] = []
+        self._matrix: Optional[np.ndarray] = None
+        self._postings: Dict[str, List[tuple]] = {}
+        self._doc_lengths: Optional[np.ndarray] = None
+        self._avg_doc_length = 0.0
+        self.synced_at: Optional[float] = None
+        self.hits = 0
+
+    @staticmethod
+    def _tokenize(text: str) -> List[str]:
+        return AzureIASearch.normalize_text(text).split()
+
+    @property
+    def ready(self) -> bool:
+        return self._matrix is not None and len(self._ids) > 0
+
+    @property
+    def document_ids(self) -> set:
+        return set(self._documents)
+
+    def manifest_hash(self) -> str:
+        """Huella del conjunto de hash ids replicado; cambia si se añade o elimina algún ejemplo."""
+        return hashlib.sha256("\n".join(sorted(self._documents)).encode()).hexdigest()
+
+    def apply_changes(self, new_documents: List[dict], deleted_ids: List[str]):
+        """
+        Aplica los cambios del manifiesto (documentos nuevos y eliminados) y reconstruye las
+        estructuras. Los documentos deben traer `id`, `user_query`, `sql_query` y `embedded_user_query`.
+        """
+        documents = {doc_id: doc for doc_id, doc in self._documents.items() if doc_id not in set(deleted_ids)}
+        for doc in new_documents:
+            if doc.get("embedded_user_query"):
+                documents[doc["id"]] = doc
+        self._build(documents)
+        self.synced_at = time.time()
+
+    def _build(self, documents: Dict[str, dict]):
+        ids = list(documents)
+        if not ids:
+            self._documents, self._ids, self._matrix = documents, ids, None
+            self._postings, self._doc_lengths, self._avg_doc_length = {}, None, 0.0
+            return
+
+        matrix = np.asarray([documents[i]["embedded_user_query"] for i in ids], dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms == 0, 1, norms)
+
+        postings = defaultdict(list)
+        doc_lengths = np.zeros(len(ids), dtype=np.float32)
+        for position, doc_id in enumerate(ids):
+            tokens = self._tokenize(documents[doc_id].get("user_query") or "")
+            doc_lengths[position] = len(tokens)
+            for term, frequency in Counter(tokens).items():
+                postings[term].append((position, frequency))
+
+        # Se publica todo de una vez para que una búsqueda concurrente vea un estado consistente.
+        self._documents, self._ids, self._matrix = documents, ids, matrix
+        self._postings, self._doc_lengths = dict(postings), doc_lengths
+        self._avg_doc_length = float(doc_lengths.mean()) or 1.0
+
+    def _bm25_scores(self, query_text: str, doc_lengths: np.ndarray, postings: dict) -> np.ndarray:
+        scores = np.zeros(len(doc_lengths), dtype=np.float32)
+        num_docs = len(doc_lengths)
+        length_norm = self.BM25_K1 * (1 - self.BM25_B + self.BM25_B * doc_lengths / self._avg_doc_length)
+        for term in set(self._tokenize(query_text)):
+            term_postings = postings.get(term)
+            if not term_postings:
+                continue
+            idf = math.log(1 + (num_docs - len(term_postings) + 0.5) / (len(term_postings) + 0.5))
+            for position, frequency in term_postings:
+                scores[position] += idf * frequency * (self.BM25_K1 + 1) / (frequency + length_norm[position])
+        return scores
+
+    def search(self, query_text: str, query_vector: List[float], top_k: int = 10) -> List[dict]:
+        """Búsqueda híbrida local: coseno + BM25 fusionados por RRF sobre los `top_k` de cada ranking."""
+        ids, matrix, postings, doc_lengths = self._ids, self._matrix, self._postings, self._doc_lengths
+        if matrix is None:
+            return []
+
+        vector = np.asarray(query_vector, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        cosine = matrix @ vector
+        bm25 = self._bm25_scores(query_text, doc_lengths, postings)
+
+        fused = defaultdict(float)
+        for ranking in (np.argsort(-cosine)[:top_k], [p for p in np.argsort(-bm25)[:top_k] if bm25[p] > 0]):
+            for rank, position in enumerate(ranking, start=1):
+                fused[int(position)] += 1.0 / (self.RRF_K + rank)
+
+        self.hits += 1
+        results = []
+        for position, score in sorted(fused.items(), key=lambda item: item[1], reverse=True)[:top_k]:
+            doc = self._documents[ids[position]]
+            results.append({
+                "user_query": doc.get("user_query"),
+                "sql_query": doc.get("sql_query"),
+                "score": score,
+            })
+        return results
+
+    def stats(self) -> dict:
+        return {
+            "documents": len(self._ids),
+            "dimensions": int(self._matrix.shape[1]) if self._matrix is not None else 0,
+            "vocabulary": len(self._postings),
+            "manifest_hash": self.manifest_hash(),
+            "synced_at": self.synced_at,
+            "local_searches": self.hits,
+        }
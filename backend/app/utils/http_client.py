@@ -0,0 +1,34 @@
+from typing import Optional
+
+import httpx
+
+from app import config
+
+_async_client: Optional[httpx.AsyncClient] = None
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """
+    Cliente HTTP asíncrono compartido por el proceso para Azure OpenAI (modelo de chat y embeddings).
+    Un único pool keep-alive reutiliza las conexiones TLS entre turnos y acota las conexiones
+    simultáneas contra Azure con AZURE_HTTP_MAX_CONNECTIONS.
+    """
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=int(config.AZURE_HTTP_MAX_CONNECTIONS),
+                max_keepalive_connections=int(config.AZURE_HTTP_MAX_CONNECTIONS),
+                keepalive_expiry=120,
+            ),
+            timeout=httpx.Timeout(60.0, connect=5.0),
+        )
+    return _async_client
+
+
+async def close_async_http_client():
+    """Cierra el pool compartido. Se invoca al apagar la aplicación."""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
@@ -0,0 +1,98 @@
+import functools
+import inspect
+import random
+import time
+from contextlib import contextmanager
+from typing import Any, Callable
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+
+from app import config
+
+# Cubetas en segundos: desde lecturas puntuales de Cosmos DB hasta consultas largas en el warehouse.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+NODE_LATENCY = Histogram(
+    "sql_agent_graph_node_seconds", "Duración de cada nodo del grafo del agente.",
+    ["node", "status"], buckets=LATENCY_BUCKETS,
+)
+LLM_LATENCY = Histogram(
+    "sql_agent_llm_call_seconds", "Duración de cada llamada al modelo de chat.",
+    ["model", "status"], buckets=LATENCY_BUCKETS,
+)
+LLM_FIRST_TOKEN = Histogram(
+    "sql_agent_llm_first_token_seconds", "Tiempo hasta el primer fragmento de la respuesta del modelo.",
+    ["model"], buckets=LATENCY_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "sql_agent_llm_tokens_total", "Tokens consumidos por las llamadas al modelo de chat.",
+    ["model", "kind"],
+)
+TOOL_LATENCY = Histogram(
+    "sql_agent_tool_seconds", "Duración de cada herramienta del agente (incluye reintentos).",
+    ["tool", "status"], buckets=LATENCY_BUCKETS,
+)
+DEPENDENCY_LATENCY = Histogram(
+    "sql_agent_dependency_seconds", "Duración de las operaciones contra servicios externos.",
+    ["dependency", "operation", "status"], buckets=LATENCY_BUCKETS,
+)
+
+
+@contextmanager
+def observe(histogram: Histogram, **labels):
+    """Mide el bloque y lo registra en `histogram` con `status` = ok / error."""
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        histogram.labels(status=status, **labels).observe(time.perf_counter() - start)
+
+
+def timed(histogram: Histogram, **labels):
+    """Decorador equivalente a `observe` para funciones síncronas y asíncronas."""
+    def decorator(func: Callable):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with observe(histogram, **labels):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with observe(histogram, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_llm_usage(model: str, usage: dict | None):
+    """Acumula los tokens de entrada y salida que reporta la respuesta del modelo (`usage_metadata`)."""
+    for kind in ("input_tokens", "output_tokens"):
+        if usage and usage.get(kind):
+            LLM_TOKENS.labels(model=model, kind=kind).inc(usage[kind])
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """Exposición en formato de texto de Prometheus y su content type."""
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+# --- Registro de cargas voluminosas (estado, respuestas del modelo, SQL) ---
+
+_PAYLOAD_LOGGING = config.LOG_LEVEL.upper() == "DEBUG"
+_PAYLOAD_SAMPLE_RATE = float(config.LOG_PAYLOAD_SAMPLE_RATE)
+
+
+def log_payload(label: str, build: Callable[[], Any]):
+    """
+    Imprime una carga voluminosa solo con LOG_LEVEL=DEBUG y para una fracción muestreada de las
+    llamadas. `build` se evalúa solo si se va a imprimir, para no pagar el formateo en el camino
+    crítico.
+    """
+    if _PAYLOAD_LOGGING and random.random() < _PAYLOAD_SAMPLE_RATE:
+        print(f"--- {label} --- {build()}")
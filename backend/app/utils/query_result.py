@@ -0,0 +1,129 @@
+import json
+import pyarrow as pa
+import pyarrow.compute as pc
+from typing import Any, Dict, List, Optional
+
+
+def _plain_value(value: Any, value_type: pa.DataType) -> Any:
+    """Valor Python de una celda anidada con los MAP como objetos, listo para `json.dumps`."""
+    if value is None:
+        return None
+    if pa.types.is_map(value_type):
+        return {str(key): _plain_value(item, value_type.item_type) for key, item in value}
+    if pa.types.is_list(value_type) or pa.types.is_large_list(value_type) or pa.types.is_fixed_size_list(value_type):
+        return [_plain_value(item, value_type.value_type) for item in value]
+    if pa.types.is_struct(value_type):
+        return {field.name: _plain_value(value[field.name], field.type) for field in value_type}
+    return value
+
+
+def csv_compatible(table: pa.Table) -> pa.Table:
+    """
+    El escritor CSV de Arrow no admite columnas anidadas (ARRAY, STRUCT, MAP de Databricks):
+    se serializan como texto JSON. Las demás columnas no se tocan.
+    """
+    if not any(pa.types.is_nested(field.type) for field in table.schema):
+        return table
+    columns = []
+    for field, column in zip(table.schema, table.columns):
+        if pa.types.is_nested(field.type):
+            column = pa.array(
+                [None if value is None else json.dumps(_plain_value(value, field.type), ensure_ascii=False, default=str)
+                 for value in column.to_pylist()],
+                type=pa.string(),
+            )
+        columns.append(column)
+    return pa.table(columns, names=table.column_names)
+
+
+class QueryResult:
+    """
+    Resultado de una consulta de Databricks respaldado por una tabla de Apache Arrow.
+
+    Es el único objeto que comparten todos los consumidores del resultado (exportación CSV,
+    muestra para el LLM, muestra para el frontend y conteo de filas). La conversión de tipos
+    no serializables en JSON (fechas, timestamps, Decimals) se hace una sola vez y de forma
+    vectorizada sobre las columnas, en lugar de celda por celda.
+    """
+
+    def __init__(self, table: pa.Table, total_rows: Optional[int] = None):
+        """
+        Args:
+            table (pa.Table): Tabla de Arrow con las filas disponibles en memoria.
+            total_rows (int, opcional): Total de filas de la consulta cuando `table` solo
+                contiene una parte del resultado (por ejemplo, al exportar por streaming).
+        """
+        self.table = table
+        self._total_rows = total_rows
+        self._json_table = None
+
+    @property
+    def columns(self) -> List[str]:
+        return self.table.column_names
+
+    @property
+    def num_rows(self) -> int:
+        return self._total_rows if self._total_rows is not None else self.table.num_rows
+
+    @staticmethod
+    def _to_json_compatible(column: pa.ChunkedArray) -> pa.ChunkedArray:
+        """Convierte una columna completa a un tipo serializable en JSON."""
+        column_type = column.type
+        if pa.types.is_timestamp(column_type):
+            return pc.strftime(column, format="%Y-%m-%dT%H:%M:%S")
+        if pa.types.is_date(column_type) or pa.types.is_time(column_type):
+            return column.cast(pa.string())
+        if pa.types.is_decimal(column_type):
+            return column.cast(pa.float64())
+        return column
+
+    def _json_ready(self) -> pa.Table:
+        """Tabla con los tipos ya convertidos; se calcula una única vez por resultado."""
+        if self._json_table is None:
+            self._json_table = pa.table(
+                [self._to_json_compatible(column) for column in self.table.columns],
+                names=self.columns,
+            )
+        return self._json_table
+
+    def _head(self, limit: Optional[int]) -> pa.Table:
+        table = self._json_ready()
+        return table if limit is None else table.slice(0, limit)
+
+    def head_records(self, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Devuelve las primeras `limit` filas como diccionarios columna -> valor."""
+        return self._head(limit).to_pylist()
+
+    def head_rows(self, limit: Optional[int] = None) -> List[List[Any]]:
+        """Devuelve las primeras `limit` filas como listas de valores en el orden de `columns`."""
+        head = self._head(limit)
+        return [list(row) for row in zip(*(column.to_pylist() for column in head.columns))]
+
+
+class QueryResultHead:
+    """
+    Acumula solo las primeras `limit` filas de un stream de lotes Arrow.
+
+    Permite construir las muestras para el LLM y el frontend mientras el resultado completo
+    se exporta por streaming, sin retener en memoria más filas de las necesarias.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._tables = []
+        self._rows = 0
+
+    def add(self, batch: pa.Table):
+        if self._tables and self._rows >= self.limit:
+            return
+        remaining = self.limit - self._rows
+        # `take` copia las filas, para no retener el lote completo detrás de un slice.
+        head = batch if batch.num_rows <= remaining else batch.take(list(range(remaining)))
+        self._tables.append(head)
+        self._rows += head.num_rows
+
+    def to_result(self, total_rows: int) -> QueryResult:
+        """Devuelve un QueryResult con las filas retenidas y el conteo total del stream."""
+        if not self._tables:
+            return QueryResult(pa.table({}), total_rows=total_rows)
+        return QueryResult(pa.concat_tables(self._tables), total_rows=total_rows)
@@ -0,0 +1,148 @@
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# Literales de texto e identificadores entre comillas invertidas: se conservan tal cual al canonizar.
+_QUOTED = re.compile(r"('(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`)")
+_TABLE_IDENTIFIER = re.compile(r"`[^`]+`\.[\w-]+\.[\w-]+")
+
+
+def canonicalize_sql(sql_query: str) -> str:
+    """
+    Forma canónica de una consulta ya saneada: espacios colapsados y palabras clave/identificadores
+    en minúsculas fuera de los literales, sin `;` final. Dos consultas que solo difieren en
+    formato comparten la misma entrada de caché.
+    """
+    parts = _QUOTED.split(sql_query.strip().rstrip(';').strip())
+    canonical = []
+    for i, part in enumerate(parts):
+        # Las posiciones impares son los fragmentos entre comillas capturados por el split.
+        canonical.append(part if i % 2 else " ".join(part.split()).lower())
+    return "".join(canonical)
+
+
+def referenced_tables(sql_query: str) -> List[str]:
+    """Identificadores completos (`catálogo`.esquema.tabla) referenciados por una consulta saneada."""
+    return sorted(set(_TABLE_IDENTIFIER.findall(sql_query)))
+
+
+@dataclass
+class CachedResultSet:
+    """Todo lo que produce una ejecución de `execute_databricks_query`, listo para reutilizarse."""
+    total_rows: int
+    agent_sample: List[Dict[str, Any]]
+    columns: List[str]
+    download_url: str
+    result_format: str
+    artifact: dict
+    session_id: str
+    message_id: str
+    table_versions: Dict[str, Optional[int]] = field(default_factory=dict)
+    created_at: float = field(default_factory=time.monotonic)
+    hits: int = 0
+
+
+class ResultSetCache:
+    """
+    Caché de resultados por SQL canónico (y formato de exportación solicitado).
+
+    Una entrada guarda el conteo de filas, la muestra para el LLM, el blob ya exportado y el
+    mensaje cuya muestra para el frontend quedó guardada en Cosmos DB, de modo que repetir la
+    consulta no vuelve a tocar el warehouse, el Storage ni a escribir la muestra. Caduca por TTL
+    y cuando cambia la versión Delta de cualquiera de las tablas que referencia; las consultas sin
+    tablas totalmente calificadas no se cachean porque no se pueden invalidar.
+
+    Las versiones de una entrada se toman antes de ejecutar la consulta (`snapshot_versions`,
+    forzadas), así que un commit que llegue durante la ejecución invalida la entrada en vez de
+    quedar oculto. Al leer, la versión se comprueba con una antigüedad máxima de
+    `version_check_seconds` (corta, independiente de la de la caché de esquema).
+    """
+
+    def __init__(self, ttl_seconds: float, max_entries: int,
+                 version_loader: Callable[[str, float], Awaitable[Optional[int]]],
+                 version_check_seconds: float = 0.0):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.version_check_seconds = version_check_seconds
+        self._version_loader = version_loader
+        self._entries: "OrderedDict[str, CachedResultSet]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(sql_query: str, result_format: str = "") -> str:
+        return hashlib.sha256(f"{result_format or ''}\x00{canonicalize_sql(sql_query)}".encode("utf-8")).hexdigest()
+
+    async def _versions(self, tables: List[str], max_age: float) -> Dict[str, Optional[int]]:
+        return {table: await self._version_loader(table, max_age) for table in tables}
+
+    async def snapshot_versions(self, sql_query: str) -> Dict[str, Optional[int]]:
+        """Versiones actuales (forzadas) de las tablas de la consulta; se toman antes de ejecutarla."""
+        return await self._versions(referenced_tables(sql_query), max_age=0)
+
+    async def get(self, key: str) -> Optional[CachedResultSet]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if time.monotonic() - entry.created_at > self.ttl_seconds or \
+                await self._versions(list(entry.table_versions), self.version_check_seconds) != entry.table_versions:
+            # Durante la espera otra consulta pudo retirar la entrada o un `put` reemplazarla por una vigente.
+            if self._entries.get(key) is entry:
+                self._entries.pop(key, None)
+                self.invalidations += 1
+            self.misses += 1
+            return None
+        if self._entries.get(key) is not entry:
+            self.misses += 1
+            return None
+        entry.hits += 1
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, entry: CachedResultSet, table_versions: Dict[str, Optional[int]]) -> bool:
+        """
+        Guarda la entrada con las versiones tomadas antes de ejecutar la consulta
+        (`snapshot_versions`). Sin tablas versionables no se cachea. Devuelve si se cacheó.
+        """
+        if not table_versions:
+            return False
+        entry.table_versions = dict(table_versions)
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return True
+
+    def evict_message(self, session_id: str, message_id: str) -> int:
+        """
+        Retira las entradas cuyo resultado en Cosmos DB es el de (session_id, message_id). Se llama
+        antes de reescribir ese resultado (otra consulta del mismo turno), para que ninguna entrada
+        ni alias nuevo apunte a la muestra de otra consulta. Devuelve cuántas se retiraron.
+        """
+        keys = [key for key, entry in self._entries.items()
+                if entry.session_id == session_id and entry.message_id == message_id]
+        for key in keys:
+            del self._entries[key]
+        self.invalidations += len(keys)
+        return len(keys)
+
+    def record_bypass(self):
+        self.bypasses += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "bypasses": self.bypasses,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,111 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+class _CacheEntry:
+    def __init__(self, value: Any, table: Optional[str], version: Optional[int]):
+        self.value = value
+        self.table = table
+        self.version = version
+        self.loaded_at = time.monotonic()
+
+
+class SchemaCache:
+    """
+    Caché en memoria para metadatos de esquema (DESCRIBE TABLE, SHOW TABLES).
+
+    Cada entrada expira tras `ttl_seconds`. Además, si la entrada está asociada a una tabla,
+    se invalida cuando cambia su versión Delta (último `version` de DESCRIBE HISTORY). Esa
+    versión se consulta como mucho una vez cada `version_check_seconds` por tabla, de modo que
+    la mayoría de los turnos no hacen ningún viaje al warehouse para obtener el esquema.
+    """
+
+    def __init__(self, ttl_seconds: float, version_check_seconds: float,
+                 version_loader: Callable[[str], Awaitable[Optional[int]]]):
+        self.ttl_seconds = ttl_seconds
+        self.version_check_seconds = version_check_seconds
+        self._version_loader = version_loader
+        self._entries: Dict[str, _CacheEntry] = {}
+        self._table_versions: Dict[str, tuple] = {}  # tabla -> (versión, instante de la comprobación)
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.version_checks = 0
+
+    async def _current_version(self, table: str, force: bool = False, max_age: Optional[float] = None) -> Optional[int]:
+        """
+        Versión Delta de la tabla, reutilizando la última comprobación si tiene menos de `max_age`
+        segundos (por defecto `version_check_seconds`).
+        """
+        cached = self._table_versions.get(table)
+        max_age = self.version_check_seconds if max_age is None else max_age
+        if cached and not force and time.monotonic() - cached[1] < max_age:
+            return cached[0]
+        self.version_checks += 1
+        try:
+            version = await self._version_loader(table)
+        except Exception as e:
+            # Sin versión disponible seguimos con la última conocida y dependemos solo del TTL.
+            print(f"--- No se pudo obtener la versión de la tabla {table}: {e} ---")
+            version = cached[0] if cached else None
+        self._table_versions[table] = (version, time.monotonic())
+        return version
+
+    async def table_version(self, table: str, max_age: Optional[float] = None) -> Optional[int]:
+        """
+        Versión Delta conocida de la tabla. Por defecto con la misma limitación de frecuencia que
+        las entradas; `max_age` la acota (0 fuerza la consulta al warehouse).
+        """
+        return await self._current_version(table, max_age=max_age)
+
+    def _is_fresh(self, entry: _CacheEntry) -> bool:
+        return time.monotonic() - entry.loaded_at < self.ttl_seconds
+
+    async def get(self, key: str, loader: Callable[[], Awaitable[Any]], table: Optional[str] = None) -> Any:
+        """
+        Devuelve el valor cacheado para `key` o lo carga con `loader` si no existe, expiró
+        o la versión de `table` cambió desde que se cargó.
+        """
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_fresh(entry):
+                if table is None or await self._current_version(table) == entry.version:
+                    self.hits += 1
+                    return entry.value
+                self.invalidations += 1
+                print(f"--- Caché de esquema: la tabla {table} cambió de versión, se recarga '{key}' ---")
+
+            self.misses += 1
+            version = await self._current_version(table, force=True) if table else None
+            value = await loader()
+            self._entries[key] = _CacheEntry(value, table, version)
+            return value
+
+    def invalidate(self, table: Optional[str] = None):
+        """Elimina las entradas de una tabla, o todas si no se indica ninguna."""
+        if table is None:
+            removed = len(self._entries)
+            self._entries.clear()
+            self._table_versions.clear()
+        else:
+            keys = [k for k, e in self._entries.items() if e.table == table]
+            for k in keys:
+                del self._entries[k]
+            self._table_versions.pop(table, None)
+            removed = len(keys)
+        self.invalidations += removed
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "version_checks": self.version_checks,
+            "table_versions": {t: v for t, (v, _) in self._table_versions.items()},
+        }
@@ -0,0 +1,111 @@
+import asyncio
+import json
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+
+class SpeculativeToolCalls:
+    """
+    Despacho anticipado de llamadas a herramientas mientras el modelo sigue generando.
+
+    Al recibir los fragmentos en streaming, cada llamada cuyo nombre esté en `tool_names` se lanza
+    en cuanto sus argumentos forman un objeto JSON válido (un objeto solo es válido una vez cerrado).
+    El nodo de herramientas recoge después la tarea por `tool_call_id` en lugar de volver a
+    ejecutarla. Los ids de las llamadas son únicos, así que un solo registro sirve a todas las
+    conversaciones concurrentes.
+
+    Solo deben registrarse herramientas sin efectos secundarios: una tarea cancelada (argumentos
+    distintos en el mensaje final o ejecución abortada) no deshace lo que ya hizo. Cada tarea queda
+    asociada a su ejecución del grafo (`run_key`); `run_scope` cancela al terminar la ejecución las
+    que nadie recogió (límite de recursión, cliente de /chat/stream desconectado).
+    """
+
+    def __init__(self, tool_names: Iterable[str], dispatch: Callable[[dict], Awaitable[Any]], enabled: bool = True):
+        self.tool_names = frozenset(tool_names)
+        self._dispatch = dispatch
+        self.enabled = enabled
+        # tool_call_id -> (argumentos tal como los generó el modelo, tarea, ejecución del grafo)
+        self._pending: dict[str, tuple[dict, asyncio.Task, Any]] = {}
+        self.dispatched = 0
+        self.confirmed = 0
+        self.discarded = 0
+
+    def observe(self, tool_call_chunks: list, prepare: Callable[[dict], dict], run_key: Any = None) -> list[str]:
+        """
+        Revisa los fragmentos de llamadas ya agregados (`AIMessageChunk.tool_call_chunks`) y lanza
+        las llamadas completas que aún no se hayan despachado. `prepare` recibe la llamada tal como
+        la generó el modelo y devuelve la que se ejecutará (p. ej. con argumentos de sesión).
+        `run_key` identifica la ejecución del grafo (ver `run_scope`).
+        Devuelve los ids despachados en esta pasada.
+        """
+        if not self.enabled:
+            return []
+        started = []
+        for chunk in tool_call_chunks or []:
+            call_id, name, raw_args = chunk.get("id"), chunk.get("name"), chunk.get("args") or ""
+            if not call_id or name not in self.tool_names or call_id in self._pending:
+                continue
+            # Evita intentar el parseo en cada token de un SQL largo: un objeto cerrado termina en "}".
+            if not raw_args.rstrip().endswith("}"):
+                continue
+            try:
+                args = json.loads(raw_args)
+            except json.JSONDecodeError:
+                continue
+            if not isinstance(args, dict):
+                continue
+            call = {"name": name, "args": args, "id": call_id, "type": "tool_call"}
+            task = asyncio.create_task(self._dispatch(prepare(dict(call, args=dict(args)))))
+            self._pending[call_id] = (args, task, run_key)
+            self.dispatched += 1
+            started.append(call_id)
+        return started
+
+    def confirm(self, tool_calls: list, dispatched_ids: Iterable[str]):
+        """
+        Contrasta las llamadas despachadas con el mensaje final del modelo y cancela las que no
+        coinciden (otro nombre o argumentos distintos), para que se ejecuten de forma normal.
+        """
+        final_calls = {call.get("id"): call for call in tool_calls or []}
+        for call_id in dispatched_ids:
+            call = final_calls.get(call_id)
+            args = self._pending[call_id][0]
+            if call is None or call["name"] not in self.tool_names or call["args"] != args:
+                self._drop(call_id)
+
+    def take(self, call_id: str) -> Optional[asyncio.Task]:
+        """Entrega (y retira del registro) la tarea anticipada de una llamada, si existe."""
+        entry = self._pending.pop(call_id, None)
+        if entry is None:
+            return None
+        self.confirmed += 1
+        return entry[1]
+
+    def discard(self, call_ids: Iterable[str]):
+        """Cancela las llamadas anticipadas cuyo turno no llegó al nodo de herramientas (p. ej. por un error)."""
+        for call_id in call_ids:
+            if call_id in self._pending:
+                self._drop(call_id)
+
+    def _drop(self, call_id: str):
+        task = self._pending.pop(call_id)[1]
+        task.cancel()
+        self.discarded += 1
+
+    @contextmanager
+    def run_scope(self, run_key: Any):
+        """Envuelve una ejecución del grafo y cancela al salir las tareas suyas que nadie recogió."""
+        try:
+            yield
+        finally:
+            self.discard([call_id for call_id, entry in list(self._pending.items()) if entry[2] == run_key])
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "tools": sorted(self.tool_names),
+            "dispatched": self.dispatched,
+            "confirmed": self.confirmed,
+            "discarded": self.discarded,
+            "pending": len(self._pending),
+        }
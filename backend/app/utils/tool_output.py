@@ -0,0 +1,66 @@
+import json
+from typing import Any, Dict, Iterable, List, Sequence
+
+from app.utils.context_builder import TokenCounter
+
+SEPARATOR = "|"
+
+
+def _cell(value: Any) -> str:
+    """Celda de una tabla compacta: sin saltos de línea ni separadores que rompan la fila."""
+    if value is None:
+        return ""
+    return str(value).replace("\n", " ").replace(SEPARATOR, "/")
+
+
+def encode_table(columns: Sequence[str], rows: Iterable[Sequence[Any]]) -> str:
+    """
+    Tabla compacta para el LLM: encabezado en la primera línea y una fila por línea, con `|`
+    como separador. Frente a una lista de diccionarios o una tabla Markdown no repite los nombres
+    de columna por fila ni añade bordes o líneas de alineación.
+    """
+    lines = [SEPARATOR.join(_cell(c) for c in columns)]
+    lines.extend(SEPARATOR.join(_cell(v) for v in row) for row in rows)
+    return "\n".join(lines)
+
+
+def encode_records(records: List[Dict[str, Any]], columns: Sequence[str] = None) -> str:
+    """Tabla compacta a partir de registros columna -> valor."""
+    columns = list(columns) if columns is not None else (list(records[0].keys()) if records else [])
+    return encode_table(columns, ([record.get(c) for c in columns] for record in records))
+
+
+def encode_json(payload: Any) -> str:
+    """JSON sin indentación ni espacios."""
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+class ToolTokenReport:
+    """
+    Compara los tokens de cada salida de herramienta en su codificación compacta con los que
+    tendría en el formato anterior (JSON indentado / Markdown), acumulando el total por herramienta.
+    """
+
+    def __init__(self, counter: TokenCounter):
+        self.counter = counter
+        self._tools: Dict[str, Dict[str, int]] = {}
+
+    def record(self, tool_name: str, before_text: str, after_text: str):
+        before = self.counter.count_text(before_text)
+        after = self.counter.count_text(after_text)
+        totals = self._tools.setdefault(tool_name, {"calls": 0, "tokens_before": 0, "tokens_after": 0})
+        totals["calls"] += 1
+        totals["tokens_before"] += before
+        totals["tokens_after"] += after
+        saving = 100 * (1 - after / before) if before else 0.0
+        print(f"--- Tokens de '{tool_name}': {before} -> {after} ({saving:.0f}% menos) ---")
+
+    def stats(self) -> dict:
+        report = {}
+        for tool_name, totals in self._tools.items():
+            before, after = totals["tokens_before"], totals["tokens_after"]
+            report[tool_name] = {
+                **totals,
+                "saving_ratio": round(1 - after / before, 4) if before else 0.0,
+            }
+        return report
@@ -0,0 +1,91 @@
+import sys, os
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from utils.az_ai_search import AzureIASearch
+
+
+class TrigramValueIndex:
+    """
+    Índice local de trigramas sobre las descripciones de los valores categóricos.
+
+    Normaliza los textos con las mismas reglas que la base de ejemplos
+    (`AzureIASearch.normalize_text`: minúsculas, sin tildes ni signos) y puntúa cada candidato
+    combinando el coeficiente de Dice entre trigramas con la fracción de trigramas del término
+    buscado que aparecen en la descripción. Así "chipichape" encuentra "OFICINA CHIPICHAPE".
+    """
+
+    def __init__(self):
+        # (columna de código, columna descriptiva, código, descripción, texto normalizado)
+        self._entries: List[Tuple[str, str, str, str, str]] = []
+        self._entry_trigrams: List[frozenset] = []
+        self._postings: Dict[str, List[int]] = defaultdict(list)
+
+    @staticmethod
+    def _trigrams(text: str) -> frozenset:
+        padded = f"  {text} "
+        return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+    def build(self, values: Dict[Tuple[str, str], Iterable[Tuple[str, str]]]):
+        """Reconstruye el índice a partir de {(columna código, columna descripción): [(código, descripción)]}."""
+        entries, entry_trigrams, postings = [], [], defaultdict(list)
+        for (code_column, desc_column), rows in values.items():
+            for code, description in rows:
+                normalized = AzureIASearch.normalize_text(description or "")
+                if not normalized:
+                    continue
+                trigrams = self._trigrams(normalized)
+                entry_id = len(entries)
+                entries.append((code_column, desc_column, code, description, normalized))
+                entry_trigrams.append(trigrams)
+                for trigram in trigrams:
+                    postings[trigram].append(entry_id)
+        self._entries, self._entry_trigrams, self._postings = entries, entry_trigrams, postings
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def search(self, term: str, columns: Optional[List[str]] = None, top_k: int = 5) -> List[dict]:
+        """
+        Devuelve los `top_k` valores cuya descripción mejor coincide con `term`.
+        `columns` restringe la búsqueda a pares cuya columna de código o descriptiva esté en la lista.
+        """
+        normalized = AzureIASearch.normalize_text(term)
+        if not normalized:
+            return []
+        query_trigrams = self._trigrams(normalized)
+        allowed = {c.strip('`').upper() for c in columns} if columns else None
+
+        # Solo se puntúan las entradas que comparten al menos un trigrama con el término.
+        shared = defaultdict(int)
+        for trigram in query_trigrams:
+            for entry_id in self._postings.get(trigram, ()):
+                shared[entry_id] += 1
+
+        scored = []
+        for entry_id, common in shared.items():
+            code_column, desc_column, code, description, entry_text = self._entries[entry_id]
+            if allowed and code_column.upper() not in allowed and desc_column.upper() not in allowed:
+                continue
+            if entry_text == normalized:
+                score = 1.0
+            else:
+                dice = 2 * common / (len(query_trigrams) + len(self._entry_trigrams[entry_id]))
+                coverage = common / len(query_trigrams)
+                score = 0.5 * dice + 0.5 * coverage
+            scored.append((score, entry_id))
+
+        scored.sort(key=lambda item: item[0], reverse=True)
+        results = []
+        for score, entry_id in scored[:top_k]:
+            code_column, desc_column, code, description, _ = self._entries[entry_id]
+            results.append({
+                "code_column": code_column,
+                "desc_column": desc_column,
+                "code": code,
+                "description": description,
+                "score": round(score, 3),
+            })
+        return results
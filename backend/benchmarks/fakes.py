@@ -0,0 +1,425 @@
+"""
+Sustitutos locales de los servicios externos del agente para el benchmark de /chat.
+
+Cada fake reproduce solo la superficie que usa la aplicación (mismos nombres de método y
+formas de respuesta) y añade una latencia configurable, de modo que el código real de
+`graph.py`, `tools.py` y los servicios se ejerce completo sin salir del proceso.
+"""
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+import uuid
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pyarrow as pa
+from azure.cosmos import exceptions
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+
+class Latency:
+    """Latencia simulada: `ms` ± `jitter` (fracción), con un generador sembrado para repetir corridas."""
+
+    def __init__(self, ms: float, jitter: float = 0.0, seed: int = 0):
+        self.ms = ms
+        self.jitter = jitter
+        self._rng = random.Random(seed)
+
+    def seconds(self) -> float:
+        if self.ms <= 0:
+            return 0.0
+        return max(0.0, self.ms * (1 + self._rng.uniform(-self.jitter, self.jitter))) / 1000
+
+    async def wait(self):
+        delay = self.seconds()
+        if delay:
+            await asyncio.sleep(delay)
+
+    def block(self):
+        delay = self.seconds()
+        if delay:
+            time.sleep(delay)
+
+
+def fake_embedding(text: str, dimensions: int) -> List[float]:
+    """Vector determinista por texto: el mismo texto produce siempre el mismo embedding."""
+    seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16)
+    return np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32).tolist()
+
+
+# --- Modelo de chat guionizado ---
+
+class ScriptedChatModel(BaseChatModel):
+    """
+    Modelo de chat que sigue el guion del flujo normal del agente: si en el turno actual aún no
+    se ejecutó `execute_databricks_query`, pide ejecutarla con un SQL derivado de la pregunta;
+    si ya se ejecutó, redacta la respuesta final con `answer_chars` caracteres.
+    """
+
+    latency: Any = None
+    table_name: str = "`ia-foundation`.pilotos.ods_cliente"
+    result_rows: int = 100
+    answer_chars: int = 600
+    stream_chunk_chars: int = 20
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted-benchmark"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def _next_message(self, messages) -> AIMessage:
+        last_human = max((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=-1)
+        turn = messages[last_human + 1:]
+        executed = any(isinstance(m, ToolMessage) and m.name == "execute_databricks_query" for m in turn)
+        prompt_tokens = sum(len(str(m.content)) for m in messages) // 4
+        if not executed:
+            question = messages[last_human].content if last_human >= 0 else ""
+            segment = int(hashlib.sha256(question.encode("utf-8")).hexdigest()[:6], 16) % 1000
+            sql_query = f"SELECT * FROM {self.table_name} WHERE segmento = {segment} LIMIT {self.result_rows}"
+            return AIMessage(
+                content="",
+                tool_calls=[{
+                    "name": "execute_databricks_query",
+                    "args": {"sql_query": sql_query},
+                    "id": f"call_{hashlib.sha256((question + str(len(messages))).encode()).hexdigest()[:24]}",
+                }],
+                usage_metadata={"input_tokens": prompt_tokens, "output_tokens": 40, "total_tokens": prompt_tokens + 40},
+            )
+        answer = ("Según los resultados de la consulta, " + "el segmento muestra un comportamiento estable. " * 50)[:self.answer_chars]
+        output_tokens = len(answer) // 4
+        return AIMessage(
+            content=answer,
+            usage_metadata={"input_tokens": prompt_tokens, "output_tokens": output_tokens, "total_tokens": prompt_tokens + output_tokens},
+        )
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        if self.latency is not None:
+            self.latency.block()
+        return ChatResult(generations=[ChatGeneration(message=self._next_message(messages))])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        if self.latency is not None:
+            await self.latency.wait()
+        return ChatResult(generations=[ChatGeneration(message=self._next_message(messages))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        # La latencia se paga antes del primer token, como el tiempo hasta el primer byte del servicio real.
+        if self.latency is not None:
+            await self.latency.wait()
+        message = self._next_message(messages)
+        if message.tool_calls:
+            chunk = AIMessageChunk(content="", tool_call_chunks=[
+                {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": i}
+                for i, call in enumerate(message.tool_calls)
+            ], usage_metadata=message.usage_metadata)
+            yield ChatGenerationChunk(message=chunk)
+            return
+        text = message.content
+        for start in range(0, len(text), self.stream_chunk_chars):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text[start:start + self.stream_chunk_chars]))
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=message.usage_metadata))
+
+
+# --- Warehouse de Databricks ---
+
+BENCHMARK_COLUMNS = [
+    ("id_cliente", "bigint", "Identificador único del cliente"),
+    ("nombre", "string", "Nombre completo del cliente"),
+    ("cod_segmento", "int", "Código del segmento del cliente"),
+    ("desc_segmento", "string", "Descripción del segmento, asociada a cod_segmento"),
+    ("saldo", "double", "Saldo total de los productos del cliente"),
+    ("fecha_apertura", "string", "Fecha de apertura de la primera cuenta"),
+]
+
+
+class FakeWarehouse:
+    """
+    Warehouse en memoria que responde con tablas Arrow a las consultas que hace la aplicación:
+    DESCRIBE TABLE, DESCRIBE HISTORY, SHOW TABLES, SELECT DISTINCT (diccionario de valores) y
+    las consultas del agente, que devuelven `rows` filas sintéticas (tamaño de payload configurable).
+    """
+
+    def __init__(self, latency: Latency, rows: int = 100, segments: int = 12):
+        self.latency = latency
+        self.rows = rows
+        self.segments = segments
+        self.queries = 0
+        self._result_table = self._build_result_table(rows)
+
+    def _build_result_table(self, rows: int) -> pa.Table:
+        ids = np.arange(rows, dtype=np.int64)
+        segments = (ids % self.segments).astype(np.int32)
+        return pa.table({
+            "id_cliente": ids,
+            "nombre": [f"Cliente {i}" for i in range(rows)],
+            "cod_segmento": segments,
+            "desc_segmento": [f"Segmento {s}" for s in segments],
+            "saldo": np.round(np.linspace(1000, 5_000_000, rows), 2),
+            "fecha_apertura": [f"20{10 + i % 15:02d}-{1 + i % 12:02d}-01" for i in range(rows)],
+        })
+
+    def answer(self, query: str) -> pa.Table:
+        self.queries += 1
+        normalized = " ".join(query.split()).upper()
+        if normalized.startswith("DESCRIBE HISTORY"):
+            return pa.table({"version": [1]})
+        if normalized.startswith("DESCRIBE TABLE"):
+            return pa.table({
+                "col_name": [c[0] for c in BENCHMARK_COLUMNS],
+                "data_type": [c[1] for c in BENCHMARK_COLUMNS],
+                "comment": [c[2] for c in BENCHMARK_COLUMNS],
+            })
+        if normalized.startswith("SHOW TABLES"):
+            return pa.table({"database": ["pilotos"], "tableName": ["ods_cliente"], "isTemporary": [False]})
+        if normalized.startswith("SELECT DISTINCT"):
+            return pa.table({
+                "code": [str(s) for s in range(self.segments)],
+                "description": [f"Segmento {s}" for s in range(self.segments)],
+            })
+        if normalized == "SELECT 1":
+            return pa.table({"1": [1]})
+        return self._result_table
+
+    def connect(self):
+        return FakeDatabricksConnection(self)
+
+
+class FakeDatabricksCursor:
+    def __init__(self, warehouse: FakeWarehouse):
+        self.warehouse = warehouse
+        self._table: Optional[pa.Table] = None
+        self._offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def execute(self, query: str):
+        self.warehouse.latency.block()
+        self._table = self.warehouse.answer(query)
+        self._offset = 0
+
+    def fetchall_arrow(self) -> pa.Table:
+        table, self._offset = self._table.slice(self._offset), self._table.num_rows
+        return table
+
+    def fetchall(self):
+        return self.fetchall_arrow().to_pylist()
+
+    def fetchmany_arrow(self, size: int) -> pa.Table:
+        table = self._table.slice(self._offset, size)
+        self._offset += table.num_rows
+        return table
+
+    def close(self):
+        self._table = None
+
+
+class FakeDatabricksConnection:
+    def __init__(self, warehouse: FakeWarehouse):
+        self.warehouse = warehouse
+
+    def cursor(self) -> FakeDatabricksCursor:
+        return FakeDatabricksCursor(self.warehouse)
+
+    def close(self):
+        pass
+
+
+# --- Cosmos DB ---
+
+class FakeCosmosContainer:
+    """Contenedor en memoria particionado por `sessionId` con upsert, lectura puntual y las consultas de la aplicación."""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self._items: Dict[str, Dict[str, dict]] = {}
+
+    def _store(self, body: dict) -> dict:
+        stored = {**body, "_etag": uuid.uuid4().hex}
+        self._items.setdefault(body["sessionId"], {})[body["id"]] = stored
+        return dict(stored)
+
+    async def upsert_item(self, body: dict) -> dict:
+        await self.latency.wait()
+        return self._store(body)
+
+    async def create_item(self, body: dict) -> dict:
+        await self.latency.wait()
+        if body["id"] in self._items.get(body["sessionId"], {}):
+            raise exceptions.CosmosResourceExistsError(status_code=409, message=f"{body['id']} ya existe")
+        return self._store(body)
+
+    async def replace_item(self, item: str, body: dict, etag: str = None, match_condition=None) -> dict:
+        await self.latency.wait()
+        current = self._items.get(body["sessionId"], {}).get(item)
+        if current is None:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message=f"{item} no existe")
+        if etag is not None and current["_etag"] != etag:
+            raise exceptions.CosmosAccessConditionFailedError(status_code=412, message=f"{item} cambió")
+        return self._store(body)
+
+    async def read_item(self, item: str, partition_key: str) -> dict:
+        await self.latency.wait()
+        found = self._items.get(partition_key, {}).get(item)
+        if found is None:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message=f"{item} no existe")
+        return dict(found)
+
+    def query_items(self, query: str, parameters: List[dict] = None, partition_key: str = None):
+        params = {p["name"]: p["value"] for p in (parameters or [])}
+        return self._query(query, params, partition_key)
+
+    async def _query(self, query: str, params: dict, partition_key: str):
+        await self.latency.wait()
+        items = list(self._items.get(partition_key, {}).values())
+        if "@msg_id" in params:
+            items = [i for i in items if i.get("messageId") == params["@msg_id"]]
+        if "IS_DEFINED(c.message_data)" in query:
+            items = [i for i in items if "message_data" in i]
+        if "ORDER BY c.timestamp DESC" in query:
+            items.sort(key=lambda i: i.get("timestamp", ""), reverse=True)
+        limit = re.search(r"LIMIT (\d+)", query)
+        if limit:
+            items = items[:int(limit.group(1))]
+        for item in items:
+            yield dict(item)
+
+
+# --- Blob Storage ---
+
+class FakeBlobDownloader:
+    def __init__(self, data: bytes, chunk_size: int = 4 * 1024 * 1024):
+        self._data = data
+        self._chunk_size = chunk_size
+
+    async def readall(self) -> bytes:
+        return self._data
+
+    async def chunks(self):
+        for start in range(0, len(self._data), self._chunk_size):
+            yield self._data[start:start + self._chunk_size]
+
+
+class FakeBlobClient:
+    def __init__(self, store: "FakeBlobServiceClient", name: str):
+        self._store = store
+        self._name = name
+        self._staged: Dict[str, bytes] = {}
+
+    async def stage_block(self, block_id: str, data: bytes, length: int = None):
+        await self._store.latency.wait()
+        self._staged[block_id] = bytes(data)
+
+    async def commit_block_list(self, blocks, content_settings=None):
+        await self._store.latency.wait()
+        self._store.blobs[self._name] = b"".join(self._staged[b.id] for b in blocks)
+        self._staged.clear()
+
+    async def upload_blob(self, data: bytes, overwrite: bool = False):
+        await self._store.latency.wait()
+        self._store.blobs[self._name] = bytes(data)
+
+    async def download_blob(self, offset: int = None, length: int = None) -> FakeBlobDownloader:
+        await self._store.latency.wait()
+        data = self._store.blobs[self._name]
+        if offset is not None:
+            data = data[offset:offset + length if length is not None else None]
+        return FakeBlobDownloader(data)
+
+    async def get_blob_properties(self) -> SimpleNamespace:
+        await self._store.latency.wait()
+        return SimpleNamespace(size=len(self._store.blobs[self._name]))
+
+
+class FakeBlobServiceClient:
+    """Cuenta de Blob Storage en memoria (un diccionario nombre -> bytes)."""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.blobs: Dict[str, bytes] = {}
+
+    def get_blob_client(self, container: str, blob: str) -> FakeBlobClient:
+        return FakeBlobClient(self, f"{container}/{blob}")
+
+    @property
+    def stored_bytes(self) -> int:
+        return sum(len(data) for data in self.blobs.values())
+
+
+# --- Azure AI Search y embeddings ---
+
+class FakeSearchResults:
+    def __init__(self, documents: List[dict]):
+        self._documents = documents
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for document in self._documents:
+            yield document
+
+
+class FakeSearchClient:
+    """Índice de ejemplos en memoria; atiende el manifiesto de ids, el filtro `search.in` y la búsqueda híbrida."""
+
+    def __init__(self, latency: Latency, documents: List[dict]):
+        self.latency = latency
+        self.documents = documents
+
+    async def search(self, search_text: str = "*", select: List[str] = None, filter: str = None,
+                     top: int = None, **kwargs) -> FakeSearchResults:
+        await self.latency.wait()
+        documents = self.documents
+        if filter:
+            ids = set(re.search(r"search\.in\(id, '([^']*)'", filter).group(1).split(","))
+            documents = [d for d in documents if d["id"] in ids]
+        documents = [
+            {**({k: d.get(k) for k in select} if select else d), "@search.score": 1.0}
+            for d in documents[:top or len(documents)]
+        ]
+        return FakeSearchResults(documents)
+
+    async def close(self):
+        pass
+
+
+def build_example_documents(count: int, dimensions: int) -> List[dict]:
+    """Ejemplos pregunta/SQL sintéticos con ids SHA-256 (como los del índice real) y su vector."""
+    documents = []
+    for i in range(count):
+        user_query = f"cuantos clientes hay en el segmento {i}"
+        documents.append({
+            "id": hashlib.sha256(user_query.encode("utf-8")).hexdigest(),
+            "user_query": user_query,
+            "sql_query": f"SELECT COUNT(*) FROM `ia-foundation`.pilotos.ods_cliente WHERE cod_segmento = {i}",
+            "embedded_user_query": fake_embedding(user_query, dimensions),
+        })
+    return documents
+
+
+class FakeAsyncOpenAI:
+    """Cliente de embeddings con la forma de `AsyncAzureOpenAI.embeddings.create`."""
+
+    def __init__(self, latency: Latency, dimensions: int):
+        self.latency = latency
+        self.dimensions = dimensions
+        self.embeddings = SimpleNamespace(create=self._create_embeddings)
+
+    async def _create_embeddings(self, input: List[str], model: str = None):
+        await self.latency.wait()
+        return SimpleNamespace(data=[SimpleNamespace(embedding=fake_embedding(text, self.dimensions)) for text in input])
+
+    async def close(self):
+        pass
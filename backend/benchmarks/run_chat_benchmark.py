@@ -0,0 +1,309 @@
+"""
+Benchmark de extremo a extremo de POST /chat sin servicios externos.
+
+Sustituye Azure OpenAI, Databricks, Cosmos DB, Blob Storage y Azure AI Search por los fakes de
+`benchmarks/fakes.py` (latencia y tamaño de payload configurables), lanza la aplicación real en
+proceso y la ejerce con la concurrencia indicada. Reporta latencias p50/p95/p99, throughput,
+desglose por etapa (a partir de los histogramas de `/metrics`) y RSS máximo, y guarda un JSON
+para comparar corridas.
+
+Uso (desde `backend/`):
+    python -m benchmarks.run_chat_benchmark --requests 200 --concurrency 16 --output bench.json
+    python -m benchmarks.run_chat_benchmark --baseline bench.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from typing import Dict, List
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark offline de /chat con servicios simulados.")
+    parser.add_argument("--requests", type=int, default=200, help="Peticiones medidas.")
+    parser.add_argument("--warmup", type=int, default=10, help="Peticiones de calentamiento (no se miden).")
+    parser.add_argument("--concurrency", type=int, default=8, help="Sesiones en paralelo.")
+    parser.add_argument("--turns-per-session", type=int, default=1, help="Turnos consecutivos por sesión (historial creciente).")
+    parser.add_argument("--distinct-questions", type=int, default=0,
+                        help="Preguntas distintas (0 = todas distintas). Valores bajos ejercitan las cachés de respuestas y resultados.")
+    parser.add_argument("--rows", type=int, default=1000, help="Filas que devuelve cada consulta del agente.")
+    parser.add_argument("--answer-chars", type=int, default=600, help="Longitud de la respuesta final del modelo.")
+    parser.add_argument("--examples", type=int, default=200, help="Documentos en el índice de ejemplos simulado.")
+    parser.add_argument("--embedding-dimensions", type=int, default=1536)
+    parser.add_argument("--llm-ms", type=float, default=800, help="Latencia por llamada al modelo de chat.")
+    parser.add_argument("--warehouse-ms", type=float, default=400, help="Latencia por consulta al warehouse.")
+    parser.add_argument("--cosmos-ms", type=float, default=8, help="Latencia por operación de Cosmos DB.")
+    parser.add_argument("--blob-ms", type=float, default=30, help="Latencia por operación de Blob Storage.")
+    parser.add_argument("--search-ms", type=float, default=60, help="Latencia por búsqueda en Azure AI Search.")
+    parser.add_argument("--embedding-ms", type=float, default=50, help="Latencia por embedding.")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Variación relativa (±) de las latencias simuladas.")
+    parser.add_argument("--seed", type=int, default=42, help="Semilla: misma semilla, mismas latencias y preguntas.")
+    parser.add_argument("--output", help="Archivo JSON donde guardar los resultados.")
+    parser.add_argument("--baseline", help="JSON de una corrida anterior contra el que comparar.")
+    parser.add_argument("--verbose", action="store_true", help="No silenciar los prints de la aplicación.")
+    return parser.parse_args(argv)
+
+
+def configure_environment(workdir: str):
+    """Credenciales ficticias y rutas locales aisladas, antes de importar la aplicación."""
+    os.environ.update({
+        "AZURE_OPENAI_API_KEY": "benchmark",
+        "AZURE_OPENAI_ENDPOINT": "https://benchmark.invalid",
+        "AZURE_OPENAI_API_VERSION": "2024-06-01",
+        "AZURE_OPENAI_EMBEDDING_NAME": "benchmark-embeddings",
+        "COSMOS_DB_ENDPOINT": "https://benchmark.invalid:443/",
+        "COSMOS_DB_KEY": "YmVuY2htYXJr",
+        "AZURE_STORAGE_ACCOUNT_URL": "https://benchmark.invalid",
+        "AZURE_STORAGE_SAS_TOKEN": "sv=benchmark",
+        "DATABRICKS_SERVER_HOSTNAME": "benchmark.invalid",
+        "DATABRICKS_HTTP_PATH": "/sql/benchmark",
+        "DATABRICKS_TOKEN": "benchmark",
+        "AZURE_SEARCH_ENDPOINT": "https://benchmark.invalid",
+        "AZURE_SEARCH_KEY": "benchmark",
+        "EMBEDDING_CACHE_PATH": os.path.join(workdir, "embedding_cache.sqlite"),
+        "VALUE_DICTIONARY_PATH": os.path.join(workdir, "value_dictionary.sqlite"),
+        "WRITE_BEHIND_JOURNAL_PATH": os.path.join(workdir, "write_behind_journal.jsonl"),
+        "TOOL_TOKEN_REPORT_ENABLED": "false",
+        "LOG_LEVEL": "INFO",
+    })
+    for name, default in (("CONVERSATION_HISTORY_WINDOW", "10"), ("RESULTS_LIMIT_FOR_THE_AGENT", "10"),
+                          ("RESULTS_LIMIT_FOR_THE_FRONTEND", "100")):
+        os.environ.setdefault(name, default)
+
+
+def install_fakes(args: argparse.Namespace) -> dict:
+    """Reemplaza los clientes externos de las instancias compartidas de la aplicación por los fakes."""
+    from benchmarks import fakes
+    from app import main
+    from app.agent import graph, tools
+
+    def latency(ms: float, offset: int) -> fakes.Latency:
+        return fakes.Latency(ms, args.jitter, seed=args.seed + offset)
+
+    warehouse = fakes.FakeWarehouse(latency(args.warehouse_ms, 1), rows=args.rows)
+    tools.databricks_service.pool._connect_factory = warehouse.connect
+
+    conversations = fakes.FakeCosmosContainer(latency(args.cosmos_ms, 2))
+    results = fakes.FakeCosmosContainer(latency(args.cosmos_ms, 3))
+    tools.cosmos_db_service.conversations_container = conversations
+    tools.cosmos_db_service.results_container = results
+
+    blobs = fakes.FakeBlobServiceClient(latency(args.blob_ms, 4))
+    for storage in {id(s): s for s in (tools.storage_service, main.storage_service)}.values():
+        storage.blob_service_client = blobs
+
+    search = tools.azure_search_service
+    search._openai_client = fakes.FakeAsyncOpenAI(latency(args.embedding_ms, 5), args.embedding_dimensions)
+    search._search_clients[search.local_index_name] = fakes.FakeSearchClient(
+        latency(args.search_ms, 6), fakes.build_example_documents(args.examples, args.embedding_dimensions)
+    )
+
+    graph.model = fakes.ScriptedChatModel(
+        latency=latency(args.llm_ms, 7), result_rows=args.rows, answer_chars=args.answer_chars
+    )
+    return {"warehouse": warehouse, "blobs": blobs, "conversations": conversations}
+
+
+# --- Métricas por etapa desde los histogramas de Prometheus ---
+
+def _histogram_totals() -> Dict[str, Dict[str, float]]:
+    """{"metrica{labels}": {"sum": s, "count": n}} de todos los histogramas de la aplicación."""
+    from prometheus_client import REGISTRY
+
+    totals = {}
+    for family in REGISTRY.collect():
+        if family.type != "histogram" or not family.name.startswith("sql_agent_"):
+            continue
+        for sample in family.samples:
+            if sample.name.endswith("_sum") or sample.name.endswith("_count"):
+                labels = ",".join(f"{k}={v}" for k, v in sorted(sample.labels.items()) if k != "status")
+                key = f"{family.name}{{{labels}}}"
+                field = "sum" if sample.name.endswith("_sum") else "count"
+                totals.setdefault(key, {"sum": 0.0, "count": 0.0})[field] += sample.value
+    return totals
+
+
+def stage_breakdown(before: dict, after: dict, measured_requests: int) -> List[dict]:
+    stages = []
+    for key, totals in after.items():
+        previous = before.get(key, {"sum": 0.0, "count": 0.0})
+        count = totals["count"] - previous["count"]
+        if count <= 0:
+            continue
+        seconds = totals["sum"] - previous["sum"]
+        stages.append({
+            "stage": key,
+            "calls": int(count),
+            "mean_ms": round(1000 * seconds / count, 2),
+            "ms_per_request": round(1000 * seconds / measured_requests, 2) if measured_requests else None,
+        })
+    return sorted(stages, key=lambda stage: stage["ms_per_request"] or 0, reverse=True)
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Percentil por rango más cercano (estable entre corridas, sin interpolación)."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+# --- Ejecución ---
+
+def question_for(index: int, distinct: int) -> str:
+    number = index % distinct if distinct else index
+    return f"cuantos clientes del segmento {number} tienen saldo mayor a un millon"
+
+
+async def run_sessions(client, args: argparse.Namespace, sessions: int, offset: int) -> List[dict]:
+    """Ejecuta `sessions` sesiones de `turns_per_session` turnos con `concurrency` sesiones simultáneas."""
+    semaphore = asyncio.Semaphore(args.concurrency)
+    samples = []
+
+    async def session(number: int):
+        async with semaphore:
+            session_id = f"bench-{offset + number:06d}"
+            for turn in range(args.turns_per_session):
+                question = question_for((offset + number) * args.turns_per_session + turn, args.distinct_questions)
+                started = time.perf_counter()
+                response = await client.post("/chat", json={
+                    "user_query": question, "session_id": session_id, "message_id": str(uuid.uuid4()),
+                })
+                samples.append({
+                    "latency_s": time.perf_counter() - started,
+                    "status": response.status_code,
+                    "turn": turn,
+                    "error": response.text[:500] if response.status_code != 200 else None,
+                })
+
+    await asyncio.gather(*(session(n) for n in range(sessions)))
+    return samples
+
+
+async def run_benchmark(args: argparse.Namespace, fakes_state: dict) -> dict:
+    import httpx
+    from app.main import app
+
+    sessions = max(1, args.requests // args.turns_per_session)
+    warmup_sessions = max(0, args.warmup // args.turns_per_session)
+
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+            if warmup_sessions:
+                await run_sessions(client, args, warmup_sessions, offset=10**5)
+            before = _histogram_totals()
+            started = time.perf_counter()
+            samples = await run_sessions(client, args, sessions, offset=0)
+            elapsed = time.perf_counter() - started
+            after = _histogram_totals()
+
+    latencies = sorted(s["latency_s"] for s in samples)
+    errors = sum(1 for s in samples if s["status"] != 200)
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "first_error": next((f"HTTP {s['status']}: {s['error']}" for s in samples if s["status"] != 200), None),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(samples) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(1000 * percentile(latencies, 50), 1),
+            "p95": round(1000 * percentile(latencies, 95), 1),
+            "p99": round(1000 * percentile(latencies, 99), 1),
+            "mean": round(1000 * sum(latencies) / len(latencies), 1) if latencies else 0.0,
+            "max": round(1000 * latencies[-1], 1) if latencies else 0.0,
+        },
+        "stages": stage_breakdown(before, after, len(samples)),
+        # ru_maxrss está en KiB en Linux y en bytes en macOS.
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1),
+        "warehouse_queries": fakes_state["warehouse"].queries,
+        "blob_bytes": fakes_state["blobs"].stored_bytes,
+    }
+
+
+def environment_info() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()}
+
+
+def print_report(result: dict, baseline: dict | None):
+    latency = result["latency_ms"]
+    print(f"\nPeticiones: {result['requests']} ({result['errors']} errores) en {result['elapsed_s']}s "
+          f"-> {result['throughput_rps']} req/s")
+    print(f"Latencia (ms): p50={latency['p50']} p95={latency['p95']} p99={latency['p99']} "
+          f"media={latency['mean']} máx={latency['max']}")
+    print(f"RSS máximo: {result['peak_rss_mb']} MB | consultas al warehouse: {result['warehouse_queries']} | "
+          f"bytes en blob: {result['blob_bytes']}")
+    print("\nEtapa                                                             llamadas   media ms   ms/petición")
+    for stage in result["stages"]:
+        print(f"{stage['stage'][:64]:<64} {stage['calls']:>9} {stage['mean_ms']:>10} {stage['ms_per_request']:>13}")
+
+    if baseline:
+        print(f"\nComparación con la línea base ({baseline.get('environment', {}).get('commit')}):")
+        for label, current, previous in (
+            ("p50", latency["p50"], baseline["result"]["latency_ms"]["p50"]),
+            ("p95", latency["p95"], baseline["result"]["latency_ms"]["p95"]),
+            ("p99", latency["p99"], baseline["result"]["latency_ms"]["p99"]),
+            ("req/s", result["throughput_rps"], baseline["result"]["throughput_rps"]),
+            ("RSS MB", result["peak_rss_mb"], baseline["result"]["peak_rss_mb"]),
+        ):
+            delta = 100 * (current - previous) / previous if previous else 0.0
+            print(f"  {label:<7} {previous:>10} -> {current:>10} ({delta:+.1f}%)")
+        if baseline.get("parameters") != result.get("parameters"):
+            print("  Aviso: los parámetros de la corrida difieren de los de la línea base.")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="sql_agent_bench_")
+    configure_environment(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+    # Paquete compartido `common/` en la raíz del repositorio.
+    sys.path.insert(1, os.path.dirname(BACKEND_DIR))
+
+    quiet = open(os.devnull, "w") if not args.verbose else None
+    with contextlib.redirect_stdout(quiet) if quiet else contextlib.nullcontext():
+        fakes_state = install_fakes(args)
+        result = asyncio.run(run_benchmark(args, fakes_state))
+    if quiet:
+        quiet.close()
+
+    parameters = {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "verbose")}
+    result["parameters"] = parameters
+    report = {"environment": environment_info(), "parameters": parameters, "result": result}
+
+    # Con peticiones fallidas las latencias no miden el camino real: no se reportan ni se guardan.
+    if result["errors"]:
+        print(f"\n{result['errors']} de {result['requests']} peticiones fallaron; no se reportan latencias.")
+        print(f"Primer error: {result['first_error']}")
+        sys.exit(1)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\nResultados guardados en {args.output}")
+
+
+if __name__ == "__main__":
+    main()
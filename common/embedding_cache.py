@@ -0,0 +1,145 @@
+import hashlib
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, List, Optional
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    Caché de embeddings de dos niveles con clave (deployment, texto normalizado).
+
+    - Nivel 1: LRU en memoria con los vectores como arreglos float32.
+    - Nivel 2: SQLite local con los vectores serializados como float32 crudos, con
+      desalojo por tamaño (se eliminan las entradas de acceso más antiguo).
+
+    Es segura entre hilos, ya que los embeddings se piden tanto desde corrutinas como
+    desde `asyncio.to_thread`. La comparten el backend del agente SQL y la aplicación de voz;
+    como usan el mismo formato en disco, ambos procesos pueden apuntar al mismo archivo.
+    """
+
+    def __init__(self, db_path: str, memory_items: int = 1024, max_disk_items: int = 50000):
+        self.db_path = Path(db_path)
+        self.memory_items = memory_items
+        self.max_disk_items = max_disk_items
+
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                deployment TEXT NOT NULL,
+                dim INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings (last_access)")
+        self._conn.commit()
+        # Conteo aproximado de entradas en disco: evita un COUNT(*) en cada escritura. Otro proceso
+        # puede escribir en el mismo archivo, así que se recalcula al desalojar.
+        self._disk_items = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Normalización de la clave: Unicode NFC y espacios colapsados."""
+        return " ".join(unicodedata.normalize("NFC", text or "").split())
+
+    @classmethod
+    def make_key(cls, deployment: str, text: str) -> str:
+        return hashlib.sha256(f"{deployment}\x00{cls.normalize(text)}".encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, vector: np.ndarray):
+        """Inserta en la LRU en memoria. Requiere el lock."""
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, deployment: str, text: str) -> Optional[List[float]]:
+        key = self.make_key(deployment, text)
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return vector.tolist()
+
+            row = self._conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            vector = np.frombuffer(row[0], dtype=np.float32)
+            self._conn.execute("UPDATE embeddings SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self._remember(key, vector)
+            self.disk_hits += 1
+            return vector.tolist()
+
+    def put(self, deployment: str, text: str, embedding: List[float]):
+        key = self.make_key(deployment, text)
+        vector = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            self._remember(key, vector)
+            row = (deployment, vector.shape[0], vector.tobytes(), time.time(), key)
+            updated = self._conn.execute(
+                "UPDATE embeddings SET deployment = ?, dim = ?, vector = ?, last_access = ? WHERE key = ?", row
+            ).rowcount
+            if not updated:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO embeddings (deployment, dim, vector, last_access, key) VALUES (?, ?, ?, ?, ?)", row
+                )
+                self._disk_items += 1
+                if self._disk_items > self.max_disk_items:
+                    self._evict_disk_locked()
+            self._conn.commit()
+
+    def _evict_disk_locked(self):
+        """Desalojo por tamaño: al superar el máximo se libera un 10% adicional de las entradas más antiguas."""
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if count > self.max_disk_items:
+            to_remove = count - self.max_disk_items + max(1, self.max_disk_items // 10)
+            deleted = self._conn.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_access ASC LIMIT ?)",
+                (to_remove,),
+            ).rowcount
+            self.evictions += deleted
+            count -= deleted
+        self._disk_items = count
+
+    def get_or_compute(self, deployment: str, text: str, compute: Callable[[str], List[float]]) -> List[float]:
+        """Devuelve el embedding cacheado o lo calcula con `compute` y lo guarda."""
+        cached = self.get(deployment, text)
+        if cached is not None:
+            return cached
+        embedding = compute(text)
+        self.put(deployment, text, embedding)
+        return embedding
+
+    def stats(self) -> dict:
+        with self._lock:
+            disk_items = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_items": len(self._memory),
+                "disk_items": disk_items,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+            }